@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+
+# archive.py
+# random access to single members of torrents.tar.xz
+
+"""
+Random-access reader for the archive written by pack.py.
+
+pixz compresses the tar stream in many independent xz blocks,
+and the xz index at the end of the stream has the compressed and
+uncompressed size of every block. The member offsets come from the
+ratarmount index next to the archive (see tarindex.py).
+To read one member, only the blocks that hold its data are decompressed.
+
+Members can be looked up by path, by glob pattern,
+or by infohash (via the btih field of torrents.json in the archive).
+Batch reads are sorted by offset, so every block is decompressed once.
+
+Usage:
+    ./archive.py torrents.tar.xz list 'torrents/managed_by_aa/*'
+    ./archive.py torrents.tar.xz cat torrents.json
+    ./archive.py torrents.tar.xz extract -C out torrents/external/libgen_rs_non_fic/r_000.torrent
+    ./archive.py torrents.tar.xz extract -C out --glob 'torrents/managed_by_aa/zlib/*'
+    ./archive.py torrents.tar.xz extract -C out --infohash 0fd7573a81057f56d07b0561874bbb39f2c861a0
+    ./archive.py torrents.tar.xz blocks
+    # for archives without index, scan the archive once
+    ./archive.py torrents.tar.xz build-index
+"""
+
+import io
+import os
+import sys
+import lzma
+import time
+import zlib
+import struct
+import bisect
+import fnmatch
+import tarfile
+from collections import OrderedDict
+
+from tarwriter import TarMember
+from tarindex import get_index_path, read_index, write_index
+from manifest import cache_file, url_prefix, iter_json_array
+
+xz_header_magic = b"\xfd7zXZ\x00"
+xz_footer_magic = b"YZ"
+xz_header_size = 12
+xz_footer_size = 12
+
+# size of the integrity check by check type
+xz_check_sizes = {0: 0, 1: 4, 4: 8, 10: 32}
+
+# number of decompressed blocks to keep in memory
+default_cache_blocks = 4
+
+class ArchiveError(Exception):
+    pass
+
+class XzBlock:
+    """
+    one block of an xz file
+
+    offset: start of the block in the xz file
+    data_offset: start of the block in the decompressed data
+    """
+
+    __slots__ = ("offset", "unpadded_size", "data_offset", "data_size", "stream_flags")
+
+    def __init__(self, offset, unpadded_size, data_offset, data_size, stream_flags):
+        self.offset = offset
+        self.unpadded_size = unpadded_size
+        self.data_offset = data_offset
+        self.data_size = data_size
+        self.stream_flags = stream_flags
+
+    def __repr__(self):
+        return f"XzBlock(offset={self.offset}, data_offset={self.data_offset}, data_size={self.data_size})"
+
+def pad4(size):
+    return (size + 3) & ~3
+
+def read_varint(buf, pos):
+    "return (value, new_pos)"
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ArchiveError("truncated xz index")
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ArchiveError("bad varint in xz index")
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def read_xz_blocks(f):
+    """
+    return the XzBlock list of an xz file, in file order
+
+    only the stream footers and indexes are read,
+    from the end of the file. concatenated streams are supported.
+    """
+    f.seek(0, io.SEEK_END)
+    pos = f.tell()
+    streams = []
+    while pos > 0:
+        # skip stream padding
+        while pos >= 4:
+            f.seek(pos - 4)
+            if f.read(4) != b"\0\0\0\0":
+                break
+            pos -= 4
+        if pos == 0:
+            break
+        if pos < xz_header_size + xz_footer_size:
+            raise ArchiveError("not an xz file")
+        f.seek(pos - xz_footer_size)
+        footer = f.read(xz_footer_size)
+        if footer[10:12] != xz_footer_magic:
+            raise ArchiveError("not an xz file: bad stream footer")
+        if zlib.crc32(footer[4:10]) != struct.unpack("<I", footer[0:4])[0]:
+            raise ArchiveError("bad crc32 of xz stream footer")
+        index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+        stream_flags = footer[8:10]
+        index_start = pos - xz_footer_size - index_size
+        f.seek(index_start)
+        index = f.read(index_size)
+        if index[0] != 0 or zlib.crc32(index[:-4]) != struct.unpack("<I", index[-4:])[0]:
+            raise ArchiveError("bad xz index")
+        count, p = read_varint(index, 1)
+        records = []
+        for _ in range(count):
+            unpadded_size, p = read_varint(index, p)
+            data_size, p = read_varint(index, p)
+            records.append((unpadded_size, data_size))
+        blocks_size = sum(pad4(unpadded_size) for unpadded_size, _ in records)
+        stream_start = index_start - blocks_size - xz_header_size
+        if stream_start < 0:
+            raise ArchiveError("bad xz index: blocks size")
+        f.seek(stream_start)
+        header = f.read(xz_header_size)
+        if header[0:6] != xz_header_magic or header[6:8] != stream_flags:
+            raise ArchiveError("bad xz stream header")
+        streams.append((stream_start, stream_flags, records))
+        pos = stream_start
+
+    blocks = []
+    data_offset = 0
+    for stream_start, stream_flags, records in reversed(streams):
+        offset = stream_start + xz_header_size
+        for unpadded_size, data_size in records:
+            blocks.append(XzBlock(offset, unpadded_size, data_offset, data_size, stream_flags))
+            offset += pad4(unpadded_size)
+            data_offset += data_size
+    return blocks
+
+def decompress_block(f, block):
+    """
+    decompress one xz block
+
+    the block is wrapped in a stream with a one-record index,
+    so the lzma module checks the block size and the integrity check.
+    """
+    f.seek(block.offset)
+    data = f.read(pad4(block.unpadded_size))
+    check_size = xz_check_sizes.get(block.stream_flags[1] & 0x0f)
+    if check_size is None:
+        raise ArchiveError(f"unsupported xz check type {block.stream_flags[1]}")
+    header = xz_header_magic + block.stream_flags + struct.pack("<I", zlib.crc32(block.stream_flags))
+    index = b"\0" + encode_varint(1) + encode_varint(block.unpadded_size) + encode_varint(block.data_size)
+    index += b"\0" * (-len(index) % 4)
+    index += struct.pack("<I", zlib.crc32(index))
+    footer = struct.pack("<I", len(index) // 4 - 1) + block.stream_flags
+    footer = struct.pack("<I", zlib.crc32(footer)) + footer + xz_footer_magic
+    try:
+        result = lzma.decompress(header + data + index + footer, format=lzma.FORMAT_XZ)
+    except lzma.LZMAError as e:
+        raise ArchiveError(f"failed to decompress xz block at offset {block.offset}: {e}")
+    if len(result) != block.data_size:
+        raise ArchiveError(f"bad size of xz block at offset {block.offset}")
+    return result
+
+def scan_archive(archive_path):
+    "read the whole archive once, return the TarMember list"
+    members = []
+    with tarfile.open(archive_path, "r|xz") as tar:
+        for info in tar:
+            name = info.name + "/" if info.isdir() else info.name
+            members.append(TarMember(
+                name, info.type.decode(), info.mode, info.size,
+                info.offset, info.offset_data, info.linkname or None,
+            ))
+    return members
+
+class ArchiveReader:
+    """
+    read single members of a tar.xz archive
+
+    usage:
+
+        with ArchiveReader("torrents.tar.xz") as archive:
+            member = archive.get_member("torrents.json")
+            data = archive.read(member)
+    """
+
+    def __init__(self, archive_path, index_path=None, cache_blocks=default_cache_blocks):
+        self.archive_path = archive_path
+        self.index_path = index_path or get_index_path(archive_path)
+        if not os.path.exists(self.index_path):
+            raise ArchiveError(f"missing index {self.index_path}. hint: ./archive.py {archive_path} build-index")
+        self.f = open(archive_path, "rb")
+        self.blocks = read_xz_blocks(self.f)
+        self.block_starts = [block.data_offset for block in self.blocks]
+        self.members = read_index(self.index_path)
+        self.by_name = {m.name.rstrip("/"): m for m in self.members}
+        self.cache = OrderedDict()
+        self.cache_blocks = cache_blocks
+        self.infohashes = None
+        # stats
+        self.num_blocks_read = 0
+        self.num_bytes_read = 0
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_member(self, name):
+        "return the member with this path, or None"
+        name = name.removeprefix("./").rstrip("/")
+        return self.by_name.get(name)
+
+    def glob(self, pattern):
+        "return the members matching a glob pattern, in archive order"
+        pattern = pattern.removeprefix("./")
+        return [m for m in self.members if fnmatch.fnmatchcase(m.name.rstrip("/"), pattern)]
+
+    def find_infohash(self, infohash):
+        "return the member with this infohash (hex), or None"
+        if self.infohashes is None:
+            self.infohashes = self.load_infohashes()
+        return self.infohashes.get(infohash.lower())
+
+    def load_infohashes(self):
+        "map the btih of torrents.json to members"
+        member = self.get_member(cache_file)
+        if member is None:
+            raise ArchiveError(f"missing {cache_file} in archive")
+        infohashes = {}
+        f = io.TextIOWrapper(io.BytesIO(self.read(member)), encoding="utf8")
+        for torrent in iter_json_array(f):
+            btih = torrent.get("btih")
+            url = torrent["url"]
+            if not btih or not url.startswith(url_prefix):
+                continue
+            m = self.get_member(url[len(url_prefix):])
+            if m is not None:
+                infohashes[btih.lower()] = m
+        return infohashes
+
+    def get_block(self, i):
+        data = self.cache.get(i)
+        if data is not None:
+            self.cache.move_to_end(i)
+            return data
+        data = decompress_block(self.f, self.blocks[i])
+        self.num_blocks_read += 1
+        self.num_bytes_read += len(data)
+        self.cache[i] = data
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return data
+
+    def read_range(self, offset, size):
+        "read size bytes at offset of the decompressed tar stream"
+        parts = []
+        i = bisect.bisect_right(self.block_starts, offset) - 1
+        end = offset + size
+        while offset < end:
+            if i < 0 or i >= len(self.blocks):
+                raise ArchiveError(f"offset {offset} is outside of the archive")
+            block = self.blocks[i]
+            data = self.get_block(i)
+            start = offset - block.data_offset
+            chunk = data[start:start + end - offset]
+            parts.append(chunk)
+            offset += len(chunk)
+            i += 1
+        return b"".join(parts)
+
+    def resolve(self, member):
+        "follow hard links to the member with the data"
+        seen = 0
+        while member.typeflag == "1":
+            target = self.get_member(member.linkname)
+            seen += 1
+            if target is None or seen > 100:
+                raise ArchiveError(f"bad hard link {member.name} -> {member.linkname}")
+            member = target
+        return member
+
+    def read(self, member):
+        "return the contents of a file member"
+        member = self.resolve(member)
+        if member.typeflag != "0":
+            raise ArchiveError(f"not a regular file: {member.name}")
+        return self.read_range(member.data_offset, member.size)
+
+    def read_many(self, members):
+        """
+        yield (member, data) for the file members, in archive order
+
+        sorting by offset visits every block once
+        """
+        order = sorted(members, key=lambda m: self.resolve(m).data_offset)
+        for member in order:
+            yield member, self.read(member)
+
+    def extract(self, members, dest_dir):
+        "extract members below dest_dir, return the number of extracted members"
+        num_done = 0
+        dest_dir = os.path.abspath(dest_dir)
+        real_dest_dir = os.path.realpath(dest_dir)
+        def check_inside(path, member):
+            # resolve the symlinks which were extracted before,
+            # so "a -> /etc" and then "a/x" cannot write outside of dest_dir
+            if os.path.commonpath([real_dest_dir, os.path.realpath(path)]) != real_dest_dir:
+                raise ArchiveError(f"unsafe member path: {member.name}")
+        files = []
+        for member in members:
+            path = os.path.abspath(os.path.join(dest_dir, member.name))
+            if os.path.commonpath([dest_dir, path]) != dest_dir:
+                raise ArchiveError(f"unsafe member path: {member.name}")
+            if member.typeflag == "5":
+                check_inside(path, member)
+                os.makedirs(path, exist_ok=True)
+                num_done += 1
+            elif member.typeflag == "2":
+                parent = os.path.dirname(path)
+                check_inside(parent, member)
+                # relative targets are resolved from the directory of the link
+                if os.path.commonpath([real_dest_dir, os.path.realpath(os.path.join(parent, member.linkname))]) != real_dest_dir:
+                    raise ArchiveError(f"unsafe symlink: {member.name} -> {member.linkname}")
+                os.makedirs(parent, exist_ok=True)
+                if os.path.lexists(path):
+                    os.unlink(path)
+                os.symlink(member.linkname, path)
+                num_done += 1
+            else:
+                files.append(member)
+        for member, data in self.read_many(files):
+            path = os.path.join(dest_dir, member.name)
+            check_inside(os.path.dirname(path), member)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + ".part"
+            # never write through a symlink
+            if os.path.lexists(temp_path):
+                os.unlink(temp_path)
+            with open(temp_path, "xb") as f:
+                f.write(data)
+            os.chmod(temp_path, member.mode)
+            os.replace(temp_path, path)
+            num_done += 1
+        return num_done
+
+def select_members(archive, items, use_glob=False, use_infohash=False):
+    members = []
+    for item in items:
+        if use_glob:
+            found = archive.glob(item)
+        elif use_infohash:
+            found = [archive.find_infohash(item)]
+        else:
+            found = [archive.get_member(item)]
+        found = [m for m in found if m is not None]
+        if not found:
+            print(f"error: not found: {item}")
+            sys.exit(1)
+        members += found
+    return members
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="random access to single members of torrents.tar.xz")
+    parser.add_argument("archive")
+    parser.add_argument("--index", help="ratarmount index (default: archive.index.sqlite)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("list", help="list members")
+    p.add_argument("pattern", nargs="?", default="*")
+    p = subparsers.add_parser("cat", help="write one member to stdout")
+    p.add_argument("name")
+    p = subparsers.add_parser("extract", help="extract members")
+    p.add_argument("items", nargs="+", help="member paths, glob patterns or infohashes")
+    p.add_argument("-C", "--directory", default=".", help="output directory (default: .)")
+    p.add_argument("--glob", action="store_true", help="items are glob patterns")
+    p.add_argument("--infohash", action="store_true", help="items are infohashes")
+    subparsers.add_parser("blocks", help="list the xz blocks")
+    subparsers.add_parser("build-index", help="scan the archive and write the ratarmount index")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.archive):
+        print(f"error: missing input file: {args.archive}")
+        sys.exit(1)
+
+    if args.command == "build-index":
+        t1 = time.time()
+        members = scan_archive(args.archive)
+        index_path = write_index(members, args.archive, args.index)
+        print(f"wrote {index_path} with {len(members)} members in {time.time() - t1:.1f} seconds")
+        return
+
+    if args.command == "blocks":
+        with open(args.archive, "rb") as f:
+            blocks = read_xz_blocks(f)
+        for block in blocks:
+            print(f"{block.offset:12d} {pad4(block.unpadded_size):10d} {block.data_offset:14d} {block.data_size:10d}")
+        print(f"{len(blocks)} blocks", file=sys.stderr)
+        if len(blocks) == 1:
+            print("warning: only one xz block, random access reads the whole archive. hint: compress with pixz", file=sys.stderr)
+        return
+
+    try:
+        archive = ArchiveReader(args.archive, args.index)
+    except ArchiveError as e:
+        print(f"error: {e}")
+        sys.exit(1)
+
+    with archive:
+        t1 = time.time()
+        if args.command == "list":
+            for m in archive.glob(args.pattern):
+                print(m.name)
+        elif args.command == "cat":
+            members = select_members(archive, [args.name])
+            sys.stdout.buffer.write(archive.read(members[0]))
+        elif args.command == "extract":
+            members = select_members(archive, args.items, args.glob, args.infohash)
+            num_done = archive.extract(members, args.directory)
+            print(f"extracted {num_done} members to {args.directory}", file=sys.stderr)
+        t2 = time.time()
+        total_size = archive.blocks[-1].data_offset + archive.blocks[-1].data_size if archive.blocks else 0
+        print(
+            f"decompressed {archive.num_blocks_read} of {len(archive.blocks)} blocks, "
+            f"{archive.num_bytes_read} of {total_size} bytes in {t2 - t1:.3f} seconds",
+            file=sys.stderr,
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# bencode.py
+# strict bencode decoder and encoder for .torrent files
+
+import re
+import hashlib
+
+class BencodeError(ValueError):
+    pass
+
+int_regex = re.compile(rb"-?(0|[1-9][0-9]*)")
+
+def decode_int(data, pos):
+    # i123e
+    end = data.index(b"e", pos)
+    raw = data[pos + 1:end]
+    if not int_regex.fullmatch(raw) or raw == b"-0":
+        raise BencodeError(f"invalid integer {raw[:32]!r} at {pos}")
+    return int(raw), end + 1
+
+def decode_bytes(data, pos):
+    # 4:spam
+    colon = data.index(b":", pos)
+    raw = data[pos:colon]
+    if not raw.isdigit() or raw[:1] == b"0" and len(raw) > 1:
+        raise BencodeError(f"invalid string length {raw[:32]!r} at {pos}")
+    start = colon + 1
+    end = start + int(raw)
+    if end > len(data):
+        raise BencodeError(f"string at {pos} ends after the end of data")
+    return data[start:end], end
+
+def decode_list(data, pos):
+    result = []
+    pos += 1
+    while data[pos:pos + 1] != b"e":
+        value, pos = decode_value(data, pos)
+        result.append(value)
+    return result, pos + 1
+
+def check_key_order(key, last_key, pos):
+    # the keys of a dict must be unique and sorted as raw strings,
+    # so every value has exactly one encoding
+    if last_key is None or key > last_key:
+        return
+    if key == last_key:
+        raise BencodeError(f"duplicate dict key {key[:32]!r} at {pos}")
+    raise BencodeError(f"unsorted dict key {key[:32]!r} at {pos}")
+
+def decode_dict(data, pos):
+    result = {}
+    key = None
+    pos += 1
+    while data[pos:pos + 1] != b"e":
+        if not data[pos:pos + 1].isdigit():
+            raise BencodeError(f"dict key at {pos} is not a string")
+        last_key = key
+        key, end = decode_bytes(data, pos)
+        check_key_order(key, last_key, pos)
+        value, pos = decode_value(data, end)
+        result[key] = value
+    return result, pos + 1
+
+def decode_value(data, pos):
+    c = data[pos:pos + 1]
+    if c == b"i":
+        return decode_int(data, pos)
+    if c == b"l":
+        return decode_list(data, pos)
+    if c == b"d":
+        return decode_dict(data, pos)
+    if c.isdigit():
+        return decode_bytes(data, pos)
+    if not c:
+        raise BencodeError("unexpected end of data")
+    raise BencodeError(f"invalid type {c!r} at {pos}")
+
+def decode_checked(decode_func, data):
+    # turn the errors of truncated or malformed data into BencodeError
+    try:
+        return decode_func(data)
+    except BencodeError:
+        raise
+    except (IndexError, RecursionError):
+        raise BencodeError("invalid bencode") from None
+    except ValueError:
+        # bytes.index did not find the terminator
+        raise BencodeError("unexpected end of data") from None
+
+def decode(data):
+    "decode one bencoded value, strings are returned as bytes"
+    value, end = decode_checked(lambda data: decode_value(data, 0), data)
+    if end != len(data):
+        raise BencodeError(f"trailing data at {end}")
+    return value
+
+def encode_value(value, out):
+    if isinstance(value, bool):
+        raise BencodeError("cannot encode bool")
+    if isinstance(value, int):
+        out += b"i%de" % value
+    elif isinstance(value, (bytes, str)):
+        if isinstance(value, str):
+            value = value.encode()
+        out += b"%d:" % len(value)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += b"l"
+        for item in value:
+            encode_value(item, out)
+        out += b"e"
+    elif isinstance(value, dict):
+        # keys are sorted as raw strings
+        items = sorted(((k.encode() if isinstance(k, str) else k, v) for k, v in value.items()), key=lambda item: item[0])
+        out += b"d"
+        for key, item in items:
+            encode_value(key, out)
+            encode_value(item, out)
+        out += b"e"
+    else:
+        raise BencodeError(f"cannot encode {type(value).__name__}")
+
+def encode(value):
+    "bencode a value of int, bytes, str, list and dict"
+    out = bytearray()
+    encode_value(value, out)
+    return bytes(out)
+
+def decode_torrent_dict(data):
+    # decode the top-level dict and locate the raw info value,
+    # so the infohash is the sha1 of the original bytes
+    if data[:1] != b"d":
+        raise BencodeError("torrent is not a dict")
+    metainfo = {}
+    info_span = None
+    key = None
+    pos = 1
+    while data[pos:pos + 1] != b"e":
+        if not data[pos:pos + 1].isdigit():
+            raise BencodeError(f"dict key at {pos} is not a string")
+        last_key = key
+        key, start = decode_bytes(data, pos)
+        check_key_order(key, last_key, pos)
+        pos = start
+        metainfo[key], pos = decode_value(data, pos)
+        if key == b"info":
+            info_span = (start, pos)
+    return metainfo, info_span, pos + 1
+
+def decode_torrent(data):
+    """
+    decode a .torrent file
+
+    return (metainfo, infohash) where infohash is the hex sha1
+    of the raw bencoded info dict, as used in magnet links.
+    """
+    metainfo, info_span, end = decode_checked(decode_torrent_dict, data)
+    if end != len(data):
+        raise BencodeError(f"trailing data at {end}")
+    if info_span is None:
+        raise BencodeError("missing info dict")
+    start, end = info_span
+    infohash = hashlib.sha1(data[start:end]).hexdigest()
+    return metainfo, infohash
+
+def check_torrent(metainfo):
+    "raise BencodeError if metainfo is not a valid BitTorrent v1 or v2 torrent"
+    info = metainfo.get(b"info")
+    if not isinstance(info, dict):
+        raise BencodeError("info is not a dict")
+    if not isinstance(info.get(b"name"), bytes):
+        raise BencodeError("missing info.name")
+    piece_length = info.get(b"piece length")
+    if not isinstance(piece_length, int) or piece_length <= 0:
+        raise BencodeError(f"invalid info.piece length {piece_length!r}")
+    if info.get(b"meta version") == 2 and b"pieces" not in info:
+        # v2-only torrent
+        if not isinstance(info.get(b"file tree"), dict):
+            raise BencodeError("missing info.file tree")
+        return
+    pieces = info.get(b"pieces")
+    if not isinstance(pieces, bytes) or len(pieces) % 20 != 0:
+        raise BencodeError("invalid info.pieces")
+    if b"length" in info:
+        length = info[b"length"]
+        if not isinstance(length, int) or length < 0:
+            raise BencodeError(f"invalid info.length {length!r}")
+        total_size = length
+    elif isinstance(info.get(b"files"), list):
+        total_size = 0
+        for f in info[b"files"]:
+            if not isinstance(f, dict):
+                raise BencodeError("info.files item is not a dict")
+            length = f.get(b"length")
+            if not isinstance(length, int) or length < 0:
+                raise BencodeError(f"invalid info.files length {length!r}")
+            path = f.get(b"path")
+            if not isinstance(path, list) or not all(isinstance(p, bytes) for p in path):
+                raise BencodeError("invalid info.files path")
+            total_size += length
+    else:
+        raise BencodeError("missing info.length and info.files")
+    num_pieces = len(pieces) // 20
+    expected_num_pieces = (total_size + piece_length - 1) // piece_length
+    if num_pieces != expected_num_pieces:
+        raise BencodeError(f"expected {expected_num_pieces} pieces, got {num_pieces}")
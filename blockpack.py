@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# blockpack.py
+# incremental packing: reuse the xz blocks of the previous archive
+
+"""
+Incremental packer.
+
+The tar members are split into block groups. Every group starts and ends
+on a member boundary, and is compressed into its own xz blocks.
+The tar bytes of a member do not depend on its offset, so an unchanged
+group compresses to the same xz blocks, and those blocks can be copied
+from the previous archive without decompressing or compressing them.
+
+Group boundaries depend only on the name and size of each member
+(a member starts a new group with a probability proportional to its size,
+decided by the hash of its name), so adding or removing a torrent
+only changes the group that holds it.
+
+A group is unchanged when its signature matches: the sha1 of
+name, type, mode, size, link name, mtime and content sha1 of its members.
+The content sha1 is taken from state.db when update.py hashed the file
+with the same size and mtime, else the file is hashed.
+The signatures are stored in the ratarmount index of the archive
+(table blockgroups, see tarindex.py).
+
+The end-of-archive blocks are always compressed again,
+because the record padding depends on the total size.
+
+The output is one xz stream with many blocks, readable by
+xz, pixz, ratarmount and archive.py.
+Given the same tree and liblzma version, the output is deterministic:
+an incremental pack is byte-identical to a full pack.
+"""
+
+import io
+import os
+import sys
+import lzma
+import zlib
+import struct
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from tarwriter import TarWriter, default_exclude
+from manifest import hash_file
+from state import StateDB, state_db_path
+from tarindex import get_index_path, read_block_groups
+from archive import (
+    xz_header_magic, xz_footer_magic, xz_header_size, xz_footer_size,
+    pad4, read_varint, encode_varint, read_xz_blocks,
+)
+
+# average uncompressed size of a block group
+group_target_size = 8 * 1024 * 1024
+# split a group when it is larger, even without a name boundary
+group_max_size = 32 * 1024 * 1024
+# groups are compressed in blocks of this size,
+# which bounds the cost of random access
+block_size = 4 * 1024 * 1024
+
+default_preset = 1 # like pixz -1
+default_threads = os.cpu_count() or 1
+
+# xz stream flags for CRC64, the default check of xz
+check = lzma.CHECK_CRC64
+stream_flags = b"\x00\x04"
+
+# bump this when the group signature or the block layout changes
+signature_version = b"blockpack 2"
+
+class BlockGroup:
+    """
+    one group of tar members
+
+    items: planned members from TarWriter.iter_planned
+    offset, size: range in the uncompressed tar stream
+    blocks: (block bytes, unpadded size, uncompressed size) list
+    reused: True if the blocks were copied from the previous archive
+    """
+
+    __slots__ = ("items", "offset", "size", "signature", "blocks", "reused")
+
+    def __init__(self):
+        self.items = []
+        self.offset = 0
+        self.size = 0
+        self.signature = None
+        self.blocks = None
+        self.reused = False
+
+def is_group_start(name, size):
+    # deterministic in name, with a probability of about size / group_target_size
+    h = int.from_bytes(hashlib.sha1(name).digest()[:8], "big")
+    return h < (size + 1024) * (1 << 64) // group_target_size
+
+def load_known_sha1s(path=state_db_path):
+    "return {path: (size, mtime_ns, sha1)} of the files hashed by update.py"
+    if not os.path.exists(path):
+        return {}
+    with StateDB(path) as db:
+        return {file_path: (size, mtime_ns, sha1) for file_path, size, mtime_ns, sha1 in db.get_hashed()}
+
+def get_content_sha1(path, st, known_sha1s=None):
+    known = known_sha1s.get(path) if known_sha1s else None
+    if known and known[:2] == (st.st_size, st.st_mtime_ns):
+        return known[2]
+    return hash_file(path)
+
+def group_signature(items, known_sha1s=None):
+    h = hashlib.sha1(signature_version)
+    for path, st, name, typeflag, size, linkname in items:
+        mtime_ns = 0
+        sha1 = ""
+        if typeflag == b"0":
+            mtime_ns = st.st_mtime_ns
+            # a file replaced in place with the same size must not reuse stale blocks
+            sha1 = get_content_sha1(path, st, known_sha1s)
+        h.update(b"%s\0%s\0%o\0%d\0%s\0%d\0%s\n" % (name, typeflag, st.st_mode, size, linkname, mtime_ns, sha1.encode()))
+    return h.hexdigest()
+
+def plan_groups(paths, exclude=default_exclude, known_sha1s=None, threads=default_threads):
+    """
+    split the tar members of paths into block groups
+
+    return (groups, members, trailer_size)
+    the files are read only to hash the ones missing in known_sha1s.
+    """
+    counter = TarWriter(None, exclude)
+    groups = []
+    group = None
+    for item in counter.iter_planned(paths):
+        path, st, name, typeflag, size, linkname = item
+        offset = counter.offset
+        if group is None or (group.items and (
+            is_group_start(name, size) or offset - group.offset >= group_max_size
+        )):
+            group = BlockGroup()
+            group.offset = offset
+            groups.append(group)
+        counter.add_member(item, None)
+        group.items.append(item)
+        group.size = counter.offset - group.offset
+    end = counter.offset
+    counter.close()
+    with ThreadPoolExecutor(threads) as executor:
+        signatures = executor.map(lambda group: group_signature(group.items, known_sha1s), groups)
+        for group, signature in zip(groups, signatures):
+            group.signature = signature
+    return groups, counter.members, counter.offset - end
+
+def build_group_data(group):
+    "return the tar bytes of a group"
+    buf = io.BytesIO()
+    writer = TarWriter(buf)
+    for item in group.items:
+        writer.add_member(item, None)
+    data = buf.getvalue()
+    if len(data) != group.size:
+        raise RuntimeError(f"file changed as we read it, in group at offset {group.offset}")
+    return data
+
+def compress_block(data, preset=default_preset):
+    """
+    compress data into one xz block
+
+    return (block bytes with padding, unpadded size, uncompressed size)
+    """
+    stream = lzma.compress(data, format=lzma.FORMAT_XZ, check=check, preset=preset)
+    footer = stream[-xz_footer_size:]
+    index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+    index = stream[-xz_footer_size - index_size:-xz_footer_size]
+    count, p = read_varint(index, 1)
+    if count != 1:
+        raise RuntimeError(f"expected one xz block, got {count}")
+    unpadded_size, p = read_varint(index, p)
+    data_size, p = read_varint(index, p)
+    block = stream[xz_header_size:xz_header_size + pad4(unpadded_size)]
+    return block, unpadded_size, data_size
+
+def compress_data(data, preset=default_preset):
+    "compress data into xz blocks of block_size"
+    if not data:
+        return []
+    return [compress_block(data[i:i + block_size], preset) for i in range(0, len(data), block_size)]
+
+def compress_group(group, preset=default_preset):
+    return compress_data(build_group_data(group), preset)
+
+def load_previous_blocks(archive_path, index_path=None):
+    """
+    return {signature: XzBlock list} of the block groups of a previous archive
+
+    return {} if the archive was not written by blockpack.py
+    """
+    index_path = index_path or get_index_path(archive_path)
+    if not os.path.exists(index_path):
+        return {}
+    block_groups = read_block_groups(index_path)
+    if not block_groups:
+        return {}
+    with open(archive_path, "rb") as f:
+        f.seek(len(xz_header_magic))
+        if f.read(2) != stream_flags:
+            return {}
+        xz_blocks = read_xz_blocks(f)
+    return {
+        signature: xz_blocks[first_block:first_block + num_blocks]
+        for first_block, num_blocks, signature in block_groups
+    }
+
+class XzStreamWriter:
+    "write one xz stream of compressed blocks"
+
+    def __init__(self, f):
+        self.f = f
+        self.records = []
+        f.write(xz_header_magic + stream_flags + struct.pack("<I", zlib.crc32(stream_flags)))
+
+    def add_block(self, block, unpadded_size, data_size):
+        self.f.write(block)
+        self.records.append((unpadded_size, data_size))
+
+    def close(self):
+        index = bytearray(b"\0" + encode_varint(len(self.records)))
+        for unpadded_size, data_size in self.records:
+            index += encode_varint(unpadded_size) + encode_varint(data_size)
+        index += b"\0" * (-len(index) % 4)
+        index += struct.pack("<I", zlib.crc32(index))
+        self.f.write(index)
+        footer = struct.pack("<I", len(index) // 4 - 1) + stream_flags
+        self.f.write(struct.pack("<I", zlib.crc32(footer)) + footer + xz_footer_magic)
+
+def pack(output, paths, previous_path=None, preset=default_preset, threads=default_threads, known_sha1s=None):
+    """
+    write the tar.xz archive of paths to the file object output
+
+    xz blocks of unchanged groups are copied from previous_path.
+    known_sha1s is the result of load_known_sha1s.
+    return (members, block_groups, num_reused)
+    where block_groups is the table for tarindex.write_index
+    """
+    groups, members, trailer_size = plan_groups(paths, known_sha1s=known_sha1s, threads=threads)
+    previous = load_previous_blocks(previous_path) if previous_path else {}
+    for group in groups:
+        xz_blocks = previous.get(group.signature)
+        group.reused = xz_blocks is not None and sum(b.data_size for b in xz_blocks) == group.size
+        if group.reused:
+            group.blocks = xz_blocks
+
+    stream = XzStreamWriter(output)
+    block_groups = []
+
+    def write_group(group, future, previous_file):
+        if group.reused:
+            blocks = []
+            for block in group.blocks:
+                previous_file.seek(block.offset)
+                blocks.append((previous_file.read(pad4(block.unpadded_size)), block.unpadded_size, block.data_size))
+        else:
+            blocks = future.result()
+        block_groups.append((len(stream.records), len(blocks), group.signature))
+        for block in blocks:
+            stream.add_block(*block)
+        # free the memory
+        group.items = group.blocks = None
+
+    # compress the changed groups in a bounded window,
+    # and write all groups in order
+    with open(previous_path or os.devnull, "rb") as previous_file, ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        num_running = 0
+        for group in groups:
+            future = None
+            if not group.reused:
+                future = executor.submit(compress_group, group, preset)
+                num_running += 1
+            pending.append((group, future))
+            while num_running >= 2 * threads:
+                group, future = pending.popleft()
+                write_group(group, future, previous_file)
+                num_running -= future is not None
+        while pending:
+            write_group(*pending.popleft(), previous_file)
+
+    for block in compress_data(b"\0" * trailer_size, preset):
+        stream.add_block(*block)
+    stream.close()
+    num_reused = sum(1 for group in groups if group.reused)
+    return members, block_groups, num_reused
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="write a tar.xz archive, reusing the xz blocks of a previous archive")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("-f", "--file", required=True, help="output file")
+    parser.add_argument("--previous", help="previous archive, with its index")
+    parser.add_argument("--threads", type=int, default=default_threads)
+    args = parser.parse_args()
+    from tarindex import write_index
+    t1 = time.time()
+    with open(args.file, "wb") as f:
+        members, block_groups, num_reused = pack(f, args.paths, args.previous, threads=args.threads, known_sha1s=load_known_sha1s())
+    write_index(members, args.file, block_groups=block_groups)
+    print(f"reused {num_reused} of {len(block_groups)} block groups in {time.time() - t1:.1f} seconds", file=sys.stderr)
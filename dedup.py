@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# dedup.py
+# content-addressed store for the files in torrents/
+
+"""
+Content-addressed store for the files in torrents/.
+
+Some torrent files are listed under several urls, so update.py
+downloads the same bytes to several paths. The store keeps one copy
+of every file content in objects/<sha1[:2]>/<sha1>, and the paths
+in torrents/ are hard links to their object. The logical tree is not
+changed, but duplicates use no disk space, and pack.py writes them
+as tar hard links, so their data is read and compressed only once.
+
+The sha1 of the file contents is taken from state.sqlite.
+Files are never written in place (downloads are renamed over the old path),
+so a new download replaces its hard link and does not change the object.
+Objects without any path in torrents/ are removed by gc_store.
+
+Usage:
+    ./update.py --dedup
+    # dedup an existing tree
+    ./dedup.py
+    # only remove unused objects
+    ./dedup.py --gc
+"""
+
+store_dir = "objects"
+
+import os
+import sys
+
+from manifest import hash_file, load_manifest
+from state import StateDB, state_db_path
+
+class DedupStats:
+    def __init__(self):
+        self.num_files = 0
+        self.num_objects = 0
+        self.num_linked = 0
+        self.saved_size = 0
+
+    def __str__(self):
+        return (
+            f"{self.num_files} files, {self.num_objects} new objects, "
+            f"{self.num_linked} duplicates linked, {self.saved_size} bytes saved"
+        )
+
+def get_object_path(sha1):
+    return os.path.join(store_dir, sha1[:2], sha1)
+
+def link_file(path, sha1):
+    """
+    make path a hard link to the object of sha1
+
+    return "new" if path was added to the store,
+    "linked" if path was replaced by a link to an existing object,
+    or None if path already is a link to its object
+    """
+    object_path = get_object_path(sha1)
+    try:
+        object_st = os.stat(object_path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.link(path, object_path)
+        return "new"
+    st = os.stat(path)
+    if (st.st_dev, st.st_ino) == (object_st.st_dev, object_st.st_ino):
+        return None
+    if st.st_size != object_st.st_size:
+        raise RuntimeError(f"size of {path} differs from {object_path}. hint: run update.py --verify")
+    # replace path atomically
+    temp_path = f"{path}.dedup.tmp"
+    os.link(object_path, temp_path)
+    os.replace(temp_path, path)
+    return "linked"
+
+def dedup_state(db):
+    """
+    link all present files of the state database into the store
+
+    files without a sha1 are hashed. return DedupStats
+    """
+    stats = DedupStats()
+    for url, path, size, mtime_ns, sha1 in db.get_present():
+        if sha1 is None:
+            sha1 = hash_file(path)
+        result = link_file(path, sha1)
+        stats.num_files += 1
+        if result == "new":
+            stats.num_objects += 1
+        elif result == "linked":
+            stats.num_linked += 1
+            stats.saved_size += size
+        if result is not None:
+            # the mtime of a link is the mtime of its object
+            st = os.stat(path)
+            db.record_file(url, path, st.st_size, st.st_mtime_ns, sha1, event="deduplicated")
+    db.commit()
+    return stats
+
+def gc_store():
+    "remove objects which have no link in torrents/. return the number of removed objects"
+    num_removed = 0
+    if not os.path.isdir(store_dir):
+        return 0
+    for prefix in os.scandir(store_dir):
+        if not prefix.is_dir(follow_symlinks=False):
+            continue
+        for entry in os.scandir(prefix.path):
+            if entry.stat(follow_symlinks=False).st_nlink == 1:
+                os.unlink(entry.path)
+                num_removed += 1
+        if not any(os.scandir(prefix.path)):
+            os.rmdir(prefix.path)
+    return num_removed
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="hard link duplicate files in torrents/ to a content-addressed store")
+    parser.add_argument("--gc", action="store_true", help=f"only remove unused objects from {store_dir}/")
+    args = parser.parse_args()
+    if not args.gc:
+        if not os.path.exists(state_db_path):
+            print(f"error: missing {state_db_path}. hint: run update.py first")
+            sys.exit(1)
+        with StateDB(state_db_path) as db:
+            db.sync_manifest(load_manifest().entries)
+            print(f"dedup: {dedup_state(db)}")
+    print(f"dedup: removed {gc_store()} unused objects")
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# delta.py
+# delta archives between two releases
+
+"""
+Delta archives between two releases.
+
+Both archives must be written by pack.py with --incremental, the default (see blockpack.py),
+so their xz blocks are grouped by block groups with signatures.
+The delta has only the xz blocks of the block groups that are not
+in the old archive, plus a recipe to rebuild the new archive
+from the old blocks and the delta blocks, byte by byte.
+
+The delta is an uncompressed tar file with
+- delta.json: versions, sha256 hashes, recipe, and the added,
+  changed and removed torrents (from the torrents.json of both archives)
+- blocks.xz: an xz stream of the new blocks
+- index.sqlite.xz: the ratarmount index of the new archive
+
+apply checks the sha256 of the old archive, the new archive and the new index.
+
+Usage:
+    ./delta.py create old/torrents.tar.xz new/torrents.tar.xz -o torrents.delta.tar
+    ./delta.py info torrents.delta.tar
+    ./delta.py apply old/torrents.tar.xz torrents.delta.tar -o torrents.tar.xz
+"""
+
+import io
+import os
+import sys
+import json
+import lzma
+import time
+import hashlib
+import tarfile
+import tempfile
+
+from manifest import Manifest, cache_file, iter_json_array
+from tarindex import get_index_path, read_block_groups
+from archive import ArchiveReader, pad4, read_xz_blocks, xz_header_magic
+from blockpack import XzStreamWriter, stream_flags
+
+# bump this when the delta format changes
+delta_format_version = 1
+
+read_size = 1024 * 1024
+
+class DeltaError(Exception):
+    pass
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(read_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+class HashWriter:
+    "file object wrapper, which hashes what is written"
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+def read_block_layout(archive_path):
+    """
+    return (xz blocks, block groups) of an archive written by blockpack.py
+
+    block groups are (first_block, num_blocks, signature)
+    """
+    index_path = get_index_path(archive_path)
+    if not os.path.exists(index_path):
+        raise DeltaError(f"missing index {index_path}")
+    block_groups = read_block_groups(index_path)
+    if not block_groups:
+        raise DeltaError(f"no block groups in {index_path}. hint: pack with pack.py --incremental, the default")
+    with open(archive_path, "rb") as f:
+        if f.read(len(xz_header_magic) + 2) != xz_header_magic + stream_flags:
+            raise DeltaError(f"unexpected xz stream flags in {archive_path}")
+        xz_blocks = read_xz_blocks(f)
+    return xz_blocks, block_groups
+
+def read_archive_manifest(archive_path):
+    "return the Manifest of the torrents.json in an archive"
+    with ArchiveReader(archive_path) as archive:
+        member = archive.get_member(cache_file)
+        if member is None:
+            raise DeltaError(f"missing {cache_file} in {archive_path}")
+        data = archive.read(member)
+    manifest = Manifest()
+    for torrent in iter_json_array(io.TextIOWrapper(io.BytesIO(data), encoding="utf8")):
+        manifest.add(torrent)
+    return manifest
+
+def diff_manifests(old, new):
+    "return (added, changed, removed) paths"
+    old_entries = {e.path: e for e in old.entries}
+    new_entries = {e.path: e for e in new.entries}
+    added = sorted(p for p in new_entries if p not in old_entries)
+    removed = sorted(p for p in old_entries if p not in new_entries)
+    changed = sorted(
+        p for p, e in new_entries.items()
+        if p in old_entries and (e.btih, e.size) != (old_entries[p].btih, old_entries[p].size)
+    )
+    return added, changed, removed
+
+def add_recipe_step(recipe, source, first_block, num_blocks):
+    # merge with the last step when the blocks are contiguous
+    if recipe and recipe[-1][0] == source and recipe[-1][1] + recipe[-1][2] == first_block:
+        recipe[-1][2] += num_blocks
+    else:
+        recipe.append([source, first_block, num_blocks])
+
+def add_file(tar, name, path):
+    info = tar.gettarinfo(path, name)
+    info.mtime = 0
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    info.mode = 0o644
+    with open(path, "rb") as f:
+        tar.addfile(info, f)
+
+def add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+def create_delta(old_path, new_path, delta_path, old_version=None, new_version=None):
+    """
+    write the delta from old_path to new_path
+
+    return the delta info (the contents of delta.json)
+    """
+    old_blocks, old_groups = read_block_layout(old_path)
+    new_blocks, new_groups = read_block_layout(new_path)
+    old_signatures = {signature: (first_block, num_blocks) for first_block, num_blocks, signature in old_groups}
+
+    # blocks after the last group: the end-of-archive blocks
+    new_groups_end = new_groups[-1][0] + new_groups[-1][1]
+    steps = [(first_block, num_blocks, signature) for first_block, num_blocks, signature in new_groups]
+    steps.append((new_groups_end, len(new_blocks) - new_groups_end, None))
+
+    recipe = []
+    delta_blocks = []
+    for first_block, num_blocks, signature in steps:
+        if num_blocks == 0:
+            continue
+        old = old_signatures.get(signature)
+        if old is not None and old[1] == num_blocks:
+            add_recipe_step(recipe, "old", old[0], num_blocks)
+        else:
+            add_recipe_step(recipe, "delta", len(delta_blocks), num_blocks)
+            delta_blocks += new_blocks[first_block:first_block + num_blocks]
+
+    old_manifest = read_archive_manifest(old_path)
+    new_manifest = read_archive_manifest(new_path)
+    added, changed, removed = diff_manifests(old_manifest, new_manifest)
+
+    index_path = get_index_path(new_path)
+    with open(index_path, "rb") as f:
+        index_data = f.read()
+
+    info = {
+        "format": delta_format_version,
+        "old_version": old_version or old_manifest.last_date,
+        "new_version": new_version or new_manifest.last_date,
+        "old_size": os.path.getsize(old_path),
+        "old_sha256": sha256_file(old_path),
+        "new_size": os.path.getsize(new_path),
+        "new_sha256": sha256_file(new_path),
+        "new_index_sha256": hashlib.sha256(index_data).hexdigest(),
+        "recipe": recipe,
+        "added": added,
+        "changed": changed,
+        "removed": removed,
+    }
+
+    temp_dir = os.path.dirname(os.path.abspath(delta_path))
+    with tempfile.NamedTemporaryFile(dir=temp_dir, suffix=".xz") as blocks_file:
+        stream = XzStreamWriter(blocks_file)
+        with open(new_path, "rb") as f:
+            for block in delta_blocks:
+                f.seek(block.offset)
+                stream.add_block(f.read(pad4(block.unpadded_size)), block.unpadded_size, block.data_size)
+        stream.close()
+        blocks_file.flush()
+
+        temp_path = delta_path + ".tmp"
+        with tarfile.open(temp_path, "w", format=tarfile.PAX_FORMAT) as tar:
+            add_bytes(tar, "delta.json", json.dumps(info, indent=1).encode() + b"\n")
+            add_file(tar, "blocks.xz", blocks_file.name)
+            add_bytes(tar, "index.sqlite.xz", lzma.compress(index_data, preset=9))
+        os.replace(temp_path, delta_path)
+    return info
+
+def read_delta_info(tar):
+    info = json.load(tar.extractfile("delta.json"))
+    if info.get("format") != delta_format_version:
+        raise DeltaError(f"unsupported delta format {info.get('format')}")
+    return info
+
+def apply_delta(old_path, delta_path, new_path):
+    """
+    rebuild the new archive and its index from old_path and delta_path
+
+    return the delta info
+    """
+    with tarfile.open(delta_path, "r:") as tar:
+        info = read_delta_info(tar)
+        if os.path.getsize(old_path) != info["old_size"] or sha256_file(old_path) != info["old_sha256"]:
+            raise DeltaError(f"{old_path} is not the archive of version {info['old_version']}")
+        index_data = lzma.decompress(tar.extractfile("index.sqlite.xz").read())
+        if hashlib.sha256(index_data).hexdigest() != info["new_index_sha256"]:
+            raise DeltaError("bad sha256 of index in delta")
+
+        delta_blocks_file = tar.extractfile("blocks.xz")
+        delta_blocks = read_xz_blocks(delta_blocks_file)
+        temp_path = f"{new_path}.temp.{time.time()}"
+        try:
+            with open(old_path, "rb") as old_file, open(temp_path, "wb") as out:
+                old_blocks = read_xz_blocks(old_file)
+                sources = {"old": (old_file, old_blocks), "delta": (delta_blocks_file, delta_blocks)}
+                writer = HashWriter(out)
+                stream = XzStreamWriter(writer)
+                for source, first_block, num_blocks in info["recipe"]:
+                    f, blocks = sources[source]
+                    if first_block + num_blocks > len(blocks):
+                        raise DeltaError(f"bad recipe step {source} {first_block} {num_blocks}")
+                    for block in blocks[first_block:first_block + num_blocks]:
+                        f.seek(block.offset)
+                        stream.add_block(f.read(pad4(block.unpadded_size)), block.unpadded_size, block.data_size)
+                stream.close()
+            if writer.hash.hexdigest() != info["new_sha256"]:
+                raise DeltaError("bad sha256 of the rebuilt archive")
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    index_path = get_index_path(new_path)
+    with open(index_path + ".tmp", "wb") as f:
+        f.write(index_data)
+    os.replace(temp_path, new_path)
+    os.replace(index_path + ".tmp", index_path)
+    return info
+
+def print_info(info):
+    print(f"delta from {info['old_version']} to {info['new_version']}")
+    print(f"old: {info['old_size']} bytes, sha256 {info['old_sha256']}")
+    print(f"new: {info['new_size']} bytes, sha256 {info['new_sha256']}")
+    num_old = sum(n for source, first, n in info["recipe"] if source == "old")
+    num_delta = sum(n for source, first, n in info["recipe"] if source == "delta")
+    print(f"blocks: {num_old} from old archive, {num_delta} from delta")
+    print(f"torrents: {len(info['added'])} added, {len(info['changed'])} changed, {len(info['removed'])} removed")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="delta archives between two releases")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("create", help="write the delta from old to new archive")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("-o", "--output", required=True)
+    p = subparsers.add_parser("apply", help="rebuild the new archive from old archive and delta")
+    p.add_argument("old")
+    p.add_argument("delta")
+    p.add_argument("-o", "--output", required=True)
+    p = subparsers.add_parser("info", help="print the contents of a delta")
+    p.add_argument("delta")
+    p.add_argument("--list", action="store_true", help="list added, changed and removed torrents")
+    args = parser.parse_args()
+
+    if args.command in ("create", "apply") and os.path.exists(args.output):
+        print(f"error: output file exists: {args.output}")
+        sys.exit(1)
+
+    t1 = time.time()
+    try:
+        if args.command == "create":
+            info = create_delta(args.old, args.new, args.output)
+            print_info(info)
+            print(f"wrote {args.output}: {os.path.getsize(args.output)} bytes in {time.time() - t1:.1f} seconds")
+        elif args.command == "apply":
+            info = apply_delta(args.old, args.delta, args.output)
+            print_info(info)
+            print(f"ok: wrote {args.output} and {get_index_path(args.output)} in {time.time() - t1:.1f} seconds")
+        else:
+            with tarfile.open(args.delta, "r:") as tar:
+                info = read_delta_info(tar)
+            print_info(info)
+            if args.list:
+                for key in ["added", "changed", "removed"]:
+                    for path in info[key]:
+                        print(f"{key} {path}")
+    except DeltaError as e:
+        print(f"error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
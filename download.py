@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# download.py
+# concurrent download pool for update.py
+
+import os
+import sys
+import json
+import time
+import asyncio
+from pathlib import Path
+
+# pip install aiohttp
+import aiohttp
+
+default_workers = 16
+default_limit_per_host = 8
+
+def create_session(workers=default_workers, limit_per_host=default_limit_per_host):
+    # the connector bounds the number of open connections
+    # so the workers reuse a small set of keep-alive connections
+    connector = aiohttp.TCPConnector(
+        limit=workers,
+        limit_per_host=limit_per_host,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+# downloads are written to path + part_suffix
+# and renamed to path when complete
+part_suffix = ".part"
+
+# cache validators of a downloaded file are stored in path + meta_suffix
+meta_suffix = ".meta"
+
+# the read size grows from min_chunk_size to max_chunk_size
+# while the response body arrives faster than we consume it
+min_chunk_size = 64 * 1024
+max_chunk_size = 4 * 1024 * 1024
+
+def get_part_path(path):
+    path = Path(path)
+    return path.with_name(path.name + part_suffix)
+
+async def write_response(response, part_path, mode="wb"):
+    chunk_size = min_chunk_size
+    with open(part_path, mode, buffering=max_chunk_size) as f:
+        while True:
+            chunk = await response.content.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            if len(chunk) == chunk_size and chunk_size < max_chunk_size:
+                chunk_size *= 2
+
+async def download_file(session, url, path, size=None, headers=None):
+    """
+    download url to path
+
+    the body is streamed into a temporary part file,
+    which is atomically renamed to path when complete,
+    so an interrupted download never leaves a truncated path.
+    an existing part file is resumed with an HTTP Range request.
+    if size is given, the downloaded size must match.
+    """
+    path = Path(path)
+    part_path = get_part_path(path)
+
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    if size is not None and offset > size:
+        part_path.unlink()
+        offset = 0
+
+    if size is not None and offset == size:
+        # the previous run was interrupted before the rename
+        os.replace(part_path, path)
+        return
+
+    request_headers = dict(headers or {})
+    if offset > 0:
+        request_headers["Range"] = f"bytes={offset}-"
+        # byte ranges of a compressed body are useless to us
+        request_headers["Accept-Encoding"] = "identity"
+
+    async with session.get(url, headers=request_headers) as response:
+        if response.status == 206 and offset > 0:
+            content_range = response.headers.get("Content-Range", "")
+            assert content_range.startswith(f"bytes {offset}-"), f"bad Content-Range {content_range!r}"
+            mode = "ab"
+        elif response.status == 200:
+            # the server ignored our Range header
+            mode = "wb"
+        else:
+            if response.status == 416:
+                # our part file does not match the remote file
+                part_path.unlink()
+            raise AssertionError(f"bad response.status {response.status}")
+
+        await write_response(response, part_path, mode)
+
+    if size is not None:
+        actual_size = part_path.stat().st_size
+        if actual_size != size:
+            part_path.unlink()
+            raise AssertionError(f"size mismatch: expected {size}, actual {actual_size}")
+
+    os.replace(part_path, path)
+
+def get_meta_path(path):
+    path = Path(path)
+    return path.with_name(path.name + meta_suffix)
+
+def read_meta(path):
+    "read the cache validators stored next to path"
+    meta_path = get_meta_path(path)
+    if not Path(path).exists() or not meta_path.exists():
+        return {}
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def write_meta(path, meta):
+    meta_path = get_meta_path(path)
+    temp_path = meta_path.with_name(meta_path.name + part_suffix)
+    with open(temp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+        f.write("\n")
+    os.replace(temp_path, meta_path)
+
+async def refresh_file(session, url, path, compress=True):
+    """
+    conditional download of url to path
+
+    the ETag and Last-Modified response headers are stored in path + meta_suffix
+    and sent back as If-None-Match and If-Modified-Since,
+    so an unchanged file costs one small 304 response.
+    with compress=True, the server may send a gzip or deflate body.
+
+    return True if path was downloaded, False if path is up to date.
+    """
+    path = Path(path)
+    part_path = get_part_path(path)
+    meta = read_meta(path)
+
+    request_headers = {}
+    if meta.get("etag"):
+        request_headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        request_headers["If-Modified-Since"] = meta["last_modified"]
+    if not compress:
+        request_headers["Accept-Encoding"] = "identity"
+
+    async with session.get(url, headers=request_headers) as response:
+        if response.status == 304:
+            return False
+        assert response.status == 200, f"bad response.status {response.status}"
+        # a part file from an interrupted run has unknown validators,
+        # so we always download the full body
+        await write_response(response, part_path, "wb")
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+
+    os.replace(part_path, path)
+    write_meta(path, meta)
+    return True
+
+class DownloadPool:
+    """
+    a bounded pool of download workers sharing one aiohttp.ClientSession
+
+    jobs are consumed from a live queue,
+    so the caller can add jobs while the workers are running.
+
+    usage:
+
+        async with DownloadPool(workers=16) as pool:
+            for url, path, size in jobs:
+                pool.put(url, path, size)
+        print(pool.num_done, pool.failed)
+    """
+
+    def __init__(self, workers=default_workers, limit_per_host=default_limit_per_host, fetch=download_file, on_done=None, metrics=None):
+        assert workers > 0, f"invalid workers {workers}"
+        self.workers = workers
+        self.limit_per_host = limit_per_host
+        self.fetch = fetch
+        # called as on_done(url, path) after each download.
+        # a coroutine function is awaited, so it can move slow work off the event loop
+        self.on_done = on_done
+        # latencies and sizes of the downloads, see metrics.py
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.session = None
+        self.tasks = []
+        self.num_done = 0
+        self.failed = []
+
+    def put(self, url, path, size=None):
+        self.queue.put_nowait((url, Path(path), size))
+
+    def start(self):
+        self.session = create_session(self.workers, self.limit_per_host)
+        self.tasks = [
+            asyncio.create_task(self.worker())
+            for _ in range(self.workers)
+        ]
+
+    async def close(self, wait=True):
+        "wait for the queue to drain, then stop the workers"
+        try:
+            if wait:
+                await self.queue.join()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.session.close()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close(wait=(exc_type is None))
+
+    async def worker(self):
+        while True:
+            url, path, size = await self.queue.get()
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                print(f"fetching {path}")
+                t1 = time.time()
+                await self.fetch(self.session, url, path, size)
+                self.num_done += 1
+                if self.metrics:
+                    self.metrics.observe("download_seconds", time.time() - t1)
+                    self.metrics.count("downloaded_bytes", path.stat().st_size)
+                if self.on_done:
+                    result = self.on_done(url, path)
+                    if asyncio.iscoroutine(result):
+                        await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"error: failed to fetch {url}: {exc!r}", file=sys.stderr)
+                # the part file is kept for the next run
+                self.failed.append(url)
+                if self.metrics:
+                    self.metrics.count("files_failed")
+            finally:
+                self.queue.task_done()
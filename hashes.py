@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# hashes.py
+# one-pass digests of the archive, like hashes.sh
+
+"""
+One-pass digests of the archive.
+
+hashes.sh reads the archive again after pack.py, and pipes it into
+one process per digest. pack.py instead passes the compressed stream
+through a MultiHasher while it writes the archive, and writes
+
+- <archive>.hashes: size, md5, sha1, tiger, sha256, sha384 and sha512,
+  in the format of hashes.sh
+- <archive>.pieces: the piece cache for release.py, with the v1 and v2
+  piece hashes, see piecehash.py and hybridtorrent.py
+
+The digests are updated in threads, one per digest.
+hashlib has no tiger, so tiger is piped into tiger-hash, like in hashes.sh.
+Like hashes.sh, this fails when tiger-hash is not installed.
+With --no-tiger (also in pack.py), the tiger line is left out.
+
+Usage:
+    # hash existing files, like hashes.sh
+    ./hashes.py torrents.2025-07-19.tar.xz
+    # without tiger-hash
+    ./hashes.py --no-tiger torrents.2025-07-19.tar.xz
+"""
+
+hashes_suffix = ".hashes"
+
+# digests in the order of hashes.sh
+digest_names = ["md5", "sha1", "tiger", "sha256", "sha384", "sha512"]
+
+tiger_hash_args = ["tiger-hash", "-"]
+
+read_size = 1024 * 1024
+
+import os
+import re
+import sys
+import shutil
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from piecehash import PieceHasher, default_piece_size, write_piece_cache
+from hybridtorrent import MerklePieceHasher
+
+class TigerHash:
+    "tiger digest from the tiger-hash tool, with the interface of hashlib"
+
+    def __init__(self):
+        self.proc = subprocess.Popen(tiger_hash_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def update(self, data):
+        self.proc.stdin.write(data)
+
+    def hexdigest(self):
+        self.proc.stdin.close()
+        output = self.proc.stdout.read().decode()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"{tiger_hash_args[0]} failed with exit code {self.proc.returncode}")
+        return re.match(r"\s*([0-9a-f]+)", output).group(1)
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+
+class MultiHasher:
+    """
+    all digests of hashes.sh and the piece hashes of one stream
+
+    usage:
+
+        hasher = MultiHasher()
+        hasher.update(data)
+        hasher.close()
+        write_hashes(path, hasher)
+    """
+
+    def __init__(self, piece_size=default_piece_size, tiger=True):
+        """
+        tiger: False to leave out the tiger digest.
+        raise RuntimeError if tiger is True and tiger-hash is not installed
+        """
+        if tiger and not shutil.which(tiger_hash_args[0]):
+            raise RuntimeError(f"{tiger_hash_args[0]} not found. hint: install it, or pass --no-tiger")
+        self.size = 0
+        self.digests = {}
+        for name in digest_names:
+            if name != "tiger":
+                self.digests[name] = hashlib.new(name)
+            elif tiger:
+                self.digests[name] = TigerHash()
+        self.pieces = PieceHasher(piece_size)
+        self.pieces_v2 = MerklePieceHasher(piece_size)
+        self.executor = ThreadPoolExecutor(len(self.digests) + 2)
+
+    def update(self, data):
+        # hashlib releases the GIL, so the digests run in parallel
+        updates = [h.update for h in self.digests.values()] + [self.pieces.update, self.pieces_v2.update]
+        for future in [self.executor.submit(update, data) for update in updates]:
+            future.result()
+        self.size += len(data)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def kill(self):
+        self.executor.shutdown()
+        for h in self.digests.values():
+            if isinstance(h, TigerHash):
+                h.kill()
+
+    def hexdigests(self):
+        return {name: h.hexdigest() for name, h in self.digests.items()}
+
+class HashingWriter:
+    "file object wrapper, which hashes what is written"
+
+    def __init__(self, f, hasher):
+        self.f = f
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.f.write(data)
+
+def copy_hashed(src, dst, hasher):
+    "copy the file object src to dst, and hash the data"
+    while chunk := src.read(read_size):
+        hasher.update(chunk)
+        dst.write(chunk)
+
+def start_copy_thread(src, dst, hasher):
+    """
+    copy src to dst in a thread, like copy_hashed
+
+    return the thread. after join, thread.error is the exception or None
+    """
+    def run():
+        try:
+            copy_hashed(src, dst, hasher)
+        except BaseException as e:
+            thread.error = e
+            # unblock the writer of src
+            src.close()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.error = None
+    thread.start()
+    return thread
+
+def get_hashes_path(path):
+    return path + hashes_suffix
+
+def write_hashes(path, hasher):
+    """
+    write the .hashes file and the piece cache of the file path
+
+    hasher: closed MultiHasher of the contents of path
+    return the path of the .hashes file
+    """
+    if hasher.size != os.path.getsize(path):
+        raise RuntimeError(f"hashed {hasher.size} bytes, but {path} has {os.path.getsize(path)} bytes")
+    hashes_path = get_hashes_path(path)
+    with open(hashes_path + ".tmp", "w") as f:
+        f.write(f"size:{hasher.size}\n")
+        for name, digest in hasher.hexdigests().items():
+            f.write(f"{name}:{digest}\n")
+    os.replace(hashes_path + ".tmp", hashes_path)
+    write_piece_cache(path, hasher.pieces, hasher.pieces_v2)
+    return hashes_path
+
+def hash_file(path, piece_size=default_piece_size, tiger=True):
+    "return the closed MultiHasher of a file"
+    hasher = MultiHasher(piece_size, tiger)
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(read_size):
+                hasher.update(chunk)
+    except BaseException:
+        hasher.kill()
+        raise
+    hasher.close()
+    return hasher
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=f"write the {hashes_suffix} file and the piece cache of files")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--piece-size", type=int, default=default_piece_size,
+        help=f"piece size of the piece cache (default: {default_piece_size})")
+    parser.add_argument("--tiger", action=argparse.BooleanOptionalAction, default=True,
+        help=f"write the tiger digest with {tiger_hash_args[0]}, like hashes.sh (default: yes)")
+    args = parser.parse_args()
+    if args.tiger and not shutil.which(tiger_hash_args[0]):
+        print(f"error: {tiger_hash_args[0]} not found. hint: install it, or pass --no-tiger")
+        sys.exit(1)
+    status = 0
+    for path in args.paths:
+        if not os.path.exists(path):
+            print(f"error: missing input file: {path}")
+            status = 1
+            continue
+        if os.path.exists(get_hashes_path(path)):
+            print(f"error: output file exists: {get_hashes_path(path)}")
+            status = 1
+            continue
+        print(f"writing {write_hashes(path, hash_file(path, args.piece_size, args.tiger))}")
+    sys.exit(status)
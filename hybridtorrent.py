@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# hybridtorrent.py
+# BitTorrent v1 + v2 hybrid torrents (BEP 52) for release.py
+
+"""
+Hybrid v1 + v2 torrents.
+
+In a v1 torrent, pieces span file boundaries, so a file is verified
+only together with its neighbors, and a file that did not change
+between two releases has different pieces in each release.
+
+In a v2 torrent (BEP 52), every file has its own merkle tree of
+sha256 hashes over blocks of 16 KiB, so every file can be verified alone,
+and a file has the same "pieces root" in every torrent.
+The hybrid torrent has the v2 file tree and the v1 file list,
+with padding files (BEP 47) after every file, so every file starts at
+a piece boundary, and v1 and v2 clients share one swarm.
+Like libtorrent, the last file is padded too, empty files are kept,
+and executable files have the attribute "x" (BEP 47), so the scripts
+of the release stay executable.
+
+Files are sorted by path, like the file tree, and hidden files
+are skipped, like in torf. As every file is piece aligned, the v1 and v2
+pieces of the archive can be taken from the piece cache of pack.py
+(see piecehash.py), so only the last piece of the archive is read.
+
+Usage:
+    ./hybridtorrent.py release/annas-torrents-2025-07-19 -o annas-torrents-2025-07-19.torrent
+    # compare our infohashes with the infohashes of libtorrent
+    ./hybridtorrent.py release/annas-torrents-2025-07-19 --compare-libtorrent
+"""
+
+import os
+import sys
+import mmap
+import hashlib
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import bencode
+from piecehash import Progress, default_workers, piece_hash_size, task_size
+
+# v2 leaf block size
+block_size = 16 * 1024
+
+v2_hash_size = 32
+
+zero_hash = b"\0" * v2_hash_size
+
+def next_pow2(n):
+    return 1 << max(0, n - 1).bit_length()
+
+def merkle_root(hashes, width, pad=zero_hash):
+    "return the root of a merkle tree of hashes, padded with pad to width leaves"
+    layer = list(hashes) + [pad] * (width - len(hashes))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0]
+
+def get_piece_size(total_size):
+    "about 1000 pieces, between 16 KiB and 16 MiB"
+    return min(16 * 1024 * 1024, max(block_size, next_pow2(total_size // 1024)))
+
+def hash_piece_v2(data, piece_size, file_size):
+    "return the v2 hash of one piece of a file: the merkle root of its 16 KiB blocks"
+    leaves = [hashlib.sha256(data[i:i + block_size]).digest() for i in range(0, len(data), block_size)]
+    # a file of one piece is not padded to a full piece
+    width = next_pow2(len(leaves)) if file_size <= piece_size else piece_size // block_size
+    return merkle_root(leaves, width)
+
+class MerklePieceHasher:
+    "hash the v2 pieces of a stream, for the piece cache"
+
+    def __init__(self, piece_size):
+        self.piece_size = piece_size
+        self.buf = bytearray()
+        self.pieces = bytearray()
+
+    def update(self, data):
+        self.buf += data
+        n = len(self.buf) // self.piece_size * self.piece_size
+        if n:
+            with memoryview(self.buf) as view:
+                for i in range(0, n, self.piece_size):
+                    with view[i:i + self.piece_size] as piece:
+                        # as in a file of more than one piece
+                        self.pieces += hash_piece_v2(piece, self.piece_size, self.piece_size + 1)
+            del self.buf[:n]
+
+    def full_pieces(self):
+        "return the hashes of the full pieces"
+        return bytes(self.pieces)
+
+def hash_file_range(path, file_size, piece_size, first_piece, num_pieces):
+    """
+    return the (v1, v2) hashes of num_pieces pieces of one file from first_piece
+
+    the last v1 piece is padded with zeros, like by the padding file
+    """
+    v1 = bytearray()
+    v2 = bytearray()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) != file_size:
+            raise RuntimeError(f"file changed as we read it: {path}")
+        if hasattr(mm, "madvise"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        try:
+            for piece in range(first_piece, first_piece + num_pieces):
+                data = view[piece * piece_size:(piece + 1) * piece_size]
+                h = hashlib.sha1(data)
+                if len(data) < piece_size:
+                    h.update(bytes(piece_size - len(data)))
+                v1 += h.digest()
+                v2 += hash_piece_v2(data, piece_size, file_size)
+                data.release()
+        finally:
+            view.release()
+    return bytes(v1), bytes(v2)
+
+def list_files(content_path):
+    "return the sorted (path components, file path) list of the non-hidden files"
+    files = []
+    for dir_path, dir_names, file_names in os.walk(content_path):
+        dir_names[:] = [d for d in dir_names if not d.startswith(".")]
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            if name.startswith(".") or not os.path.isfile(path):
+                continue
+            files.append((os.path.relpath(path, content_path).split(os.sep), path))
+    # sorted like the keys of the file tree
+    files.sort(key=lambda f: [p.encode() for p in f[0]])
+    return files
+
+def hash_files(files, piece_size, workers=default_workers, progress=True, cache=None):
+    """
+    return the (v1 pieces, v2 piece hashes) of every file
+
+    cache: {file path: (piece_size, v1 pieces, v2 pieces)} from read_piece_cache
+    """
+    results = []
+    tasks = []
+    pieces_per_task = max(1, task_size // piece_size)
+    for i, (parts, path) in enumerate(files):
+        size = os.path.getsize(path)
+        num_pieces = -(-size // piece_size)
+        v1 = v2 = b""
+        cached = (cache or {}).get(path)
+        if cached and cached[0] == piece_size and cached[2] is not None:
+            v1, v2 = cached[1], cached[2]
+        results.append(([v1], [v2]))
+        for first_piece in range(len(v1) // piece_hash_size, num_pieces, pieces_per_task):
+            n = min(pieces_per_task, num_pieces - first_piece)
+            hash_size = min(size, (first_piece + n) * piece_size) - first_piece * piece_size
+            tasks.append((i, hash_size, (path, size, piece_size, first_piece, n)))
+
+    reporter = Progress(sum(task[1] for task in tasks)) if progress else None
+    # hash in a bounded window of tasks, so the workers read close together
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        def collect():
+            i, hash_size, future = pending.popleft()
+            v1, v2 = future.result()
+            results[i][0].append(v1)
+            results[i][1].append(v2)
+            reporter and reporter.update(hash_size)
+        for i, hash_size, args in tasks:
+            pending.append((i, hash_size, executor.submit(hash_file_range, *args)))
+            while len(pending) >= 2 * workers:
+                collect()
+        while pending:
+            collect()
+    if reporter:
+        reporter.close()
+    return [(b"".join(v1), b"".join(v2)) for v1, v2 in results]
+
+def create_torrent(content_path, trackers=(), piece_size=None, workers=default_workers, progress=True, cache=None):
+    """
+    return the metainfo dict of a hybrid torrent of the directory content_path
+
+    the info dict has the v1 keys (files, pieces) and the v2 keys
+    (meta version, file tree), the piece layers are in the top-level dict.
+    """
+    files = list_files(content_path)
+    if not files:
+        raise RuntimeError(f"no files in {content_path}")
+    sizes = [os.path.getsize(path) for parts, path in files]
+    piece_size = piece_size or get_piece_size(sum(sizes))
+    results = hash_files(files, piece_size, workers, progress, cache)
+
+    pad_root = merkle_root([], piece_size // block_size)
+    file_list = []
+    file_tree = {}
+    piece_layers = {}
+    pieces = bytearray()
+    for (parts, path), size, (v1, v2) in zip(files, sizes, results):
+        node = file_tree
+        for part in parts:
+            node = node.setdefault(part, {})
+        attrs = {"attr": "x"} if os.stat(path).st_mode & 0o111 else {}
+        file_list.append({**attrs, "length": size, "path": parts})
+        if size == 0:
+            node[""] = {**attrs, "length": 0}
+            continue
+        if len(v2) == v2_hash_size:
+            pieces_root = v2
+        else:
+            pieces_root = merkle_root([v2[i:i + v2_hash_size] for i in range(0, len(v2), v2_hash_size)],
+                next_pow2(len(v2) // v2_hash_size), pad_root)
+            piece_layers[pieces_root] = v2
+        node[""] = {**attrs, "length": size, "pieces root": pieces_root}
+        pieces += v1
+        # padding file, so the next file starts at a piece boundary
+        pad_size = -size % piece_size
+        if pad_size:
+            file_list.append({"attr": "p", "length": pad_size, "path": [".pad", str(pad_size)]})
+
+    info = {
+        "name": os.path.basename(os.path.normpath(content_path)),
+        "piece length": piece_size,
+        "meta version": 2,
+        "file tree": file_tree,
+        "files": file_list,
+        "pieces": bytes(pieces),
+    }
+    metainfo = {"info": info, "piece layers": piece_layers}
+    if trackers:
+        metainfo["announce"] = trackers[0]
+        metainfo["announce-list"] = [[tracker] for tracker in trackers]
+    return metainfo
+
+def get_infohashes(metainfo):
+    "return the (v1, v2) infohashes as hex strings"
+    info = bencode.encode(metainfo["info"])
+    return hashlib.sha1(info).hexdigest(), hashlib.sha256(info).hexdigest()
+
+def get_magnet(metainfo):
+    v1, v2 = get_infohashes(metainfo)
+    params = [("xt", f"urn:btih:{v1}"), ("xt", f"urn:btmh:1220{v2}"), ("dn", metainfo["info"]["name"])]
+    params += [("tr", tracker) for tracker in metainfo.get("announce-list", [[]]) for tracker in tracker]
+    return "magnet:?" + urllib.parse.urlencode(params, safe=":")
+
+def write_torrent(metainfo, path):
+    with open(path + ".tmp", "wb") as f:
+        f.write(bencode.encode(metainfo))
+    os.replace(path + ".tmp", path)
+
+def compare_libtorrent(content_path, piece_size=None):
+    """
+    create the hybrid torrent of content_path with libtorrent and with create_torrent
+
+    return True if the infohashes are equal
+    """
+    # pip install libtorrent
+    import libtorrent as lt
+    metainfo = create_torrent(content_path, piece_size=piece_size, progress=False)
+    fs = lt.file_storage()
+    lt.add_files(fs, content_path, lambda path: not os.path.basename(path).startswith("."))
+    ct = lt.create_torrent(fs, metainfo["info"]["piece length"])
+    lt.set_piece_hashes(ct, os.path.dirname(os.path.abspath(content_path)))
+    ref = lt.torrent_info(lt.bencode(ct.generate()))
+    ours = get_infohashes(metainfo)
+    ref_hashes = (str(ref.info_hashes().v1), str(ref.info_hashes().v2))
+    print(f"libtorrent: {ref_hashes[0]} {ref_hashes[1]}")
+    print(f"ours:       {ours[0]} {ours[1]}")
+    if ref_hashes != ours:
+        print("error: infohashes differ")
+        return False
+    print("ok: infohashes are equal")
+    return True
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="create a hybrid v1 + v2 torrent of a directory")
+    parser.add_argument("path", help="content directory")
+    parser.add_argument("-o", "--output", help="torrent file")
+    parser.add_argument("--piece-size", type=int, help="piece size (default: about 1000 pieces)")
+    parser.add_argument("--workers", type=int, default=default_workers,
+        help=f"number of hashing threads (default: {default_workers})")
+    parser.add_argument("--compare-libtorrent", action="store_true",
+        help="compare our infohashes with the infohashes of libtorrent, exit 1 if they differ")
+    args = parser.parse_args()
+    if args.compare_libtorrent:
+        sys.exit(0 if compare_libtorrent(args.path, args.piece_size) else 1)
+    metainfo = create_torrent(args.path, piece_size=args.piece_size, workers=args.workers)
+    v1, v2 = get_infohashes(metainfo)
+    print(f"btih {v1}")
+    print(f"btmh {v2}")
+    if args.output:
+        if os.path.exists(args.output):
+            print(f"error: output file exists: {args.output}")
+            sys.exit(1)
+        write_torrent(metainfo, args.output)
+        print(f"writing {args.output}")
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# manifest.py
+# parse and filter torrents.json for update.py and pack.py
+
+base_url = "https://annas-archive.org"
+torrents_json_url = f"{base_url}/dyn/torrents.json"
+cache_file = "torrents.json"
+url_prefix = f"{base_url}/dyn/small_file/"
+
+# the parsed manifest is cached in cache_file + parsed_cache_suffix
+parsed_cache_suffix = ".cache"
+# bump this when the parsed format changes
+parsed_cache_version = 2
+
+# ignore annas-torrents torrents
+# example:
+# torrents/managed_by_aa/annas-torrents-2025-07-14.torrent/annas-torrents-2025-07-14.torrent
+ignored_path_prefix = "torrents/managed_by_aa/annas-torrents-"
+
+import os
+import sys
+import json
+import pickle
+import hashlib
+
+read_size = 1024 * 1024
+
+def format_date(date_int):
+    date_str = str(date_int)
+    assert len(date_str) == 8, f"invalid date_str {date_str}"
+    return "-".join([
+        date_str[0:4], # year
+        date_str[4:6], # month
+        date_str[6:8], # day
+    ])
+
+def parse_date(date_str):
+    assert len(date_str) == 10, f"invalid date_str {date_str}" # "2024-03-07"
+    return int(date_str.replace("-", "")) # 20240307
+
+class ManifestEntry:
+    "one torrent from torrents.json"
+
+    __slots__ = ("url", "path", "size", "date_int", "btih")
+
+    def __init__(self, url, path, size, date_int, btih=None):
+        self.url = url
+        # path relative to the mirror root, like "torrents/..."
+        self.path = path
+        self.size = size
+        self.date_int = date_int
+        # hex infohash, if torrents.json has it
+        self.btih = btih
+
+    def __repr__(self):
+        return f"ManifestEntry({self.path!r}, size={self.size}, date_int={self.date_int})"
+
+    def to_tuple(self):
+        return (self.url, self.path, self.size, self.date_int, self.btih)
+
+class Manifest:
+    """
+    the filtered contents of torrents.json
+
+    entries: torrents to mirror
+    removed: obsolete or embargoed torrents
+    ignored_urls: urls outside of url_prefix
+    last_date_int: latest added_to_torrents_list_at of entries, like 20250714
+    """
+
+    __slots__ = ("entries", "removed", "ignored_urls", "last_date_int")
+
+    def __init__(self, entries=None, removed=None, ignored_urls=None, last_date_int=0):
+        self.entries = entries or []
+        self.removed = removed or []
+        self.ignored_urls = ignored_urls or []
+        self.last_date_int = last_date_int
+
+    @property
+    def last_date(self):
+        return format_date(self.last_date_int)
+
+    def add(self, torrent, url_prefix=url_prefix):
+        url = torrent['url']
+
+        if not url.startswith(url_prefix):
+            self.ignored_urls.append(url)
+            return
+
+        path = url[len(url_prefix):]
+
+        if torrent['obsolete'] or torrent['embargo']:
+            self.removed.append(ManifestEntry(url, path, torrent['torrent_size'], 0, torrent.get('btih')))
+            return
+
+        if path.startswith(ignored_path_prefix):
+            return
+
+        date_int = parse_date(torrent['added_to_torrents_list_at'])
+        if date_int > self.last_date_int:
+            self.last_date_int = date_int
+
+        self.entries.append(ManifestEntry(url, path, torrent['torrent_size'], date_int, torrent.get('btih')))
+
+    def dump(self):
+        return (
+            [e.to_tuple() for e in self.entries],
+            [e.to_tuple() for e in self.removed],
+            self.ignored_urls,
+            self.last_date_int,
+        )
+
+    @classmethod
+    def load(cls, data):
+        entries, removed, ignored_urls, last_date_int = data
+        return cls(
+            [ManifestEntry(*t) for t in entries],
+            [ManifestEntry(*t) for t in removed],
+            ignored_urls,
+            last_date_int,
+        )
+
+def iter_json_array(f, read_size=read_size):
+    """
+    yield the items of a top-level JSON array from a text file
+
+    only one item is decoded at a time,
+    so memory use does not grow with the size of the file.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(read_size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    while True:
+        # skip whitespace and separators
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            fill()
+        if pos >= len(buf):
+            raise ValueError("unexpected end of JSON array")
+        c = buf[pos]
+        if not started:
+            if c != "[":
+                raise ValueError(f"expected JSON array, got {c!r}")
+            started = True
+            pos += 1
+            continue
+        if c == "]":
+            return
+        if c == ",":
+            pos += 1
+            continue
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            # a number at the end of the buffer may be incomplete
+            if end == len(buf) and not eof:
+                fill()
+                continue
+            break
+        pos = end
+        yield item
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(read_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def parse_manifest(path=cache_file, url_prefix=url_prefix):
+    manifest = Manifest()
+    with open(path, encoding="utf8") as f:
+        for torrent in iter_json_array(f):
+            manifest.add(torrent, url_prefix)
+    return manifest
+
+def load_manifest(path=cache_file, url_prefix=url_prefix, use_cache=True):
+    """
+    parse and filter torrents.json
+
+    the result is cached in path + parsed_cache_suffix,
+    keyed on the sha1 of path and url_prefix.
+    """
+    if not use_cache:
+        return parse_manifest(path, url_prefix)
+
+    parsed_cache_path = path + parsed_cache_suffix
+    cache_key = (parsed_cache_version, hash_file(path), url_prefix)
+
+    if os.path.exists(parsed_cache_path):
+        try:
+            with open(parsed_cache_path, "rb") as f:
+                key, data = pickle.load(f)
+            if key == cache_key:
+                return Manifest.load(data)
+        except Exception as exc:
+            print(f"ignoring bad cache {parsed_cache_path}: {exc!r}", file=sys.stderr)
+
+    manifest = parse_manifest(path, url_prefix)
+
+    temp_path = parsed_cache_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        pickle.dump((cache_key, manifest.dump()), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, parsed_cache_path)
+
+    return manifest
+
+if __name__ == "__main__":
+    import time
+    t1 = time.time()
+    manifest = load_manifest(sys.argv[1] if len(sys.argv) > 1 else cache_file)
+    t2 = time.time()
+    print(f"entries {len(manifest.entries)}")
+    print(f"removed {len(manifest.removed)}")
+    print(f"ignored {len(manifest.ignored_urls)}")
+    print(f"last_date {manifest.last_date}")
+    print(f"done in {t2 - t1:.3f} seconds")
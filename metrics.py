@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# metrics.py
+# per-stage metrics of update.py, pack.py and release.py
+
+"""
+Per-stage metrics of the pipeline in main.sh.
+
+Every stage records spans (named durations with a byte count),
+counters and histograms in a Metrics object. When the stage exits,
+also by sys.exit or an exception, the run is written as
+
+- <metrics dir>/<stage>.json: the report of the last run
+- <metrics dir>/runs.jsonl: one line per run, to graph regressions
+- <textfile dir>/annas_torrents_<stage>.prom: the last run in the
+  Prometheus text format, for the textfile collector of node_exporter
+
+Counters are exported as gauges, because every file holds a single run.
+The exit code is exported, so alerts can fire on failed or slow runs.
+Note that update.py exits 1 when there is nothing new to release.
+
+Usage:
+    ./update.py --metrics-dir metrics --textfile-dir /var/lib/node_exporter/textfile_collector
+    # print the last report of every stage
+    ./metrics.py
+"""
+
+metrics_dir = "metrics"
+runs_filename = "runs.jsonl"
+metric_prefix = "annas_torrents"
+
+# upper bounds of the latency histograms, in seconds
+default_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+import os
+import sys
+import json
+import time
+import resource
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.seconds = None
+        # set by the caller, for the throughput
+        self.bytes = None
+
+    def to_dict(self):
+        result = {"name": self.name, "start": self.start, "seconds": self.seconds}
+        if self.bytes is not None:
+            result["bytes"] = self.bytes
+            result["bytes_per_second"] = self.bytes / self.seconds if self.seconds else None
+        return result
+
+class SpanContext:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.span = Span(name)
+
+    def __enter__(self):
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.seconds = time.time() - self.span.start
+        self.metrics.spans.append(self.span)
+
+class Histogram:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {"buckets": self.buckets, "counts": self.counts, "count": self.count, "sum": self.sum}
+
+def get_peak_rss():
+    "return the peak RSS in bytes of this process and of its waited child processes"
+    # ru_maxrss is in KiB on linux
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+
+class Metrics:
+    """
+    spans, counters and histograms of one run of a stage
+
+    usage:
+
+        with Metrics("pack") as metrics:
+            with metrics.span("compress") as span:
+                ...
+                span.bytes = size
+            metrics.count("files", 10)
+            metrics.observe("request_seconds", 0.2)
+    """
+
+    def __init__(self, stage, metrics_dir=metrics_dir, textfile_dir=None):
+        self.stage = stage
+        self.metrics_dir = metrics_dir
+        # node_exporter reads all *.prom files of its textfile directory
+        self.textfile_dir = textfile_dir or metrics_dir
+        self.start = time.time()
+        self.spans = []
+        self.counters = {}
+        self.histograms = {}
+
+    def span(self, name):
+        return SpanContext(self, name)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=default_buckets):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(buckets)
+        self.histograms[name].observe(value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            exit_code = 0
+        elif issubclass(exc_type, SystemExit):
+            exit_code = exc.code if isinstance(exc.code, int) else (0 if exc.code is None else 1)
+        else:
+            exit_code = 1
+        try:
+            self.write(exit_code)
+        except OSError as e:
+            # metrics must not break the pipeline
+            print(f"warning: not writing metrics: {e}", file=sys.stderr)
+
+    def get_report(self, exit_code):
+        return {
+            "stage": self.stage,
+            "start": self.start,
+            "seconds": time.time() - self.start,
+            "exit_code": exit_code,
+            "peak_rss": get_peak_rss(),
+            "spans": [span.to_dict() for span in self.spans],
+            "counters": self.counters,
+            "histograms": {name: h.to_dict() for name, h in self.histograms.items()},
+        }
+
+    def write(self, exit_code=0):
+        report = self.get_report(exit_code)
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        write_file(os.path.join(self.metrics_dir, f"{self.stage}.json"), json.dumps(report, indent=1) + "\n")
+        with open(os.path.join(self.metrics_dir, runs_filename), "a") as f:
+            f.write(json.dumps(report) + "\n")
+        os.makedirs(self.textfile_dir, exist_ok=True)
+        write_file(os.path.join(self.textfile_dir, f"{metric_prefix}_{self.stage}.prom"), format_textfile(report))
+
+def write_file(path, text):
+    # node_exporter must never read a partial file
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+def format_labels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+def format_textfile(report):
+    "return the report in the Prometheus text format"
+    lines = []
+    def add(name, metric_type, help, samples):
+        name = f"{metric_prefix}_{name}"
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{format_labels({'stage': report['stage'], **labels})} {value}")
+    add("run_timestamp_seconds", "gauge", "start time of the last run", [("", {}, report["start"])])
+    add("run_duration_seconds", "gauge", "duration of the last run", [("", {}, report["seconds"])])
+    add("run_exit_code", "gauge", "exit code of the last run", [("", {}, report["exit_code"])])
+    add("peak_rss_bytes", "gauge", "peak resident set size of the last run",
+        [("", {"process": process}, value) for process, value in report["peak_rss"].items()])
+    spans = report["spans"]
+    if spans:
+        add("span_duration_seconds", "gauge", "duration of a span of the last run",
+            [("", {"span": span["name"]}, span["seconds"]) for span in spans])
+    spans = [span for span in spans if "bytes" in span]
+    if spans:
+        add("span_bytes", "gauge", "bytes processed in a span of the last run",
+            [("", {"span": span["name"]}, span["bytes"]) for span in spans])
+        add("span_bytes_per_second", "gauge", "throughput of a span of the last run",
+            [("", {"span": span["name"]}, span["bytes_per_second"] or 0) for span in spans])
+    for name, value in sorted(report["counters"].items()):
+        add(name, "gauge", f"{name} of the last run", [("", {}, value)])
+    for name, h in sorted(report["histograms"].items()):
+        samples = []
+        total = 0
+        for bound, count in zip(h["buckets"], h["counts"]):
+            total += count
+            samples.append(("_bucket", {"le": bound}, total))
+        samples.append(("_bucket", {"le": "+Inf"}, h["count"]))
+        samples.append(("_sum", {}, h["sum"]))
+        samples.append(("_count", {}, h["count"]))
+        add(name, "histogram", f"{name} of the last run", samples)
+    return "\n".join(lines) + "\n"
+
+def add_metrics_args(parser):
+    parser.add_argument("--metrics-dir", default=metrics_dir,
+        help=f"directory of the JSON run reports (default: {metrics_dir})")
+    parser.add_argument("--textfile-dir",
+        help="directory of the Prometheus textfiles, for the textfile collector of node_exporter (default: --metrics-dir)")
+
+def print_report(report):
+    print(f"{report['stage']}: exit code {report['exit_code']} after {report['seconds']:.1f} seconds, "
+        f"peak rss {report['peak_rss']['self'] // 2**20} MiB, children {report['peak_rss']['children'] // 2**20} MiB")
+    for span in report["spans"]:
+        throughput = f", {span['bytes_per_second'] / 2**20:.1f} MiB/s" if span.get("bytes_per_second") else ""
+        print(f"  {span['name']}: {span['seconds']:.1f} seconds{throughput}")
+    for name, value in sorted(report["counters"].items()):
+        print(f"  {name}: {value}")
+    for name, h in sorted(report["histograms"].items()):
+        mean = h["sum"] / h["count"] if h["count"] else 0
+        print(f"  {name}: {h['count']} samples, mean {mean:.3f}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="print the last run report of every stage")
+    parser.add_argument("--metrics-dir", default=metrics_dir,
+        help=f"directory of the JSON run reports (default: {metrics_dir})")
+    args = parser.parse_args()
+    found = False
+    for stage in ["update", "pack", "release", "verify"]:
+        path = os.path.join(args.metrics_dir, f"{stage}.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                print_report(json.load(f))
+            found = True
+    if not found:
+        print(f"error: no run reports in {args.metrics_dir}")
+        sys.exit(1)
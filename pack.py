@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 
-base_url = "https://annas-archive.org"
-torrents_json_url = f"{base_url}/dyn/torrents.json"
-cache_file = "torrents.json"
-url_prefix = f"{base_url}/dyn/small_file/"
-url_prefix_len = len(url_prefix)
-
-cache_file = "torrents.json"
 torrents_archive_path_template = "torrents.{version}.tar.xz"
 
+# archive contents
+archive_paths = [
+    "torrents",
+    "torrents.json",
+]
+
+# previous archives, for incremental packing
+previous_archive_globs = [
+    "torrents.????-??-??.tar.xz",
+    "release/annas-torrents-????-??-??/torrents.tar.xz",
+]
+
+compress_args = [
+    "pixz",
+    "-1", # level 1: lowest compression
+]
+
 r"""
 xz gives the best compression
 
+the table below was measured by hand.
+to choose the codec, level, threads and block size of compress_args,
+run scripts/benchmark-compression.py, which also measures time, memory
+and random access latency, and writes a JSON report
+
 ```py
 import subprocess; lines = subprocess.check_output("du -sh --block-size=1 --apparent torrents* | sort -n", shell=True, text=True)
 for line in lines.strip().split("\n"): line = line.strip(); size, name = line.split(); print(f"{int(size) / 2189462129 * 100:7.3f}  {size:10s}  {name}")
@@ -30,17 +45,27 @@ for line in lines.strip().split("\n"): line = line.strip(); size, name = line.sp
 
 import os
 import re
+import glob
 import time
-import json
 import shlex
 import shutil
 import asyncio
+import argparse
 import subprocess
 from pathlib import Path
 
 # pip install packaging
 import packaging.version
 
+from manifest import cache_file, load_manifest
+from tarwriter import write_tar
+from tarindex import get_index_path, write_index
+from hashes import MultiHasher, HashingWriter, start_copy_thread, get_hashes_path, write_hashes, hash_file, tiger_hash_args
+from piecehash import get_piece_cache_path
+from metrics import Metrics, add_metrics_args
+from profiling import Profiler, add_profile_args
+import blockpack
+
 def get_tar_version():
     try:
         # Run 'tar --version' with LANG=C to ensure consistent output
@@ -72,40 +97,211 @@ def check_min_version(current_version, min_version="1.28"):
     except Exception as e:
         raise ValueError(f"Version comparison failed: {str(e)}") from e
 
-def format_date(date_int):
-    date_str = str(date_int)
-    assert len(date_str) == 8, f"invalid date_str {date_str}"
-    return "-".join([
-        date_str[0:4], # year
-        date_str[4:6], # month
-        date_str[6:8], # day
-    ])
-
-def parse_date(date_str):
-    assert len(date_str) == 10, f"invalid date_str {date_str}" # "2024-03-07"
-    return int(date_str.replace("-", "")) # 20240307
+def get_tar_args(tar_path):
+    # create a reproducible tar archive
+    # https://reproducible-builds.org/docs/archives/#full-example
+    # https://stackoverflow.com/questions/32997526/how-to-create-a-tar-file-that-omits-timestamps-for-its-contents
+    # https://unix.stackexchange.com/questions/438329/tar-produces-different-files-each-time
+    return [
+        "tar",
+        "--sort=name",
+        "--mtime=UTC 1970-01-01",
+        "--owner=0",
+        "--group=0",
+        "--numeric-owner",
+        "--pax-option=exthdr.name=%d/PaxHeaders/%f,delete=atime,delete=ctime",
+        # partial downloads from update.py
+        "--exclude=*.part",
+        "-c",
+        "-f", tar_path,
+        # archive contents
+        *archive_paths,
+    ]
 
-async def main():
+def run_pipeline(tar_args, compress_args, output_path, hasher=None):
+    """
+    run: tar_args | compress_args > output_path
+
+    the pipe gives us backpressure: tar blocks while the compressor is busy.
+    the output is written to a temporary file,
+    which is renamed to output_path only when both processes succeed.
+    the output is passed through hasher, if given.
+    raise RuntimeError if one of the processes fails.
+    """
+    temp_output_path = f"{output_path}.temp.{time.time()}"
+    print(">", shlex.join(tar_args), "|", shlex.join(compress_args), ">", shlex.quote(temp_output_path))
+    with open(temp_output_path, "wb") as output:
+        tar = subprocess.Popen(tar_args, stdout=subprocess.PIPE)
+        try:
+            compressor = subprocess.Popen(compress_args, stdin=tar.stdout, stdout=(subprocess.PIPE if hasher else output))
+        except BaseException:
+            tar.kill()
+            tar.wait()
+            os.unlink(temp_output_path)
+            raise
+        copy_thread = start_copy_thread(compressor.stdout, output, hasher) if hasher else None
+        # only the compressor holds the read end now,
+        # so tar gets SIGPIPE if the compressor dies
+        tar.stdout.close()
+        compressor_returncode = compressor.wait()
+        if compressor_returncode != 0:
+            tar.kill()
+        tar_returncode = tar.wait()
+        if copy_thread:
+            copy_thread.join()
+    errors = []
+    if tar_returncode != 0:
+        errors.append(f"{tar_args[0]} failed with exit code {tar_returncode}")
+    if copy_thread and copy_thread.error:
+        errors.append(f"writing the output failed: {copy_thread.error}")
+    elif compressor_returncode != 0:
+        errors.append(f"{compress_args[0]} failed with exit code {compressor_returncode}")
+    if errors:
+        os.unlink(temp_output_path)
+        raise RuntimeError(", ".join(errors))
+    os.replace(temp_output_path, output_path)
+
+def run_writer(paths, compress_args, output_path, hasher=None):
+    """
+    run: tarwriter.py paths | compress_args > output_path
+
+    like run_pipeline, but the tar stream is written by TarWriter in this process.
+    return the members of the tar archive.
+    """
+    temp_output_path = f"{output_path}.temp.{time.time()}"
+    print(">", "tarwriter", shlex.join(paths), "|", shlex.join(compress_args), ">", shlex.quote(temp_output_path))
+    writer_error = None
+    members = None
+    with open(temp_output_path, "wb") as output:
+        compressor = subprocess.Popen(compress_args, stdin=subprocess.PIPE,
+            stdout=(subprocess.PIPE if hasher else output), bufsize=1024 * 1024)
+        copy_thread = start_copy_thread(compressor.stdout, output, hasher) if hasher else None
+        try:
+            members = write_tar(compressor.stdin, paths)
+            compressor.stdin.close()
+        except BrokenPipeError:
+            # the compressor died, its exit code tells why
+            pass
+        except Exception as e:
+            writer_error = e
+            compressor.kill()
+        except BaseException:
+            compressor.kill()
+            compressor.wait()
+            os.unlink(temp_output_path)
+            raise
+        compressor_returncode = compressor.wait()
+        if copy_thread:
+            copy_thread.join()
+    errors = []
+    if writer_error is not None:
+        errors.append(f"tarwriter failed: {writer_error}")
+    if copy_thread and copy_thread.error:
+        errors.append(f"writing the output failed: {copy_thread.error}")
+    elif compressor_returncode != 0 and writer_error is None:
+        errors.append(f"{compress_args[0]} failed with exit code {compressor_returncode}")
+    if members is None and not errors:
+        errors.append(f"{compress_args[0]} closed its input")
+    if errors:
+        os.unlink(temp_output_path)
+        raise RuntimeError(", ".join(errors))
+    os.replace(temp_output_path, output_path)
+    return members
+
+def print_hard_links(members):
+    # duplicates from dedup.py are stored once
+    num_links = sum(1 for m in members if m.typeflag == "1")
+    if num_links:
+        print(f"wrote {num_links} files as hard links")
+
+def count_members(metrics, members, span):
+    "count the files and bytes of the tar archive, span is the span which wrote it"
+    span.bytes = sum(m.size for m in members)
+    metrics.count("files_packed", sum(1 for m in members if m.typeflag in ("0", "1")))
+    metrics.count("hard_links", sum(1 for m in members if m.typeflag == "1"))
+
+def find_previous_archive(version):
+    "return the path of the latest archive before version, or None"
+    found = []
+    for pattern in previous_archive_globs:
+        for path in glob.glob(pattern):
+            match = re.search(r"[0-9]{4}-[0-9]{2}-[0-9]{2}", path)
+            if match and match.group(0) < version:
+                found.append((match.group(0), path))
+    return max(found)[1] if found else None
+
+def run_blockpack(paths, output_path, previous_path, threads, hasher=None):
+    """
+    write output_path with blockpack.py, reusing the xz blocks of previous_path
+
+    return (members, block_groups)
+    """
+    temp_output_path = f"{output_path}.temp.{time.time()}"
+    try:
+        with open(temp_output_path, "wb") as output:
+            if hasher:
+                output = HashingWriter(output, hasher)
+            members, block_groups, num_reused = blockpack.pack(output, paths, previous_path, threads=threads,
+                known_sha1s=blockpack.load_known_sha1s())
+    except BaseException:
+        os.unlink(temp_output_path)
+        raise
+    os.replace(temp_output_path, output_path)
+    print(f"reused {num_reused} of {len(block_groups)} block groups")
+    return members, block_groups
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="pack torrents/ and torrents.json into a reproducible tar.xz archive")
+    parser.add_argument("--gnu-tar", action="store_true",
+        help="use GNU tar instead of the builtin tar writer in tarwriter.py")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+        help="with --gnu-tar: pipe tar into pixz without a temporary tar file (default: yes)")
+    # release.py can only create deltas (see delta.py) between incremental archives
+    parser.add_argument("--incremental", action=argparse.BooleanOptionalAction, default=None,
+        help="compress with blockpack.py and reuse the xz blocks of unchanged block groups from the previous archive. "
+            "release.py needs this for the delta from the previous release (default: yes, no with --gnu-tar)")
+    parser.add_argument("--previous",
+        help="with --incremental: previous archive (default: latest archive in . or release/)")
+    parser.add_argument("--threads", type=int, default=blockpack.default_threads,
+        help=f"with --incremental: number of compression threads (default: {blockpack.default_threads})")
+    parser.add_argument("--tiger", action=argparse.BooleanOptionalAction, default=True,
+        help=f"write the tiger digest to the .hashes file with {tiger_hash_args[0]}, like hashes.sh (default: yes)")
+    add_metrics_args(parser)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    if args.incremental is None:
+        args.incremental = not args.gnu_tar
+    return args
+
+async def main(args, metrics):
 
     # check dependencies
-    for bin in ["tar", "pixz"]:
+    if args.incremental and args.gnu_tar:
+        print("error: --incremental and --gnu-tar cannot be used together")
+        sys.exit(1)
+    for bin in ([] if args.incremental else ["pixz"]) + (["tar"] if args.gnu_tar else []):
         assert shutil.which(bin), f"please install {bin}"
+    # the .hashes file has the digests of hashes.sh
+    if args.tiger and not shutil.which(tiger_hash_args[0]):
+        print(f"error: {tiger_hash_args[0]} not found. hint: install it, or pass --no-tiger")
+        sys.exit(1)
 
     # check tar version
     min_tar_version = "1.28"
-    try:
-        tar_version = get_tar_version()
-        # print(f"Found tar version: {tar_version}")
-        if check_min_version(tar_version, min_tar_version):
-            # print(f"ok: tar version meets minimum requirement {min_tar_version}")
-            # return 0
-            pass
-        else:
-            print(f"error: tar version {tar_version} is below minimum requirement {min_tar_version}")
+    if args.gnu_tar:
+        try:
+            tar_version = get_tar_version()
+            # print(f"Found tar version: {tar_version}")
+            if check_min_version(tar_version, min_tar_version):
+                # print(f"ok: tar version meets minimum requirement {min_tar_version}")
+                # return 0
+                pass
+            else:
+                print(f"error: tar version {tar_version} is below minimum requirement {min_tar_version}")
+                sys.exit(1)
+        except Exception as e:
+            print(f"Error: {str(e)}")
             sys.exit(1)
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        sys.exit(1)
 
     # print("ok"); return # debug
 
@@ -116,45 +312,22 @@ async def main():
         print("error: missing input file: {cache_path} - hint: run update.py first")
         sys.exit(1)
 
-    # Process torrents.json and prepare download URLs
-    with open(cache_file) as f:
-        torrents = json.load(f)
-
-    download_urls = []
-    last_torrent_date_int = 0
-    for torrent in torrents:
-        url = torrent['url']
-        size = torrent['torrent_size']
-        obsolete = torrent['obsolete']
-        embargo = torrent['embargo']
-
-        if not url.startswith(url_prefix):
-            continue
-
-        if obsolete or embargo:
-            continue
-
-        path = Path(url[url_prefix_len:])
-
-        # ignore annas-torrents torrents
-        # example:
-        # torrents/managed_by_aa/annas-torrents-2025-07-14.torrent/annas-torrents-2025-07-14.torrent
-        if str(path).startswith("torrents/managed_by_aa/annas-torrents-"):
-            continue
-
-        torrent_date_int = parse_date(torrent['added_to_torrents_list_at'])
-
-        if torrent_date_int > last_torrent_date_int:
-            last_torrent_date_int = torrent_date_int
-
-    last_torrent_date = format_date(last_torrent_date_int)
-    version = last_torrent_date
+    # Process torrents.json
+    manifest = load_manifest(cache_file)
+    version = manifest.last_date
 
     torrents_archive_path = torrents_archive_path_template.format(version=version)
 
-    if os.path.exists(torrents_archive_path):
-        print(f"error: output file exists: {torrents_archive_path}")
-        sys.exit(1)
+    output_paths = [
+        torrents_archive_path,
+        get_index_path(torrents_archive_path),
+        get_hashes_path(torrents_archive_path),
+        get_piece_cache_path(torrents_archive_path),
+    ]
+    for path in output_paths:
+        if os.path.exists(path):
+            print(f"error: output file exists: {path}")
+            sys.exit(1)
 
     content_path = f"release/annas-torrents-{version}"
     if os.path.exists(content_path):
@@ -166,44 +339,94 @@ async def main():
         print(f"error: torrent exists: {torrent_file_path}")
         sys.exit(1)
 
-    # create a reproducible tar archive
-    # https://reproducible-builds.org/docs/archives/#full-example
-    # https://stackoverflow.com/questions/32997526/how-to-create-a-tar-file-that-omits-timestamps-for-its-contents
-    # https://unix.stackexchange.com/questions/438329/tar-produces-different-files-each-time
+    t0 = time.time()
+
+    if args.incremental:
+        previous_path = args.previous or find_previous_archive(version)
+        if previous_path and not os.path.exists(previous_path):
+            print(f"error: missing input file: {previous_path}")
+            sys.exit(1)
+        print(f"creating {torrents_archive_path}, previous archive: {previous_path}")
+        # digests and piece hashes of the archive, computed while it is written
+        hasher = MultiHasher(tiger=args.tiger)
+        try:
+            # tar, compress and hash in one pass
+            with metrics.span("pack") as span:
+                members, block_groups = run_blockpack(archive_paths, torrents_archive_path, previous_path, args.threads, hasher)
+        except RuntimeError as e:
+            hasher.kill()
+            print(f"error: {e}")
+            sys.exit(1)
+        count_members(metrics, members, span)
+        metrics.count("block_groups", len(block_groups))
+        print_hard_links(members)
+        with metrics.span("index"):
+            print(f"writing {write_index(members, torrents_archive_path, block_groups=block_groups)}")
+        hasher.close()
+        print(f"writing {write_hashes(torrents_archive_path, hasher)}")
+        metrics.count("archive_bytes", hasher.size)
+        print(f"done in {time.time() - t0:.1f} seconds")
+        print(f"done {torrents_archive_path}")
+        return
+
+    if not args.gnu_tar or args.stream:
+        # pipe tar into pixz, without a temporary tar file
+        print(f"creating {torrents_archive_path}")
+        hasher = MultiHasher(tiger=args.tiger)
+        try:
+            # tar, compress and hash in one pass
+            with metrics.span("pack") as span:
+                if args.gnu_tar:
+                    run_pipeline(get_tar_args("-"), compress_args, torrents_archive_path, hasher)
+                else:
+                    members = run_writer(archive_paths, compress_args, torrents_archive_path, hasher)
+        except RuntimeError as e:
+            hasher.kill()
+            print(f"error: {e}")
+            sys.exit(1)
+        if args.gnu_tar:
+            # gnu tar does not tell us the members, so the span has the archive size
+            span.bytes = hasher.size
+            print(f"not writing {get_index_path(torrents_archive_path)}. hint: ratarmount will create it on mount")
+        else:
+            count_members(metrics, members, span)
+            print_hard_links(members)
+            # seek index for ratarmount, so mount.sh does not scan the whole archive
+            with metrics.span("index"):
+                print(f"writing {write_index(members, torrents_archive_path)}")
+        hasher.close()
+        print(f"writing {write_hashes(torrents_archive_path, hasher)}")
+        metrics.count("archive_bytes", hasher.size)
+        print(f"done in {time.time() - t0:.1f} seconds")
+        print(f"done {torrents_archive_path}")
+        return
+
     temp_torrents_tar_path = f"torrents.{version}.temp.{time.time()}.tar"
     print(f"creating {temp_torrents_tar_path}")
-    args = [
-        "tar",
-        "--sort=name",
-        "--mtime=UTC 1970-01-01",
-        "--owner=0",
-        "--group=0",
-        "--numeric-owner",
-        "--pax-option=exthdr.name=%d/PaxHeaders/%f,delete=atime,delete=ctime",
-        "-c",
-        "-f", temp_torrents_tar_path,
-        # archive contents
-        "torrents",
-        "torrents.json",
-    ]
-    print(">", shlex.join(args))
+    command = get_tar_args(temp_torrents_tar_path)
+    print(">", shlex.join(command))
     t1 = time.time()
-    subprocess.run(args)
+    with metrics.span("tar") as span:
+        subprocess.run(command, check=True)
+        span.bytes = os.path.getsize(temp_torrents_tar_path)
     t2 = time.time()
     print(f"done in {t2 - t1:.1f} seconds")
 
     # use pixz to compress the tar archive
+    # pixz writes the output file, so it is hashed after
     print(f"creating {torrents_archive_path}")
-    args = [
-        "pixz",
-        "-1", # level 1: lowest compression
+    command = [
+        *compress_args,
         "-k", # keep input file
         temp_torrents_tar_path,
         torrents_archive_path,
     ]
-    print(">", shlex.join(args))
+    print(">", shlex.join(command))
     t1 = time.time()
-    subprocess.run(args)
+    with metrics.span("compress") as span:
+        subprocess.run(command, check=True)
+        # the throughput of the input
+        span.bytes = os.path.getsize(temp_torrents_tar_path)
     t2 = time.time()
     print(f"done in {t2 - t1:.1f} seconds")
 
@@ -214,8 +437,15 @@ async def main():
     else:
         print(f"keeping tempfile {temp_torrents_tar_path}")
 
+    with metrics.span("hash") as span:
+        print(f"writing {write_hashes(torrents_archive_path, hash_file(torrents_archive_path, tiger=args.tiger))}")
+        span.bytes = os.path.getsize(torrents_archive_path)
+    metrics.count("archive_bytes", span.bytes)
     print(f"done {torrents_archive_path}")
 
 if __name__ == "__main__":
     import sys
-    asyncio.run(main())
+    args = parse_args()
+    with Metrics("pack", args.metrics_dir, args.textfile_dir) as metrics:
+        with Profiler("pack", args.profile, args.profile_dir, args.profile_memory):
+            asyncio.run(main(args, metrics))
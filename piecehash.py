@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+
+# piecehash.py
+# parallel piece hashing for release.py
+
+"""
+Parallel piece hasher for BitTorrent v1 torrents.
+
+torf hashes the release with one reader thread, which reads one piece
+at a time into a queue. Here every worker hashes a run of consecutive
+pieces straight from mmap'ed files, so there is no copy and no queue,
+and the workers read adjacent ranges, which keeps the reads sequential.
+hashlib releases the GIL while it hashes, so threads use all cores.
+
+Pieces span file boundaries, like in torf: the files are hashed
+as one stream, in the order of the torrent.
+The piece hashes are written into the torf.Torrent, so for the same
+file order and piece size, the metainfo and the infohash are the same
+as with torf.Torrent.generate().
+
+pack.py hashes the pieces of the archive while it writes the archive
+(see hashes.py), and stores them in the piece cache <archive>.pieces.
+release.py uses the release layout (see set_release_layout):
+the archive is the first file, not the file in the sorted order of torf,
+and the piece size is the piece size of the cache, not the default of torf.
+So release.py takes the pieces of the archive from the cache, and reads
+only the last piece of the archive and the small files after it.
+The infohash of a release is different from the infohash of
+torf.Torrent.generate() with the default layout.
+
+verify_torrent checks the files of a torrent against its v1 pieces,
+with the same hasher, and maps bad pieces back to files.
+Padding files of hybrid torrents are hashed as zeros, and are not read.
+See release.py --verify.
+
+Usage:
+    # compare our infohash with the infohash of torf, in the release layout,
+    # and with the infohash of release/annas-torrents-2025-07-19.torrent
+    ./piecehash.py --compare-torf release/annas-torrents-2025-07-19
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bencode import decode_torrent, check_torrent
+
+default_workers = os.cpu_count() or 1
+
+# every worker task hashes at least this many bytes
+task_size = 32 * 1024 * 1024
+
+# seconds between progress lines
+progress_interval = 1
+
+piece_hash_size = 20
+
+# piece size of the piece cache, and of the release torrent
+# torf would choose 2 MiB for an archive of 2 GB
+default_piece_size = 2 * 1024 * 1024
+
+piece_cache_suffix = ".pieces"
+
+# release.py puts the archive first, see set_release_layout
+release_first_file = "torrents.tar.xz"
+
+def get_file_ranges(filepaths):
+    "return (path, start, size) list, where start is the offset in the stream of all files"
+    ranges = []
+    start = 0
+    for path in filepaths:
+        size = os.path.getsize(path)
+        if size > 0:
+            ranges.append((str(path), start, size))
+        start += size
+    return ranges
+
+def hash_range(file_ranges, piece_size, first_piece, num_pieces, total_size):
+    """
+    return the concatenated sha1 hashes of num_pieces pieces from first_piece
+
+    file_ranges: (path, start, size) list. path None is a padding file of zeros
+    """
+    start = first_piece * piece_size
+    end = min(total_size, (first_piece + num_pieces) * piece_size)
+    hashes = [hashlib.sha1() for _ in range(num_pieces)]
+    for path, file_start, file_size in file_ranges:
+        a = max(start, file_start)
+        b = min(end, file_start + file_size)
+        if a >= b:
+            continue
+        if path is None:
+            while a < b:
+                piece = a // piece_size
+                piece_end = min(b, (piece + 1) * piece_size)
+                hashes[piece - first_piece].update(bytes(piece_end - a))
+                a = piece_end
+            continue
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) != file_size:
+                raise RuntimeError(f"file changed as we read it: {path}")
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mm)
+            try:
+                # split the range of this file at piece boundaries
+                while a < b:
+                    piece = a // piece_size
+                    piece_end = min(b, (piece + 1) * piece_size)
+                    hashes[piece - first_piece].update(view[a - file_start:piece_end - file_start])
+                    a = piece_end
+            finally:
+                view.release()
+    return b"".join(h.digest() for h in hashes)
+
+class Progress:
+    def __init__(self, total_size, file=sys.stderr):
+        self.total_size = total_size
+        self.done_size = 0
+        self.file = file
+        self.t1 = self.last_print = time.monotonic()
+        self.end = "\r" if file.isatty() else "\n"
+
+    def update(self, size):
+        self.done_size += size
+        now = time.monotonic()
+        if now - self.last_print >= progress_interval or self.done_size == self.total_size:
+            self.last_print = now
+            print(f"hashed {self.done_size / 2**20:.0f} of {self.total_size / 2**20:.0f} MiB "
+                f"({self.done_size / max(1, self.total_size) * 100:.0f}%), "
+                f"{self.speed() / 2**20:.1f} MiB/s", end=self.end, file=self.file, flush=True)
+
+    def speed(self):
+        return self.done_size / max(1e-9, time.monotonic() - self.t1)
+
+    def close(self):
+        if self.end == "\r":
+            print(file=self.file)
+
+def hash_pieces(filepaths, piece_size, workers=default_workers, progress=True, first_piece=0):
+    """
+    return the concatenated sha1 piece hashes of the stream of filepaths
+
+    like the "pieces" of a v1 torrent. pieces before first_piece are skipped.
+    """
+    file_ranges = get_file_ranges(filepaths)
+    total_size = sum(size for path, start, size in file_ranges)
+    return hash_file_ranges(file_ranges, total_size, piece_size, workers, progress, first_piece)
+
+def hash_file_ranges(file_ranges, total_size, piece_size, workers=default_workers, progress=True, first_piece=0):
+    "like hash_pieces, but with the (path, start, size) list of get_file_ranges"
+    total_pieces = -(-total_size // piece_size)
+    pieces_per_task = max(1, task_size // piece_size)
+    reporter = Progress(max(0, total_size - first_piece * piece_size)) if progress else None
+
+    # hash in a bounded window of tasks, so the workers read close together
+    result = []
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for task_piece in range(first_piece, total_pieces, pieces_per_task):
+            num_pieces = min(pieces_per_task, total_pieces - task_piece)
+            size = min(total_size, (task_piece + num_pieces) * piece_size) - task_piece * piece_size
+            future = executor.submit(hash_range, file_ranges, piece_size, task_piece, num_pieces, total_size)
+            pending.append((future, size))
+            while len(pending) >= 2 * workers:
+                future, size = pending.popleft()
+                result.append(future.result())
+                reporter and reporter.update(size)
+        while pending:
+            future, size = pending.popleft()
+            result.append(future.result())
+            reporter and reporter.update(size)
+    if reporter:
+        reporter.close()
+    return b"".join(result)
+
+class PieceHasher:
+    "hash the pieces of a stream, for the piece cache"
+
+    def __init__(self, piece_size=default_piece_size):
+        self.piece_size = piece_size
+        self.hash = hashlib.sha1()
+        self.hash_size = 0
+        self.pieces = bytearray()
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.piece_size - self.hash_size)
+            self.hash.update(view[:n])
+            self.hash_size += n
+            view = view[n:]
+            if self.hash_size == self.piece_size:
+                self.pieces += self.hash.digest()
+                self.hash = hashlib.sha1()
+                self.hash_size = 0
+
+    def full_pieces(self):
+        "return the hashes of the full pieces. the last partial piece depends on the next file"
+        return bytes(self.pieces)
+
+def get_piece_cache_path(path):
+    return path + piece_cache_suffix
+
+def write_piece_cache(path, hasher, v2_hasher=None):
+    """
+    write the piece cache of the file path, from a PieceHasher of its contents
+
+    v2_hasher: MerklePieceHasher from hybridtorrent.py, for the v2 piece layer
+    """
+    st = os.stat(path)
+    cache = {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "piece_size": hasher.piece_size,
+        "pieces": hasher.full_pieces().hex(),
+    }
+    if v2_hasher:
+        cache["piece_layer"] = v2_hasher.full_pieces().hex()
+    cache_path = get_piece_cache_path(path)
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(cache, f)
+        f.write("\n")
+    os.replace(cache_path + ".tmp", cache_path)
+    return cache_path
+
+def read_piece_cache(path, cache_path=None):
+    """
+    return (piece_size, v1 hashes, v2 hashes) of the full pieces of the file path
+
+    the v2 hashes are None if the cache has none.
+    return None if there is no cache, or if the file has changed
+    """
+    cache_path = cache_path or get_piece_cache_path(path)
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path) as f:
+        cache = json.load(f)
+    st = os.stat(path)
+    if (cache["size"], cache["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+        return None
+    pieces = bytes.fromhex(cache["pieces"])
+    num_pieces = st.st_size // cache["piece_size"]
+    if len(pieces) != num_pieces * piece_hash_size:
+        return None
+    piece_layer = bytes.fromhex(cache["piece_layer"]) if "piece_layer" in cache else None
+    if piece_layer is not None and len(piece_layer) != num_pieces * 32:
+        return None
+    return cache["piece_size"], pieces, piece_layer
+
+def generate(torrent, workers=default_workers, progress=True, cache=None):
+    """
+    set the piece hashes of a torf.Torrent
+
+    the same as torrent.generate(), but with our hasher.
+    cache: (piece_size, v1 pieces, v2 pieces) of the first file, from read_piece_cache.
+    """
+    cached_pieces = b""
+    if cache and cache[0] == torrent.piece_size:
+        cached_pieces = cache[1]
+    first_piece = len(cached_pieces) // piece_hash_size
+    pieces = cached_pieces + hash_pieces(torrent.filepaths, torrent.piece_size, workers, progress, first_piece)
+    if len(pieces) != torrent.pieces * piece_hash_size:
+        raise RuntimeError(f"expected {torrent.pieces} pieces, got {len(pieces) // piece_hash_size}")
+    torrent.metainfo["info"]["pieces"] = pieces
+
+def set_release_layout(torrent, first_file=release_first_file, piece_size=None):
+    """
+    set the file order and piece size of release.py in a torf.Torrent
+
+    first_file is moved to the front, so its pieces start at a piece boundary,
+    and the pieces from its piece cache are valid.
+    piece_size: the piece size of the piece cache, or None for the default of torf
+    """
+    files = torrent.metainfo["info"]["files"]
+    paths = [f["path"] for f in files]
+    if [first_file] in paths:
+        files.insert(0, files.pop(paths.index([first_file])))
+    if piece_size:
+        torrent.piece_size = piece_size
+
+def read_torrent_files(metainfo, content_path):
+    "return the (path, start, size) list of the v1 files of a torrent. path is None for padding files"
+    info = metainfo[b"info"]
+    if b"files" not in info:
+        return [(content_path, 0, info[b"length"])]
+    files = []
+    start = 0
+    for f in info[b"files"]:
+        path = None
+        if b"p" not in f.get(b"attr", b""):
+            path = os.path.join(content_path, *(part.decode() for part in f[b"path"]))
+        files.append((path, start, f[b"length"]))
+        start += f[b"length"]
+    return files
+
+def verify_torrent(torrent_path, content_path=None, workers=default_workers, progress=True):
+    """
+    check the files of a torrent against its v1 pieces
+
+    content_path defaults to the torrent name next to the torrent file.
+    return (number of pieces, bad pieces, {path: bad pieces}, file errors)
+    missing files and files of the wrong size are file errors,
+    and their pieces are bad.
+    """
+    with open(torrent_path, "rb") as f:
+        metainfo, infohash = decode_torrent(f.read())
+    check_torrent(metainfo)
+    info = metainfo[b"info"]
+    content_path = content_path or os.path.join(os.path.dirname(torrent_path), info[b"name"].decode())
+    piece_size = info[b"piece length"]
+    expected = info[b"pieces"]
+
+    files = read_torrent_files(metainfo, content_path)
+    file_ranges = []
+    file_errors = []
+    for path, start, size in files:
+        if path is not None:
+            try:
+                actual_size = os.path.getsize(path)
+            except FileNotFoundError:
+                file_errors.append((path, "missing"))
+                continue
+            if actual_size != size:
+                # not hashed, so its pieces are bad
+                file_errors.append((path, f"size {actual_size}, expected {size}"))
+                continue
+        if size > 0:
+            file_ranges.append((path, start, size))
+    total_size = sum(size for path, start, size in files)
+    pieces = hash_file_ranges(file_ranges, total_size, piece_size, workers, progress)
+
+    num_pieces = len(expected) // piece_hash_size
+    bad_pieces = [
+        i for i in range(num_pieces)
+        if pieces[i * piece_hash_size:(i + 1) * piece_hash_size] != expected[i * piece_hash_size:(i + 1) * piece_hash_size]
+    ]
+    bad_files = {}
+    for path, start, size in files:
+        if path is None or size == 0:
+            continue
+        first, last = start // piece_size, (start + size - 1) // piece_size
+        file_bad_pieces = [i for i in bad_pieces if first <= i <= last]
+        if file_bad_pieces:
+            bad_files[path] = file_bad_pieces
+    return num_pieces, bad_pieces, bad_files, file_errors
+
+def compare_torf(path, workers=default_workers, piece_size=None):
+    """
+    hash path with torf and with hash_pieces, in the release layout of release.py
+
+    piece_size defaults to the piece size of the torrent file next to path,
+    like release/annas-torrents-2025-07-19.torrent, or to default_piece_size.
+    when the torrent file is a v1 torrent, its infohash is compared too.
+    return True if the infohashes are equal
+    """
+    # pip install torf
+    import torf
+    torrent_path = os.path.normpath(path) + ".torrent"
+    published = None
+    if os.path.exists(torrent_path):
+        with open(torrent_path, "rb") as f:
+            metainfo, infohash = decode_torrent(f.read())
+        check_torrent(metainfo)
+        piece_size = piece_size or metainfo[b"info"][b"piece length"]
+        # a hybrid torrent has padding files, its infohash is not the infohash of torf
+        if b"meta version" not in metainfo[b"info"]:
+            published = infohash
+    piece_size = piece_size or default_piece_size
+    t1 = time.time()
+    ref = torf.Torrent(path=path, creation_date=None, created_by=None)
+    if ref.mode == "multifile":
+        set_release_layout(ref, piece_size=piece_size)
+    else:
+        ref.piece_size = piece_size
+    ref.generate()
+    t2 = time.time()
+    ours = torf.Torrent(path=path, creation_date=None, created_by=None)
+    if ours.mode == "multifile":
+        set_release_layout(ours, piece_size=piece_size)
+    else:
+        ours.piece_size = piece_size
+    generate(ours, workers)
+    t3 = time.time()
+    print(f"piece size {piece_size}")
+    print(f"torf: {ref.infohash} in {t2 - t1:.1f} seconds")
+    print(f"ours: {ours.infohash} in {t3 - t2:.1f} seconds")
+    if published:
+        print(f"{torrent_path}: {published}")
+    if ref.infohash != ours.infohash:
+        print("error: infohashes differ")
+        return False
+    if published and published != ours.infohash:
+        print(f"error: infohash of {torrent_path} differs")
+        return False
+    print("ok: infohashes are equal")
+    return True
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="hash the pieces of a torrent with many threads")
+    parser.add_argument("path", help="file or directory")
+    parser.add_argument("--workers", type=int, default=default_workers,
+        help=f"number of hashing threads (default: {default_workers})")
+    parser.add_argument("--compare-torf", action="store_true",
+        help=f"compare our infohash with the infohash of torf, both in the release layout of release.py "
+            f"({release_first_file} first, piece size of the torrent file next to path or {default_piece_size}), "
+            "and with the infohash of that torrent file. exit 1 if they differ")
+    parser.add_argument("--piece-size", type=int,
+        help="with --compare-torf: piece size (default: from the torrent file next to path)")
+    args = parser.parse_args()
+    if args.compare_torf:
+        sys.exit(0 if compare_torf(args.path, args.workers, args.piece_size) else 1)
+    # pip install torf
+    import torf
+    t = torf.Torrent(path=args.path, creation_date=None, created_by=None)
+    generate(t, args.workers)
+    print(f"btih {t.infohash}")
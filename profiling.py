@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# profiling.py
+# --profile for update.py, pack.py, release.py and the stats scripts
+
+"""
+Profiling mode for the pipeline stages.
+
+With --profile, a stage runs under cProfile, and writes to a new
+directory profiles/<stage>-<time>-<random>/
+
+- profile.pstats: the call stats, for snakeviz, gprof2dot or
+  python -m pstats
+- profile.txt: the top functions by cumulative and by own time
+- profile.folded: collapsed stacks, for flamegraph.pl, inferno,
+  speedscope and other flamegraph viewers
+
+cProfile records only caller-callee pairs, not whole stacks, so the stacks
+in profile.folded are rebuilt from the call graph: the time of a function
+is split between its callers in proportion to the time of each call pair.
+The stacks are cut at max_stack_depth and at max_folded_stacks,
+and calls below min_folded_fraction of the total time are left out.
+
+With --profile-memory, tracemalloc traces the allocations, and
+tracemalloc.txt has the top allocation sites with their tracebacks,
+and tracemalloc.snapshot can be loaded with tracemalloc.Snapshot.load.
+tracemalloc makes python about 2 times slower.
+
+update.py runs its event loop in debug mode, and asyncio-slow-callbacks.log
+lists every callback which blocked the event loop for longer
+than slow_callback_duration.
+
+Only the main thread of the main process is profiled: the hashing
+threads of pack.py and release.py, the validator processes of update.py
+and the parser processes of stats.py are not.
+
+Usage:
+    ./update.py --profile
+    ./pack.py --profile --profile-memory
+    flamegraph.pl profiles/pack-*/profile.folded > pack.svg
+    ./profiling.py profiles/pack-20250719-120000-k2j4f8ax
+"""
+
+profile_dir = "profiles"
+
+# asyncio logs callbacks which run longer, in seconds
+slow_callback_duration = 0.1
+
+# number of frames of an allocation traceback
+tracemalloc_frames = 10
+
+num_top_functions = 50
+num_top_allocations = 30
+
+# bounds of profile.folded, so the walk of the call graph is fast.
+# calls below min_folded_fraction of the total time are left out
+max_stack_depth = 40
+max_folded_stacks = 10000
+min_folded_fraction = 0.001
+
+import os
+import sys
+import time
+import pstats
+import tempfile
+import asyncio
+import logging
+import cProfile
+import tracemalloc
+
+def get_function_name(func):
+    "return the name of a pstats function key (filename, line, name)"
+    filename, line, name = func
+    if filename == "~":
+        # builtin function like <built-in method time.time>
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def write_folded(stats, path):
+    """
+    write the collapsed stacks of pstats.Stats to path
+
+    every line is: function;function;... microseconds
+    the number of paths in the call graph can grow exponentially,
+    so the walk is bounded by the time of a call, the depth and the number of stacks.
+    """
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, (caller_cc, caller_nc, caller_tt, caller_ct) in callers.items():
+            callees.setdefault(caller, []).append((func, caller_ct))
+    # the roots are the functions without callers
+    roots = [func for func, (cc, nc, tt, ct, callers) in stats.stats.items() if not callers]
+    min_time = min_folded_fraction * sum(stats.stats[func][3] for func in roots)
+    folded = {}
+    def walk(func, stack, funcs, scale):
+        if len(folded) >= max_folded_stacks:
+            return
+        cc, nc, tt, ct, callers = stats.stats[func]
+        stack = stack + [get_function_name(func)]
+        key = ";".join(stack)
+        folded[key] = folded.get(key, 0) + tt * scale
+        if len(stack) >= max_stack_depth:
+            return
+        funcs = funcs | {func}
+        for callee, edge_ct in sorted(callees.get(func, []), key=lambda c: -c[1]):
+            callee_ct = stats.stats[callee][3]
+            # edge_ct * scale is the time of the callee in this stack
+            if callee in funcs or not callee_ct or edge_ct * scale < min_time:
+                continue
+            walk(callee, stack, funcs, scale * edge_ct / callee_ct)
+    for func in sorted(roots, key=lambda func: -stats.stats[func][3]):
+        if stats.stats[func][3] >= min_time:
+            walk(func, [], frozenset(), 1)
+    with open(path, "w") as f:
+        for key, seconds in sorted(folded.items()):
+            microseconds = round(seconds * 1e6)
+            if microseconds > 0:
+                f.write(f"{key} {microseconds}\n")
+
+def write_tracemalloc(snapshot, peak_size, path):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    stats = snapshot.statistics("traceback")
+    with open(path, "w") as f:
+        total = sum(stat.size for stat in stats)
+        f.write(f"{total / 2**20:.1f} MiB in {sum(stat.count for stat in stats)} blocks, "
+            f"peak {peak_size / 2**20:.1f} MiB\n")
+        for i, stat in enumerate(stats[:num_top_allocations]):
+            f.write(f"\n#{i + 1}: {stat.size / 2**10:.1f} KiB in {stat.count} blocks\n")
+            for line in stat.traceback.format(most_recent_first=True):
+                f.write(f"{line}\n")
+
+class Profiler:
+    """
+    profile the code in a with block, when enabled
+
+    usage:
+
+        with Profiler("pack", args.profile, args.profile_dir, args.profile_memory):
+            main()
+    """
+
+    def __init__(self, stage, enabled=False, profile_dir=profile_dir, memory=False):
+        self.stage = stage
+        self.enabled = enabled
+        self.memory = memory
+        self.profile_dir = profile_dir
+        self.run_dir = None
+        self.profile = None
+        self.log_handler = None
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        os.makedirs(self.profile_dir, exist_ok=True)
+        # unique, also for runs which start in the same second
+        self.run_dir = tempfile.mkdtemp(prefix=f"{self.stage}-{time.strftime('%Y%m%d-%H%M%S')}-", dir=self.profile_dir)
+        print(f"profiling to {self.run_dir}", file=sys.stderr)
+        # asyncio logs slow callbacks in debug mode
+        self.log_handler = logging.FileHandler(os.path.join(self.run_dir, "asyncio-slow-callbacks.log"), delay=True)
+        self.log_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logging.getLogger("asyncio").addHandler(self.log_handler)
+        if self.memory:
+            tracemalloc.start(tracemalloc_frames)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.enabled:
+            return
+        self.profile.disable()
+        logging.getLogger("asyncio").removeHandler(self.log_handler)
+        self.log_handler.close()
+        self.write()
+
+    def write(self):
+        if self.memory:
+            # before our own allocations
+            snapshot = tracemalloc.take_snapshot()
+            peak_size = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            snapshot.dump(os.path.join(self.run_dir, "tracemalloc.snapshot"))
+            write_tracemalloc(snapshot, peak_size, os.path.join(self.run_dir, "tracemalloc.txt"))
+        path = os.path.join(self.run_dir, "profile.pstats")
+        self.profile.dump_stats(path)
+        stats = pstats.Stats(path)
+        with open(os.path.join(self.run_dir, "profile.txt"), "w") as f:
+            stats.stream = f
+            stats.sort_stats("cumulative").print_stats(num_top_functions)
+            stats.sort_stats("tottime").print_stats(num_top_functions)
+        write_folded(stats, os.path.join(self.run_dir, "profile.folded"))
+        print(f"wrote profile to {self.run_dir}", file=sys.stderr)
+
+    def run_async(self, coro):
+        "like asyncio.run, but report slow callbacks when profiling"
+        if not self.enabled:
+            return asyncio.run(coro)
+        with asyncio.Runner(debug=True) as runner:
+            runner.get_loop().slow_callback_duration = slow_callback_duration
+            return runner.run(coro)
+
+def add_profile_args(parser):
+    parser.add_argument("--profile", action="store_true",
+        help=f"profile this run with cProfile, write the stats and a flamegraph to {profile_dir}/, see profiling.py")
+    parser.add_argument("--profile-memory", action="store_true",
+        help="with --profile: also write the top allocation sites of tracemalloc")
+    parser.add_argument("--profile-dir", default=profile_dir,
+        help=f"with --profile: parent of the run directories (default: {profile_dir})")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="print the top functions of a profile run directory")
+    parser.add_argument("run_dir")
+    parser.add_argument("--sort", default="cumulative", help="pstats sort key (default: cumulative)")
+    parser.add_argument("--limit", type=int, default=30, help="number of functions (default: 30)")
+    args = parser.parse_args()
+    path = os.path.join(args.run_dir, "profile.pstats")
+    if not os.path.exists(path):
+        print(f"error: missing input file: {path}")
+        sys.exit(1)
+    pstats.Stats(path).sort_stats(args.sort).print_stats(args.limit)
+    path = os.path.join(args.run_dir, "asyncio-slow-callbacks.log")
+    if os.path.exists(path):
+        with open(path) as f:
+            lines = f.readlines()
+        print(f"{len(lines)} slow callbacks in {path}")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# reconcile.py
+# diff the torrents/ tree against the manifest in one directory sweep
+
+torrents_dir = "torrents"
+
+# update.py refuses to remove more than this fraction of the tree without --force,
+# so a truncated or filtered torrents.json does not empty torrents/
+max_remove_fraction = 0.05
+
+import os
+
+from download import part_suffix
+
+class Tree:
+    """
+    the files and directories below root
+
+    files: {path: (size, mtime_ns)}
+    dirs: directory paths, parents before children
+    """
+
+    __slots__ = ("files", "dirs")
+
+    def __init__(self):
+        self.files = {}
+        self.dirs = []
+
+def scan_tree(root=torrents_dir):
+    "walk root once with os.scandir"
+    tree = Tree()
+    if not os.path.isdir(root):
+        return tree
+    stack = [root]
+    while stack:
+        dir_path = stack.pop()
+        tree.dirs.append(dir_path)
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                tree.files[entry.path] = (st.st_size, st.st_mtime_ns)
+    return tree
+
+class Reconciliation:
+    """
+    the diff of a Tree against the manifest entries
+
+    present: [(entry, size, mtime_ns)] files with the expected size
+    mismatched: [(entry, size)] files with the wrong size
+    missing: [entry] entries without a file
+    partial: [path] part files of missing entries
+    orphans: [path] files which are not in the manifest
+    """
+
+    __slots__ = ("present", "mismatched", "missing", "partial", "orphans")
+
+    def __init__(self):
+        self.present = []
+        self.mismatched = []
+        self.missing = []
+        self.partial = []
+        self.orphans = []
+
+def reconcile(entries, tree):
+    result = Reconciliation()
+    # remaining files are orphans
+    files = dict(tree.files)
+    for entry in entries:
+        stat = files.pop(entry.path, None)
+        part_path = entry.path + part_suffix
+        if part_path in files:
+            del files[part_path]
+            if stat is None:
+                result.partial.append(part_path)
+            else:
+                # the part file is stale
+                result.orphans.append(part_path)
+        if stat is None:
+            result.missing.append(entry)
+            continue
+        size, mtime_ns = stat
+        if size != entry.size:
+            result.mismatched.append((entry, size))
+        else:
+            result.present.append((entry, size, mtime_ns))
+    result.orphans.extend(files)
+    result.orphans.sort()
+    return result
+
+def check_removals(entries, tree, paths, max_fraction=max_remove_fraction):
+    """
+    check that removing paths from tree is plausible
+
+    return an error message, or None
+    """
+    if not paths:
+        return None
+    if not entries:
+        return f"the manifest is empty, but would remove all {len(paths)} files"
+    if len(paths) > max_fraction * len(tree.files):
+        return f"would remove {len(paths)} of {len(tree.files)} files, more than {max_fraction:.0%}"
+    return None
+
+def remove_empty_dirs(tree):
+    "remove empty directories of tree, children first"
+    num_removed = 0
+    for dir_path in reversed(tree.dirs[1:]):
+        try:
+            os.rmdir(dir_path)
+            num_removed += 1
+        except OSError:
+            pass
+    return num_removed
+
+if __name__ == "__main__":
+    # print the diff of torrents/ against torrents.json
+    import time
+    from manifest import load_manifest
+
+    manifest = load_manifest()
+    t1 = time.time()
+    tree = scan_tree()
+    result = reconcile(manifest.entries, tree)
+    t2 = time.time()
+    for path in result.orphans:
+        print(f"orphan {path}")
+    for entry, size in result.mismatched:
+        print(f"size mismatch {entry.path}: expected {entry.size}, actual {size}")
+    print(f"files {len(tree.files)}")
+    print(f"present {len(result.present)}")
+    print(f"mismatched {len(result.mismatched)}")
+    print(f"missing {len(result.missing)}")
+    print(f"partial {len(result.partial)}")
+    print(f"orphans {len(result.orphans)}")
+    print(f"done in {t2 - t1:.3f} seconds")
@@ -1,17 +1,46 @@
 #!/usr/bin/env python3
 
 torrents_archive_dst_filename = "torrents.tar.xz"
+# ratarmount index written by pack.py
+index_suffix = ".index.sqlite"
+# digests written by pack.py, like hashes.sh
+hashes_suffix = ".hashes"
+hashes_dst_filename = "torrents.tar.xz.hashes"
 torrents_archive_path_glob = "torrents.????-??-??.tar.xz"
 torrents_archive_path_version_regex = r"torrents\.([0-9-]{10})\.tar\.xz"
 
 version_filename = "version.txt"
 
+# read size of the last fallback of copy_file
+read_size = 1024 * 1024
+
+# delta from the previous release, see delta.py
+delta_filename_template = "torrents.delta-from-{version}.tar"
+release_path_glob = "release/annas-torrents-????-??-??"
+
 copy_content_file_list = [
+    "archive.py",
+    "bencode.py",
+    "blockpack.py",
+    "dedup.py",
+    "delta.py",
+    "download.py",
+    "hashes.py",
+    "hybridtorrent.py",
+    "manifest.py",
+    "metrics.py",
     "mount.sh",
+    "piecehash.py",
+    "profiling.py",
+    "reconcile.py",
     "release.py",
     "shell.nix",
+    "state.py",
+    "tarindex.py",
+    "tarwriter.py",
     "umount.sh",
     "update.py",
+    "validate.py",
 ]
 
 # https://github.com/ngosang/trackerslist
@@ -30,16 +59,28 @@ import os
 import sys
 import time
 import re
+import stat
+import errno
+import fcntl
 import shutil
+import filecmp
 import urllib.parse
 import dataclasses
 import subprocess
 import json
 import glob
+import argparse
 
 # from torf import Torrent
 import torf
 
+from delta import DeltaError, create_delta
+from tarindex import get_index_path, read_block_groups
+import piecehash
+import hybridtorrent
+from metrics import Metrics, add_metrics_args
+from profiling import Profiler, add_profile_args
+
 
 
 def parse_trackerlist(trackerlist):
@@ -51,7 +92,200 @@ def parse_trackerlist(trackerlist):
 
 
 
-def main():
+def find_previous_release(version):
+    "return (version, archive path) of the latest release before version, or (None, None)"
+    found = []
+    for path in glob.glob(release_path_glob):
+        release_version = path[-10:]
+        archive_path = f"{path}/{torrents_archive_dst_filename}"
+        if release_version < version and os.path.exists(archive_path):
+            found.append((release_version, archive_path))
+    return max(found) if found else (None, None)
+
+
+
+# linux/fs.h, fcntl.FICLONE in python 3.12
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+# errors of a copy method which is not supported for these files
+copy_fallback_errnos = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY}
+
+def reflink_file(fsrc, fdst, size):
+    # share the extents of src (btrfs, xfs, bcachefs, ...), no data is copied
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def copy_file_range_file(fsrc, fdst, size):
+    # copy in the kernel, server-side on nfs and smb, reflink where possible
+    offset = 0
+    while offset < size:
+        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset, offset, offset)
+        if n == 0:
+            break
+        offset += n
+
+def sendfile_file(fsrc, fdst, size):
+    # copy in the kernel through the page cache
+    os.lseek(fdst.fileno(), 0, os.SEEK_SET)
+    offset = 0
+    while offset < size:
+        n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+        if n == 0:
+            break
+        offset += n
+
+def read_write_file(fsrc, fdst, size):
+    fsrc.seek(0)
+    fdst.seek(0)
+    shutil.copyfileobj(fsrc, fdst, read_size)
+
+copy_methods = [
+    ("reflink", reflink_file),
+    ("copy_file_range", copy_file_range_file),
+    ("sendfile", sendfile_file),
+    ("read/write", read_write_file),
+]
+
+def copy_file(src, dst):
+    """
+    copy the file src to dst with the first copy method that works
+
+    the data is not read into python, unless all kernel methods fail.
+    the mode is copied, like shutil.copy. return the name of the copy method
+    """
+    temp_path = f"{dst}.tmp"
+    try:
+        with open(src, "rb") as fsrc, open(temp_path, "wb") as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            for method, copy in copy_methods:
+                try:
+                    copy(fsrc, fdst, size)
+                    break
+                except OSError as e:
+                    if e.errno not in copy_fallback_errnos:
+                        raise
+                    # start again with the next method
+                    os.ftruncate(fdst.fileno(), 0)
+            fdst.flush()
+            if os.fstat(fdst.fileno()).st_size != size:
+                raise RuntimeError(f"file changed as we copied it: {src}")
+        shutil.copymode(src, temp_path)
+        os.replace(temp_path, dst)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return method
+
+def move_file(src, dst):
+    """
+    move the file src to dst, return how
+
+    a rename on the same filesystem, else copy_file like shutil.move
+    """
+    try:
+        os.rename(src, dst)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    method = copy_file(src, dst)
+    shutil.copystat(src, dst)
+    os.unlink(src)
+    return method
+
+def is_same_file(path1, path2):
+    "return True if both files have the same mode and content"
+    try:
+        st1 = os.stat(path1)
+        st2 = os.stat(path2)
+    except FileNotFoundError:
+        return False
+    if (st1.st_size, stat.S_IMODE(st1.st_mode)) != (st2.st_size, stat.S_IMODE(st2.st_mode)):
+        return False
+    return filecmp.cmp(path1, path2, shallow=False)
+
+def stage_file(src, dst, previous_path=None):
+    """
+    copy the file src to dst, return how
+
+    when previous_path (the same file in the previous release) is equal,
+    dst is a hard link to previous_path, so the releases share the file.
+    releases are never changed, so this is safe
+    """
+    if previous_path and is_same_file(src, previous_path):
+        try:
+            os.link(previous_path, dst)
+            return "hardlink to previous release"
+        except OSError as e:
+            print(f"warning: not linking {previous_path}: {e}")
+    return copy_file(src, dst)
+
+
+
+def has_block_groups(archive_path):
+    "return True if the archive was written by pack.py --incremental, so it can be used for a delta"
+    index_path = get_index_path(archive_path)
+    return os.path.exists(index_path) and bool(read_block_groups(index_path))
+
+
+
+def verify_releases(torrent_paths, workers, metrics):
+    "check the content of every torrent. return the number of bad releases"
+    num_bad = 0
+    for torrent_path in torrent_paths:
+        print(f"verifying {torrent_path}")
+        t1 = time.time()
+        try:
+            with metrics.span("verify"):
+                num_pieces, bad_pieces, bad_files, file_errors = piecehash.verify_torrent(torrent_path, workers=workers)
+        except (OSError, ValueError) as e:
+            print(f"error: {torrent_path}: {e}")
+            num_bad += 1
+            continue
+        metrics.count("pieces_verified", num_pieces)
+        metrics.count("pieces_bad", len(bad_pieces))
+        for path, error in file_errors:
+            print(f"error: {path}: {error}")
+        for path, pieces in bad_files.items():
+            print(f"error: {path}: {len(pieces)} bad pieces: {' '.join(map(str, pieces[:10]))}{' ...' if len(pieces) > 10 else ''}")
+        if bad_pieces or file_errors:
+            print(f"error: {torrent_path}: {len(bad_pieces)} of {num_pieces} pieces are bad")
+            num_bad += 1
+        else:
+            print(f"ok: {num_pieces} pieces in {time.time() - t1:.1f} seconds")
+    return num_bad
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="move the latest archive to release/ and create its torrent")
+    parser.add_argument("--hash-workers", type=int, default=piecehash.default_workers,
+        help=f"number of piece hashing threads (default: {piecehash.default_workers})")
+    parser.add_argument("--verify", nargs="*", metavar="TORRENT",
+        help="check releases against their torrent files, exit 1 if a piece is bad "
+            f"(default: all {release_path_glob}.torrent)")
+    parser.add_argument("--hybrid", action="store_true",
+        help="create a hybrid BitTorrent v1 + v2 torrent with hybridtorrent.py, "
+            "so unchanged files can be shared between releases")
+    parser.add_argument("--no-delta", action="store_true",
+        help="dont create the delta from the previous release, "
+            "for example when the previous archive was not written by pack.py --incremental")
+    add_metrics_args(parser)
+    add_profile_args(parser)
+    return parser.parse_args()
+
+
+
+def main(args, metrics):
+
+    if args.verify is not None:
+        torrent_paths = args.verify or sorted(glob.glob(f"{release_path_glob}.torrent"))
+        if not torrent_paths:
+            print(f"error: not found torrent files with glob pattern {release_path_glob}.torrent")
+            sys.exit(1)
+        num_bad = verify_releases(torrent_paths, args.hash_workers, metrics)
+        metrics.count("releases_bad", num_bad)
+        sys.exit(1 if num_bad else 0)
 
     torrents_archive_path = (sorted(glob.glob(torrents_archive_path_glob) or [None]))[-1]
     if torrents_archive_path is None:
@@ -76,23 +310,74 @@ def main():
         print(f"error: torrent_file_path exists: {torrent_file_path}")
         sys.exit(1)
 
+    # delta from the previous release, so mirrors dont download the full archive.
+    # both archives must be written by pack.py --incremental, the default
+    previous_version, previous_archive_path = find_previous_release(version)
+    if previous_archive_path and not args.no_delta:
+        for path in [previous_archive_path, torrents_archive_path]:
+            if not has_block_groups(path):
+                print(f"error: cannot create the delta from version {previous_version}: no block groups in {get_index_path(path)}. "
+                    "hint: pack with pack.py --incremental, or release without a delta with --no-delta")
+                sys.exit(1)
+
     os.makedirs(content_path)
 
     for content_file in copy_content_file_list:
         assert os.path.exists(content_file), f"missing file: {content_file}"
 
+    # piece hashes of the archive from pack.py
+    piece_cache_path = piecehash.get_piece_cache_path(torrents_archive_path)
+    piece_cache = piecehash.read_piece_cache(torrents_archive_path)
+    if piece_cache is None:
+        print(f"warning: missing or outdated piece cache {piece_cache_path}. hint: hashing the whole archive")
+
+    # the archive is moved, and the other files are copied,
+    # without a copy of the data where the filesystems allow it
     src = torrents_archive_path
     dst = f"{content_path}/{torrents_archive_dst_filename}"
     print(f"moving {src} to {dst}")
-    shutil.move(src, dst)
-
+    with metrics.span("move_archive") as span:
+        print(f"moved {src} by {move_file(src, dst)}")
+        span.bytes = os.path.getsize(dst)
+
+    src = f"{torrents_archive_path}{hashes_suffix}"
+    dst = hashes_dst_filename
+    if os.path.exists(src):
+        print(f"moving {src} to {dst}")
+        os.replace(src, dst)
+    else:
+        print(f"warning: missing {src}. hint: run hashes.py {content_path}/{torrents_archive_dst_filename}")
+
+    src = f"{torrents_archive_path}{index_suffix}"
+    dst = f"{content_path}/{torrents_archive_dst_filename}{index_suffix}"
+    if os.path.exists(src):
+        print(f"moving {src} to {dst}")
+        print(f"moved {src} by {move_file(src, dst)}")
+    else:
+        print(f"warning: missing ratarmount index {src}. hint: mount.sh will scan the whole archive")
+
+    if previous_archive_path and not args.no_delta:
+        dst = f"{content_path}/{delta_filename_template.format(version=previous_version)}"
+        print(f"creating {dst}")
+        try:
+            with metrics.span("delta"):
+                create_delta(previous_archive_path, f"{content_path}/{torrents_archive_dst_filename}", dst, previous_version, version)
+        except DeltaError as e:
+            print(f"error: not creating delta: {e}")
+            print(f"error: mirrors must download the full archive of version {version}")
+
+    # unchanged files are hard links to the previous release
+    previous_content_path = os.path.dirname(previous_archive_path) if previous_archive_path else None
     for content_file in copy_content_file_list:
         dst = f"{content_path}/{content_file}"
-        print(f"copying content_file {content_file}")
         if os.path.isdir(content_file):
-            shutil.copytree(content_file, dst)
-        else:
-            shutil.copy(content_file, dst)
+            print(f"copying content_file {content_file}")
+            shutil.copytree(content_file, dst, copy_function=copy_file)
+            continue
+        previous_path = f"{previous_content_path}/{content_file}" if previous_content_path else None
+        method = stage_file(content_file, dst, previous_path)
+        print(f"copying content_file {content_file} by {method}")
+        metrics.count("files_linked" if method == "hardlink to previous release" else "files_copied")
 
     with open(f"{content_path}/{version_filename}", "w") as f:
         f.write(f"{version}\n")
@@ -104,29 +389,59 @@ def main():
         print(f"  {t}")
 
     print("creating new torrent file")
-    t = torf.Torrent(
-        path=content_path,
-        trackers=trackers,
-        creation_date=None,
-        created_by=None,
-        randomize_infohash=False,
-    )
-    t.generate()
-
-    btih = t.infohash
+    t1 = time.time()
+    with metrics.span("torrent") as span:
+        if args.hybrid:
+            # every file starts at a piece boundary, so the piece cache is valid in any file order
+            metainfo = hybridtorrent.create_torrent(
+                content_path,
+                trackers,
+                piece_size=(piece_cache[0] if piece_cache else None),
+                workers=args.hash_workers,
+                cache=({f"{content_path}/{torrents_archive_dst_filename}": piece_cache} if piece_cache else None),
+            )
+            info = metainfo["info"]
+            print(f"hashed {len(info['pieces']) // 20} pieces of {info['piece length']} bytes in {time.time() - t1:.1f} seconds")
+            btih, btmh = hybridtorrent.get_infohashes(metainfo)
+            print("btmh", btmh)
+            magnet_link = hybridtorrent.get_magnet(metainfo)
+            write_torrent = lambda path: hybridtorrent.write_torrent(metainfo, path)
+        else:
+            t = torf.Torrent(
+                path=content_path,
+                trackers=trackers,
+                creation_date=None,
+                created_by=None,
+                randomize_infohash=False,
+            )
+            # the archive is the first file, so its pieces start at a piece boundary,
+            # and the pieces from the piece cache are valid
+            piecehash.set_release_layout(t, torrents_archive_dst_filename, piece_cache[0] if piece_cache else None)
+            piecehash.generate(t, args.hash_workers, cache=piece_cache)
+            print(f"hashed {t.pieces} pieces of {t.piece_size} bytes in {time.time() - t1:.1f} seconds")
+            btih = t.infohash
+            magnet_link = str(t.magnet())
+            write_torrent = t.write
+        span.bytes = sum(f["length"] for f in info["files"] if f.get("attr") != "p") if args.hybrid else t.size
+
     print("btih", btih)
     assert len(btih) == 40
 
-    magnet_link = str(t.magnet())
-
     print("magnet", magnet_link)
 
     if not os.path.exists(torrent_file_path):
         print(f"writing {torrent_file_path}")
-        t.write(torrent_file_path)
+        write_torrent(torrent_file_path)
+
+    if os.path.exists(piece_cache_path):
+        os.unlink(piece_cache_path)
 
 
 
 if __name__ == "__main__":
 
-    sys.exit(main() or 0)
+    args = parse_args()
+    stage = "verify" if args.verify is not None else "release"
+    with Metrics(stage, args.metrics_dir, args.textfile_dir) as metrics:
+        with Profiler(stage, args.profile, args.profile_dir, args.profile_memory):
+            sys.exit(main(args, metrics) or 0)
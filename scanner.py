@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# scanner.py
+# fast .torrent header scanner
+
+"""
+Fast .torrent header scanner.
+
+The file is mmapped and walked in place. Strings like info.pieces are
+skipped by their length prefix, so they are never copied, and the
+infohash is computed over a memoryview of the raw info dict.
+
+Only the header fields are extracted:
+piece length, total content size, file count and infohash.
+This handles BitTorrent v1 (info.length or info.files)
+and v2 (info.file tree) torrents.
+"""
+
+import os
+import sys
+import mmap
+import hashlib
+
+from bencode import BencodeError
+
+# byte values
+I = ord("i")
+L = ord("l")
+D = ord("d")
+E = ord("e")
+ZERO = ord("0")
+NINE = ord("9")
+
+def read_int(buf, pos):
+    # i123e
+    end = buf.find(b"e", pos)
+    if end == -1:
+        raise BencodeError(f"unterminated integer at {pos}")
+    return int(buf[pos + 1:end]), end + 1
+
+def read_str_span(buf, pos):
+    # 4:spam -> (start, end) of spam
+    colon = buf.find(b":", pos, pos + 21)
+    if colon == -1:
+        raise BencodeError(f"invalid string at {pos}")
+    start = colon + 1
+    end = start + int(buf[pos:colon])
+    if end > len(buf):
+        raise BencodeError(f"string at {pos} ends after the end of data")
+    return start, end
+
+def read_key(buf, pos):
+    start, end = read_str_span(buf, pos)
+    return buf[start:end], end
+
+def skip_value(buf, pos):
+    "return the end of the value at pos, without decoding it"
+    c = buf[pos]
+    if c == I:
+        end = buf.find(b"e", pos)
+        if end == -1:
+            raise BencodeError(f"unterminated integer at {pos}")
+        return end + 1
+    if c == L or c == D:
+        # dict keys are strings, so dicts are skipped like lists
+        pos += 1
+        while buf[pos] != E:
+            pos = skip_value(buf, pos)
+        return pos + 1
+    if ZERO <= c <= NINE:
+        return read_str_span(buf, pos)[1]
+    raise BencodeError(f"invalid type {chr(c)!r} at {pos}")
+
+def scan_files(buf, pos):
+    # info.files: list of dicts with a length key
+    # return (total_size, file_count, end)
+    if buf[pos] != L:
+        raise BencodeError(f"info.files is not a list at {pos}")
+    total_size = 0
+    file_count = 0
+    pos += 1
+    while buf[pos] != E:
+        if buf[pos] != D:
+            raise BencodeError(f"info.files item is not a dict at {pos}")
+        pos += 1
+        while buf[pos] != E:
+            key, pos = read_key(buf, pos)
+            if key == b"length":
+                length, pos = read_int(buf, pos)
+                total_size += length
+                file_count += 1
+            else:
+                pos = skip_value(buf, pos)
+        pos += 1
+    return total_size, file_count, pos + 1
+
+def scan_file_tree(buf, pos):
+    # info.file tree: nested dicts, a file is {"": {"length": ...}}
+    # return (total_size, file_count, end)
+    if buf[pos] != D:
+        raise BencodeError(f"info.file tree is not a dict at {pos}")
+    total_size = 0
+    file_count = 0
+    pos += 1
+    while buf[pos] != E:
+        key, pos = read_key(buf, pos)
+        if key == b"":
+            # file leaf
+            pos += 1
+            while buf[pos] != E:
+                leaf_key, pos = read_key(buf, pos)
+                if leaf_key == b"length":
+                    length, pos = read_int(buf, pos)
+                    total_size += length
+                    file_count += 1
+                else:
+                    pos = skip_value(buf, pos)
+            pos += 1
+        else:
+            size, count, pos = scan_file_tree(buf, pos)
+            total_size += size
+            file_count += count
+    return total_size, file_count, pos + 1
+
+def scan_info(buf, pos):
+    # return (piece_length, total_size, file_count, end)
+    if buf[pos] != D:
+        raise BencodeError(f"info is not a dict at {pos}")
+    piece_length = None
+    length = None
+    files = None
+    file_tree = None
+    pos += 1
+    while buf[pos] != E:
+        key, pos = read_key(buf, pos)
+        if key == b"piece length":
+            piece_length, pos = read_int(buf, pos)
+        elif key == b"length":
+            length, pos = read_int(buf, pos)
+        elif key == b"files":
+            *files, pos = scan_files(buf, pos)
+        elif key == b"file tree":
+            *file_tree, pos = scan_file_tree(buf, pos)
+        else:
+            pos = skip_value(buf, pos)
+    if length is not None:
+        total_size, file_count = length, 1
+    elif files is not None:
+        total_size, file_count = files
+    elif file_tree is not None:
+        total_size, file_count = file_tree
+    else:
+        total_size, file_count = 0, 0
+    return piece_length, total_size, file_count, pos + 1
+
+def scan_torrent_buffer(buf):
+    """
+    scan a bencoded torrent in buf (bytes or mmap)
+
+    return (piece_length, total_size, file_count, infohash)
+    """
+    try:
+        if buf[0] != D:
+            raise BencodeError("torrent is not a dict")
+        pos = 1
+        header = None
+        while buf[pos] != E:
+            key, pos = read_key(buf, pos)
+            if key == b"info":
+                start = pos
+                piece_length, total_size, file_count, pos = scan_info(buf, pos)
+                with memoryview(buf) as view:
+                    infohash = hashlib.sha1(view[start:pos]).hexdigest()
+                header = (piece_length, total_size, file_count, infohash)
+            else:
+                pos = skip_value(buf, pos)
+    except (IndexError, ValueError, RecursionError) as exc:
+        if isinstance(exc, BencodeError):
+            raise
+        raise BencodeError(f"invalid bencode: {exc}") from None
+    if header is None:
+        raise BencodeError("missing info dict")
+    return header
+
+def scan_torrent(path):
+    """
+    scan the .torrent file at path
+
+    return (piece_length, total_size, file_count, infohash)
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise BencodeError("empty file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return scan_torrent_buffer(mm)
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        try:
+            piece_length, total_size, file_count, infohash = scan_torrent(path)
+        except (OSError, BencodeError) as exc:
+            print(f"error: {path}: {exc}")
+            continue
+        print(f"{infohash} piece={piece_length} size={total_size} files={file_count} {path}")
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+"""
+same as average-piece-size-torf.py and average-piece-size-tree-sitter.py,
+but with the mmap header scanner from scanner.py,
+parsed in parallel and cached by the stats engine in stats.py
+
+compare the parsers with scripts/benchmark-scanners.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stats import main
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import time
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from torf import Torrent
 
+from profiling import Profiler, add_profile_args
+
 def find_torrent_files(directory):
     """Recursively yield .torrent files from a directory."""
     for root, _, files in os.walk(directory):
@@ -72,4 +77,9 @@ def main():
         print("No multi-file torrents with at least 100 files found.")
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="weighted average piece size of the torrents in torrents/, parsed with torf")
+    add_profile_args(parser)
+    args = parser.parse_args()
+    with Profiler("average-piece-size-torf", args.profile, args.profile_dir, args.profile_memory):
+        main()
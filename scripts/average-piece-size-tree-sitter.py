@@ -45,6 +45,10 @@ from typing import Optional, Tuple
 import tree_sitter
 # from tree_sitter import Language, Parser
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiling import Profiler, add_profile_args
+
 # https://github.com/Samasaur1/tree-sitter-bencode
 BENCODE_LIB = "lib/tree-sitter-bencode/bencode.so"
 BENCODE_SRC_DIR = "lib/tree-sitter-bencode"
@@ -404,4 +408,9 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="weighted average piece size of the torrents in torrents/, parsed with tree-sitter-bencode")
+    add_profile_args(parser)
+    args = parser.parse_args()
+    with Profiler("average-piece-size-tree-sitter", args.profile, args.profile_dir, args.profile_memory):
+        main()
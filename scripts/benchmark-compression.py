@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+"""
+benchmark compressors on the tar stream of pack.py
+
+the tar stream of torrents/ and torrents.json is written once with tarwriter.py,
+then every combination of codec, level, thread count and block size
+is run over it. for each run we record
+
+- compressed size and ratio
+- wall time, CPU time (user + system) and peak RSS of compression
+- the same for full decompression, checked against the sha1 of the input
+- for xz containers: latency of reading one random member with archive.py
+
+codecs that are not installed are skipped.
+the report is written as JSON, so runs on a grown corpus can be compared.
+
+Usage:
+    ./scripts/benchmark-compression.py
+    ./scripts/benchmark-compression.py --codecs pixz,zstd --levels 1,3,6 --threads 1,4
+    ./scripts/benchmark-compression.py --codecs xz --block-sizes 1M,8M,64M --sample 100
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pack import archive_paths, compress_args
+from tarwriter import write_tar
+from tarindex import write_index
+from archive import ArchiveReader, read_xz_blocks
+
+report_path = "benchmark-compression.json"
+
+# dictionary size of the xz presets
+# pixz sets the block size as a fraction of the dictionary size
+xz_dict_sizes = {
+    0: 256 * 1024,
+    1: 1 << 20,
+    2: 2 << 20,
+    3: 4 << 20,
+    4: 4 << 20,
+    5: 8 << 20,
+    6: 8 << 20,
+    7: 16 << 20,
+    8: 32 << 20,
+    9: 64 << 20,
+}
+
+def pixz_compress(level, threads, block_size):
+    args = ["pixz", f"-{level}", "-p", str(threads)]
+    if block_size:
+        args += ["-f", f"{block_size / xz_dict_sizes[level]:g}"]
+    return args
+
+def xz_compress(level, threads, block_size):
+    args = ["xz", f"-{level}", "-T", str(threads), "-c"]
+    if block_size:
+        args += [f"--block-size={block_size}"]
+    return args
+
+# name: (levels, block sizes are supported, threads are supported, compress, decompress)
+# default levels are used when --levels is not given
+codecs = {
+    "pixz": ([1, 6, 9], True, True, pixz_compress, lambda threads: ["pixz", "-d", "-p", str(threads)]),
+    "xz": ([1, 6, 9], True, True, xz_compress, lambda threads: ["xz", "-d", "-c", "-T", str(threads)]),
+    "zstd": ([1, 3, 9, 19], False, True,
+        lambda level, threads, block_size: ["zstd", f"-{level}", f"-T{threads}", "-q", "-c"],
+        lambda threads: ["zstd", "-d", "-q", "-c"]),
+    "pigz": ([1, 6, 9], False, True,
+        lambda level, threads, block_size: ["pigz", f"-{level}", "-p", str(threads), "-c"],
+        lambda threads: ["pigz", "-d", "-c"]),
+    "gzip": ([1, 6, 9], False, False,
+        lambda level, threads, block_size: ["gzip", f"-{level}", "-c"],
+        lambda threads: ["gzip", "-d", "-c"]),
+    "bzip2": ([1, 9], False, False,
+        lambda level, threads, block_size: ["bzip2", f"-{level}", "-c"],
+        lambda threads: ["bzip2", "-d", "-c"]),
+    "lz4": ([1, 9], False, False,
+        lambda level, threads, block_size: ["lz4", f"-{level}", "-q", "-c"],
+        lambda threads: ["lz4", "-d", "-q", "-c"]),
+}
+
+# codecs with xz blocks, which archive.py can read at random
+random_access_codecs = {"pixz", "xz"}
+
+def parse_size(value):
+    "parse 1M, 64K, 1G or a plain number of bytes"
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    value = value.strip().upper().removesuffix("IB").removesuffix("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def parse_list(value, parse=int):
+    return [parse(v) for v in value.split(",") if v]
+
+def run_measured(args, input_path, output_path):
+    """
+    run args with stdin from input_path and stdout to output_path
+
+    return (wall seconds, cpu seconds, peak rss bytes) of the child process
+    """
+    with open(input_path, "rb") as stdin, open(output_path, "wb") as stdout:
+        t1 = time.perf_counter()
+        proc = subprocess.Popen(args, stdin=stdin, stdout=stdout)
+        # wait4 returns the resource usage of this child only
+        _, status, rusage = os.wait4(proc.pid, 0)
+        t2 = time.perf_counter()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed with exit code {proc.returncode}")
+    # ru_maxrss is in KiB on linux
+    return t2 - t1, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * 1024
+
+def sha1_file(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+def measure_random_access(archive_path, index_path, names):
+    "return the latencies in ms of opening the archive and reading one member"
+    latencies = []
+    for name in names:
+        t1 = time.perf_counter()
+        with ArchiveReader(archive_path, index_path) as archive:
+            archive.read(archive.get_member(name))
+        latencies.append((time.perf_counter() - t1) * 1000)
+    return latencies
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+def run_one(codec, level, threads, block_size, tar_path, tar_sha1, index_members, sample_names, temp_dir, repeat):
+    compress, decompress = codecs[codec][3:]
+    compressed_path = os.path.join(temp_dir, "out")
+    decompressed_path = os.path.join(temp_dir, "out.tar")
+    result = {
+        "codec": codec,
+        "level": level,
+        "threads": threads,
+        "block_size": block_size,
+        "command": compress(level, threads, block_size),
+    }
+
+    # best of repeat runs
+    runs = [run_measured(result["command"], tar_path, compressed_path) for _ in range(repeat)]
+    result["compressed_size"] = os.path.getsize(compressed_path)
+    result["ratio"] = result["compressed_size"] / os.path.getsize(tar_path)
+    result["compress_wall_s"] = min(r[0] for r in runs)
+    result["compress_cpu_s"] = min(r[1] for r in runs)
+    result["compress_max_rss"] = max(r[2] for r in runs)
+
+    runs = [run_measured(decompress(threads), compressed_path, decompressed_path) for _ in range(repeat)]
+    result["decompress_wall_s"] = min(r[0] for r in runs)
+    result["decompress_cpu_s"] = min(r[1] for r in runs)
+    result["decompress_max_rss"] = max(r[2] for r in runs)
+    if sha1_file(decompressed_path) != tar_sha1:
+        raise RuntimeError("decompressed output differs from input")
+    os.unlink(decompressed_path)
+
+    if codec in random_access_codecs and sample_names:
+        with open(compressed_path, "rb") as f:
+            result["xz_blocks"] = len(read_xz_blocks(f))
+        index_path = write_index(index_members, compressed_path)
+        latencies = measure_random_access(compressed_path, index_path, sample_names)
+        result["random_access_median_ms"] = statistics.median(latencies)
+        result["random_access_p95_ms"] = percentile(latencies, 95)
+        os.unlink(index_path)
+
+    os.unlink(compressed_path)
+    return result
+
+def format_row(r):
+    if "error" in r:
+        return f"{r['codec']:6s} {r['level']:>3} {r['threads']:>3} {r['block_size'] or '-':>10}  error: {r['error']}"
+    random_access = f"{r['random_access_median_ms']:8.1f}" if "random_access_median_ms" in r else f"{'-':>8s}"
+    return (
+        f"{r['codec']:6s} {r['level']:>3} {r['threads']:>3} {r['block_size'] or '-':>10} "
+        f"{r['compressed_size']:12d} {r['ratio'] * 100:7.2f} "
+        f"{r['compress_wall_s']:8.2f} {r['compress_cpu_s']:8.2f} {r['compress_max_rss'] / 2**20:8.1f} "
+        f"{r['decompress_wall_s']:8.2f} {r['decompress_max_rss'] / 2**20:8.1f} {random_access}"
+    )
+
+table_header = (
+    f"{'codec':6s} {'lvl':>3} {'thr':>3} {'block':>10} {'size':>12} {'ratio%':>7} "
+    f"{'c wall':>8} {'c cpu':>8} {'c rssM':>8} {'d wall':>8} {'d rssM':>8} {'ra ms':>8}"
+)
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark compressors on the tar stream of pack.py")
+    parser.add_argument("--codecs", default=",".join(codecs),
+        help=f"comma separated list of codecs (default: {','.join(codecs)})")
+    parser.add_argument("--levels",
+        help="comma separated list of levels (default: a few levels per codec)")
+    parser.add_argument("--threads", default=f"1,{os.cpu_count()}",
+        help="comma separated list of thread counts, for codecs with threads (default: 1,ncpu)")
+    parser.add_argument("--block-sizes", default="",
+        help="comma separated list of block sizes like 1M,16M, for xz and pixz (default: codec default)")
+    parser.add_argument("--repeat", type=int, default=1,
+        help="run every command N times, report the best time (default: 1)")
+    parser.add_argument("--sample", type=int, default=20,
+        help="number of random members to read for the random access latency (default: 20)")
+    parser.add_argument("--temp-dir", default=None,
+        help="directory for the temporary files (default: system temp dir)")
+    parser.add_argument("-o", "--output", default=report_path,
+        help=f"JSON report (default: {report_path})")
+    args = parser.parse_args()
+
+    paths = [p for p in archive_paths if os.path.exists(p)]
+    if not paths:
+        print(f"error: missing input files: {' '.join(archive_paths)} - hint: run update.py first")
+        sys.exit(1)
+
+    selected = args.codecs.split(",")
+    for codec in selected:
+        if codec not in codecs:
+            print(f"error: unknown codec {codec}")
+            sys.exit(1)
+    block_sizes = parse_list(args.block_sizes, parse_size) or [None]
+    thread_counts = parse_list(args.threads)
+
+    with tempfile.TemporaryDirectory(dir=args.temp_dir) as temp_dir:
+        tar_path = os.path.join(temp_dir, "input.tar")
+        print(f"writing tar stream of {' '.join(paths)}", file=sys.stderr)
+        with open(tar_path, "wb") as f:
+            members = write_tar(f, paths)
+        tar_size = os.path.getsize(tar_path)
+        tar_sha1 = sha1_file(tar_path)
+        file_names = [m.name for m in members if m.typeflag == "0"]
+        sample_names = random.Random(0).sample(file_names, min(args.sample, len(file_names)))
+
+        report = {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "machine": {
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "cpu_count": os.cpu_count(),
+                "python": platform.python_version(),
+            },
+            "corpus": {
+                "paths": paths,
+                "tar_size": tar_size,
+                "tar_sha1": tar_sha1,
+                "members": len(members),
+                "files": len(file_names),
+            },
+            "pack_command": compress_args,
+            "skipped_codecs": [],
+            "results": [],
+        }
+
+        print(f"input: {tar_size} bytes, {len(members)} members", file=sys.stderr)
+        print(table_header)
+        for codec in selected:
+            levels, has_blocks, has_threads = codecs[codec][:3]
+            if not shutil.which(codec):
+                print(f"{codec:6s} skipped: not installed")
+                report["skipped_codecs"].append(codec)
+                continue
+            for level in (parse_list(args.levels) if args.levels else levels):
+                for threads in (thread_counts if has_threads else [1]):
+                    for block_size in (block_sizes if has_blocks else [None]):
+                        try:
+                            result = run_one(
+                                codec, level, threads, block_size, tar_path, tar_sha1,
+                                members, sample_names, temp_dir, args.repeat,
+                            )
+                        except Exception as e:
+                            result = {"codec": codec, "level": level, "threads": threads,
+                                "block_size": block_size, "error": str(e)}
+                        print(format_row(result), flush=True)
+                        report["results"].append(result)
+
+    temp_path = args.output + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    os.replace(temp_path, args.output)
+    print(f"wrote {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
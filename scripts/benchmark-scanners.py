@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+compare the speed and results of .torrent header parsers
+on the same corpus of .torrent files
+
+parsers:
+- mmap: scanner.scan_torrent
+- bencode: bencode.decode_torrent (full strict decode)
+- torf: torf.Torrent.read, as in average-piece-size-torf.py
+- tree-sitter: parse_torrent_header_bytes, as in average-piece-size-tree-sitter.py
+
+torf and tree-sitter are skipped when they are not installed.
+
+Usage:
+    ./scripts/benchmark-scanners.py [--limit N] [directory]
+"""
+
+import os
+import sys
+import time
+import argparse
+import importlib.util
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(scripts_dir))
+
+from scanner import scan_torrent
+from bencode import decode_torrent
+
+def find_torrent_files(directory):
+    for root, _, files in os.walk(directory):
+        for f in files:
+            if f.endswith(".torrent"):
+                yield os.path.join(root, f)
+
+def load_script(filename):
+    "import one of the dash-named scripts as a module"
+    path = os.path.join(scripts_dir, filename)
+    name = os.path.splitext(filename)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_mmap_parser():
+    def parse(path):
+        piece_length, total_size, file_count, infohash = scan_torrent(path)
+        return piece_length, total_size, file_count
+    return parse
+
+def make_bencode_parser():
+    def parse(path):
+        with open(path, "rb") as f:
+            metainfo, infohash = decode_torrent(f.read())
+        info = metainfo[b"info"]
+        if b"length" in info:
+            return info[b"piece length"], info[b"length"], 1
+        files = info.get(b"files", [])
+        return info[b"piece length"], sum(f[b"length"] for f in files), len(files)
+    return parse
+
+def make_torf_parser():
+    from torf import Torrent
+    def parse(path):
+        t = Torrent.read(path)
+        return t.piece_size, t.size, (len(t.files) if t.files else 0)
+    return parse
+
+def make_tree_sitter_parser():
+    # the script must be loaded from the repo root,
+    # because it uses relative paths to lib/tree-sitter-bencode
+    module = load_script("average-piece-size-tree-sitter.py")
+    module.build_tree_sitter_language(module.BENCODE_LIB, module.BENCODE_SRC_DIR)
+    lang = module.load_tree_sitter_language(module.BENCODE_LIB)
+    parser = module.create_tree_sitter_parser(lang)
+    def parse(path):
+        with open(path, "rb") as f:
+            src = f.read()
+        return module.parse_torrent_header_bytes(src, parser)
+    return parse
+
+parser_factories = {
+    "mmap": make_mmap_parser,
+    "bencode": make_bencode_parser,
+    "torf": make_torf_parser,
+    "tree-sitter": make_tree_sitter_parser,
+}
+
+def run_parser(parse, paths):
+    results = {}
+    num_errors = 0
+    t1 = time.time()
+    for path in paths:
+        try:
+            results[path] = parse(path)
+        except Exception:
+            num_errors += 1
+    t2 = time.time()
+    return results, num_errors, t2 - t1
+
+def weighted_avg_piece_size(results):
+    weighted_piece_sum = 0
+    total_size = 0
+    for piece_size, content_size, file_count in results.values():
+        if piece_size and content_size > 0:
+            weighted_piece_sum += piece_size * content_size
+            total_size += content_size
+    return weighted_piece_sum / total_size if total_size else 0
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="benchmark .torrent header parsers")
+    arg_parser.add_argument("directory", nargs="?", default="torrents")
+    arg_parser.add_argument("--limit", type=int, default=None,
+        help="only parse the first N files")
+    arg_parser.add_argument("--parsers", default=",".join(parser_factories),
+        help=f"comma separated list of parsers (default: {','.join(parser_factories)})")
+    args = arg_parser.parse_args()
+
+    paths = sorted(find_torrent_files(args.directory))[:args.limit]
+    print(f"corpus: {len(paths)} files in {args.directory}")
+    if not paths:
+        sys.exit(1)
+
+    # read the corpus once, so the first parser does not pay for a cold cache
+    for path in paths:
+        with open(path, "rb") as f:
+            f.read()
+
+    reference = None
+    print()
+    print(f"{'parser':12s} {'seconds':>10s} {'files/s':>10s} {'errors':>7s} {'differ':>7s} {'avg piece size':>16s}")
+    for name in args.parsers.split(","):
+        try:
+            parse = parser_factories[name]()
+        except Exception as exc:
+            print(f"{name:12s} skipped: {exc!r}")
+            continue
+        results, num_errors, dt = run_parser(parse, paths)
+        if reference is None:
+            reference = results
+        num_differ = sum(
+            1 for path, result in results.items()
+            if path in reference and tuple(result) != tuple(reference[path])
+        )
+        files_per_second = len(paths) / dt if dt > 0 else 0
+        print(f"{name:12s} {dt:10.3f} {files_per_second:10.1f} {num_errors:7d} {num_differ:7d} {weighted_avg_piece_size(results):16.2f}")
+
+if __name__ == "__main__":
+    main()
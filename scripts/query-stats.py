@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+query the per-torrent metrics dataset written by stats.py
+
+all aggregates are vectorized over the NumPy columns,
+so queries take milliseconds instead of a rescan of torrents/
+
+Usage:
+    ./scripts/query-stats.py summary
+    ./scripts/query-stats.py percentiles piece_size
+    ./scripts/query-stats.py histogram content_size
+    ./scripts/query-stats.py collections
+    ./scripts/query-stats.py --collection 'managed_by_aa/*' --since 2024-01-01 summary
+"""
+
+import os
+import sys
+import time
+import fnmatch
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pip install numpy
+import numpy as np
+
+from stats import dataset_path
+from manifest import parse_date
+from profiling import Profiler, add_profile_args
+
+columns = ["piece_size", "content_size", "file_count", "added_date"]
+
+def load_dataset(path=dataset_path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+def select_rows(ds, collection=None, since=None, until=None):
+    "return a boolean mask of the valid rows matching the filters"
+    mask = ds["valid"].copy()
+    if collection:
+        matching = np.array([
+            fnmatch.fnmatchcase(c, collection) for c in ds["collections"]
+        ], dtype=bool)
+        if len(matching):
+            mask &= matching[ds["collection_id"]]
+        else:
+            mask[:] = False
+    if since:
+        mask &= ds["added_date"] >= parse_date(since)
+    if until:
+        mask &= ds["added_date"] <= parse_date(until)
+    return mask
+
+def weighted_avg_piece_size(piece_size, content_size):
+    # float64, because piece_size * content_size overflows int64
+    use = (piece_size > 0) & (content_size > 0)
+    total_size = content_size[use].sum(dtype=np.float64)
+    if total_size == 0:
+        return None
+    return float(np.dot(piece_size[use].astype(np.float64), content_size[use].astype(np.float64)) / total_size)
+
+def avg_file_size(content_size, file_count, min_files=100):
+    use = (file_count >= min_files) & (content_size > 0)
+    total_count = file_count[use].sum()
+    if total_count == 0:
+        return None
+    return float(content_size[use].sum(dtype=np.float64) / total_count)
+
+def format_size(value):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(value) < 1024 or unit == "TiB":
+            return f"{value:.1f} {unit}" if unit != "B" else f"{value:.0f} B"
+        value /= 1024
+
+def cmd_summary(ds, mask, args):
+    piece_size = ds["piece_size"][mask]
+    content_size = ds["content_size"][mask]
+    file_count = ds["file_count"][mask]
+    print(f"torrents: {int(mask.sum())} of {len(mask)} ({int((~ds['valid']).sum())} invalid)")
+    print(f"total content size: {int(content_size.sum(dtype=np.float64))} bytes")
+    print(f"total file count: {int(file_count.sum())}")
+    value = weighted_avg_piece_size(piece_size, content_size)
+    if value is not None:
+        print(f"Weighted average piece size: {value:.2f} bytes")
+    value = avg_file_size(content_size, file_count, args.min_files)
+    if value is not None:
+        print(f"Average file size (multi-file torrents with ≥{args.min_files} files): {value:.2f} bytes")
+
+def cmd_percentiles(ds, mask, args):
+    values = ds[args.column][mask]
+    if len(values) == 0:
+        print("no rows")
+        return
+    qs = [0, 1, 5, 10, 25, 50, 75, 90, 95, 99, 100]
+    for q, value in zip(qs, np.percentile(values, qs)):
+        print(f"p{q:<3d} {value:20.0f}")
+
+def cmd_histogram(ds, mask, args):
+    values = ds[args.column][mask]
+    values = values[values > 0]
+    if len(values) == 0:
+        print("no rows")
+        return
+    # power of 2 buckets
+    exponents = np.floor(np.log2(values)).astype(np.int64)
+    counts = np.bincount(exponents - exponents.min())
+    width = 50
+    for i, count in enumerate(counts):
+        if count == 0:
+            continue
+        e = exponents.min() + i
+        bar = "#" * int(np.ceil(count / counts.max() * width))
+        print(f">= {format_size(2 ** e) if args.column != 'file_count' else 2 ** e:>12} {count:8d} {bar}")
+
+def cmd_collections(ds, mask, args):
+    collection_id = ds["collection_id"][mask]
+    piece_size = ds["piece_size"][mask].astype(np.float64)
+    content_size = ds["content_size"][mask].astype(np.float64)
+    n = len(ds["collections"])
+    count = np.bincount(collection_id, minlength=n)
+    size = np.bincount(collection_id, weights=content_size, minlength=n)
+    files = np.bincount(collection_id, weights=ds["file_count"][mask], minlength=n)
+    weighted = np.bincount(collection_id, weights=piece_size * content_size, minlength=n)
+    order = np.argsort(-size)
+    print(f"{'torrents':>8s} {'content size':>14s} {'files':>12s} {'avg piece size':>14s}  collection")
+    for i in order:
+        if count[i] == 0:
+            continue
+        avg_piece = weighted[i] / size[i] if size[i] > 0 else 0
+        print(f"{count[i]:8d} {format_size(size[i]):>14s} {int(files[i]):12d} {format_size(avg_piece):>14s}  {ds['collections'][i]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="query the per-torrent metrics dataset")
+    parser.add_argument("--dataset", default=dataset_path,
+        help=f"dataset written by stats.py (default: {dataset_path})")
+    parser.add_argument("--collection",
+        help="only torrents in matching collections, glob pattern like 'managed_by_aa/*'")
+    parser.add_argument("--since", help="only torrents added on or after this date, like 2024-01-01")
+    parser.add_argument("--until", help="only torrents added on or before this date")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("summary", help="totals and weighted averages")
+    p.add_argument("--min-files", type=int, default=100)
+    p.set_defaults(func=cmd_summary)
+    p = subparsers.add_parser("percentiles", help="percentiles of one column")
+    p.add_argument("column", choices=columns)
+    p.set_defaults(func=cmd_percentiles)
+    p = subparsers.add_parser("histogram", help="power of 2 histogram of one column")
+    p.add_argument("column", choices=columns)
+    p.set_defaults(func=cmd_histogram)
+    p = subparsers.add_parser("collections", help="breakdown by collection")
+    p.set_defaults(func=cmd_collections)
+    add_profile_args(parser)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dataset):
+        print(f"error: missing input file: {args.dataset} - hint: run stats.py first")
+        sys.exit(1)
+
+    t1 = time.time()
+    with Profiler("query-stats", args.profile, args.profile_dir, args.profile_memory):
+        ds = load_dataset(args.dataset)
+        mask = select_rows(ds, args.collection, args.since, args.until)
+        args.func(ds, mask, args)
+    t2 = time.time()
+    print(f"done in {(t2 - t1) * 1000:.1f} ms", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ pkgs.mkShell {
       packaging
       aiohttp
       torf
+      numpy
     ]))
   ];
 }
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# state.py
+# local state database of the mirrored torrent files
+
+state_db_path = "state.sqlite"
+
+import os
+import time
+import sqlite3
+
+from manifest import hash_file
+
+schema = """
+create table if not exists files (
+    url text primary key,
+    path text not null,
+    -- torrent_size from torrents.json
+    expected_size integer,
+    -- null if the file is missing
+    size integer,
+    mtime_ns integer,
+    -- sha1 of the file contents
+    sha1 text,
+    -- btih of the torrent, set by the validator
+    infohash text,
+    -- added_to_torrents_list_at, like 20250714
+    added_date integer,
+    -- unix time
+    downloaded_at real
+);
+create index if not exists files_path on files (path);
+
+create table if not exists history (
+    time real not null,
+    url text not null,
+    -- downloaded, removed, found, lost, corrupt, invalid, deduplicated
+    event text not null,
+    size integer,
+    sha1 text
+);
+create index if not exists history_url on history (url);
+"""
+
+class StateDB:
+    """
+    per-url state of the files in torrents/
+
+    the current manifest is loaded into a temporary table,
+    so "what is missing / stale / orphaned" are single indexed queries
+    instead of one stat call per file.
+
+    usage:
+
+        with StateDB() as db:
+            db.sync_manifest(manifest.entries)
+            for url, path, expected_size in db.get_missing():
+                ...
+    """
+
+    def __init__(self, path=state_db_path):
+        self.path = path
+        self.is_new = not os.path.exists(path)
+        self.con = sqlite3.connect(path)
+        self.con.execute("pragma journal_mode = wal")
+        self.con.execute("pragma synchronous = normal")
+        self.con.executescript(schema)
+        self.con.execute("""
+            create temp table manifest (
+                url text primary key,
+                path text not null,
+                size integer,
+                added_date integer,
+                btih text
+            )
+        """)
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def commit(self):
+        self.con.commit()
+
+    def sync_manifest(self, entries):
+        "load the manifest entries and update the expected sizes"
+        with self.con:
+            self.con.execute("delete from manifest")
+            self.con.executemany(
+                "insert or replace into manifest values (?, ?, ?, ?, ?)",
+                ((e.url, e.path, e.size, e.date_int, e.btih) for e in entries)
+            )
+            self.con.execute("""
+                insert into files (url, path, expected_size, added_date)
+                select url, path, size, added_date from manifest where true
+                on conflict (url) do update set
+                    path = excluded.path,
+                    expected_size = excluded.expected_size,
+                    added_date = excluded.added_date
+            """)
+
+    def get_missing(self):
+        "manifest entries without a local file: (url, path, expected_size)"
+        return self.con.execute("""
+            select m.url, m.path, m.size
+            from manifest m join files f on f.url = m.url
+            where f.size is null
+            order by m.path
+        """).fetchall()
+
+    def get_stale(self):
+        "local files with the wrong size: (url, path, expected_size, size)"
+        return self.con.execute("""
+            select m.url, m.path, m.size, f.size
+            from manifest m join files f on f.url = m.url
+            where f.size is not null and f.size != m.size
+            order by m.path
+        """).fetchall()
+
+    def get_orphaned(self):
+        "local files not in the manifest: (url, path, size)"
+        return self.con.execute("""
+            select f.url, f.path, f.size
+            from files f left join manifest m on m.url = f.url
+            where m.url is null and f.size is not null
+            order by f.path
+        """).fetchall()
+
+    def get_present(self):
+        "local files in the manifest: (url, path, size, mtime_ns, sha1)"
+        return self.con.execute("""
+            select f.url, f.path, f.size, f.mtime_ns, f.sha1
+            from manifest m join files f on f.url = m.url
+            where f.size is not null
+            order by f.path
+        """).fetchall()
+
+    def get_hashed(self):
+        "local files with a known sha1, also without a manifest: (path, size, mtime_ns, sha1)"
+        return self.con.execute("""
+            select path, size, mtime_ns, sha1 from files
+            where size is not null and sha1 is not null
+        """).fetchall()
+
+    def sync_tree(self, files, event="lost"):
+        """
+        update the local file state from a directory sweep
+
+        files: [(url, size, mtime_ns)] of all files present on disk.
+        rows with a local file which is not in files are marked as removed,
+        new or changed files are recorded with an unknown sha1.
+        """
+        now = time.time()
+        with self.con:
+            self.con.execute("""
+                create temp table if not exists disk (
+                    url text primary key,
+                    size integer,
+                    mtime_ns integer
+                )
+            """)
+            self.con.execute("delete from disk")
+            self.con.executemany("insert or replace into disk values (?, ?, ?)", files)
+            self.con.execute("""
+                insert into history (time, url, event)
+                select ?, f.url, ? from files f left join disk d on d.url = f.url
+                where f.size is not null and d.url is null
+            """, (now, event))
+            self.con.execute("""
+                update files set size = null, mtime_ns = null, sha1 = null, infohash = null
+                where size is not null and url not in (select url from disk)
+            """)
+            self.con.execute("""
+                insert into history (time, url, event, size)
+                select ?, d.url, 'found', d.size from disk d join files f on f.url = d.url
+                where f.size is null or f.size != d.size or f.mtime_ns != d.mtime_ns
+            """, (now,))
+            self.con.execute("""
+                update files set
+                    size = d.size, mtime_ns = d.mtime_ns, sha1 = null, infohash = null
+                from disk d
+                where d.url = files.url
+                    and (files.size is null or files.size != d.size or files.mtime_ns != d.mtime_ns)
+            """)
+
+    def record_removed_paths(self, paths, event="removed"):
+        "record that the local files at paths are gone"
+        for path in paths:
+            for (url,) in self.con.execute(
+                "select url from files where path = ? and size is not null",
+                (str(path),)
+            ).fetchall():
+                self.record_removed(url, event)
+
+    def get_unvalidated(self):
+        "local files without a known infohash: (url, path, btih)"
+        return self.con.execute("""
+            select f.url, f.path, m.btih
+            from manifest m join files f on f.url = m.url
+            where f.size is not null and f.infohash is null
+            order by f.path
+        """).fetchall()
+
+    def record_infohash(self, url, infohash):
+        self.con.execute("update files set infohash = ? where url = ?", (infohash, url))
+
+    def add_history(self, url, event, size=None, sha1=None):
+        self.con.execute(
+            "insert into history values (?, ?, ?, ?, ?)",
+            (time.time(), url, event, size, sha1)
+        )
+
+    def record_file(self, url, path, size, mtime_ns, sha1=None, event="found"):
+        "record a local file found on disk"
+        self.con.execute("""
+            insert into files (url, path, size, mtime_ns, sha1) values (?, ?, ?, ?, ?)
+            on conflict (url) do update set
+                path = excluded.path,
+                size = excluded.size,
+                mtime_ns = excluded.mtime_ns,
+                sha1 = excluded.sha1
+        """, (url, str(path), size, mtime_ns, sha1))
+        self.add_history(url, event, size, sha1)
+
+    def record_download(self, url, path, sha1=None):
+        "record a completed download, hashing the new file if sha1 is not given"
+        st = os.stat(path)
+        if sha1 is None:
+            sha1 = hash_file(path)
+        self.record_file(url, path, st.st_size, st.st_mtime_ns, sha1, event="downloaded")
+        self.con.execute(
+            "update files set downloaded_at = ?, infohash = null where url = ?",
+            (time.time(), url)
+        )
+
+    def record_removed(self, url, event="removed"):
+        "record that the local file of url is gone"
+        self.con.execute("""
+            update files set size = null, mtime_ns = null, sha1 = null, infohash = null
+            where url = ?
+        """, (url,))
+        self.add_history(url, event)
+
+if __name__ == "__main__":
+    # print a summary of the state database
+    from manifest import load_manifest
+
+    with StateDB() as db:
+        db.sync_manifest(load_manifest().entries)
+        print(f"missing {len(db.get_missing())}")
+        print(f"stale {len(db.get_stale())}")
+        print(f"orphaned {len(db.get_orphaned())}")
+        print(f"present {len(db.get_present())}")
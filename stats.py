@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+# stats.py
+# corpus statistics over the .torrent files in torrents/
+
+"""
+Corpus statistics engine.
+
+The .torrent files are parsed with the mmap header scanner from scanner.py
+in batches across a ProcessPoolExecutor. Per-file results are cached,
+keyed on (path, size, mtime_ns), so a re-run only parses new or changed
+files.
+
+The per-torrent metrics are also written as a columnar NumPy dataset
+(see write_dataset), which scripts/query-stats.py aggregates in vectorized
+form, so new questions do not need a rescan.
+
+Usage:
+    ./stats.py [--workers N] [--no-cache] [--dataset PATH] [directory]
+"""
+
+torrents_dir = "torrents"
+stats_cache_path = "torrents-stats.cache"
+dataset_path = "torrents-stats.npz"
+# bump this when the cached result format changes
+stats_cache_version = 1
+
+import os
+import sys
+import time
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from scanner import scan_torrent
+from profiling import Profiler, add_profile_args
+
+batch_size = 256
+
+def find_torrent_files(directory):
+    "yield (path, size, mtime_ns) of the .torrent files below directory"
+    stack = [directory]
+    while stack:
+        dir_path = stack.pop()
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".torrent"):
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime_ns
+
+def scan_batch(paths):
+    """
+    parse a batch of .torrent files
+
+    return [(path, result, error)]
+    where result is (piece_length, total_size, file_count, infohash)
+    """
+    results = []
+    for path in paths:
+        try:
+            results.append((path, scan_torrent(path), None))
+        except Exception as exc:
+            results.append((path, None, str(exc)))
+    return results
+
+def load_cache(path=stats_cache_path):
+    "return {path: (size, mtime_ns, result, error)}"
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as f:
+            version, cache = pickle.load(f)
+        if version == stats_cache_version:
+            return cache
+    except Exception as exc:
+        print(f"ignoring bad cache {path}: {exc!r}", file=sys.stderr)
+    return {}
+
+def save_cache(cache, path=stats_cache_path):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        pickle.dump((stats_cache_version, cache), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+def scan_corpus(directory=torrents_dir, workers=None, cache_path=stats_cache_path):
+    """
+    parse all .torrent files below directory
+
+    return {path: (size, mtime_ns, result, error)} for the current files.
+    with cache_path=None, all files are parsed.
+    """
+    cache = load_cache(cache_path) if cache_path else {}
+    corpus = {}
+    todo = []
+    for path, size, mtime_ns in find_torrent_files(directory):
+        cached = cache.get(path)
+        if cached is not None and cached[0] == size and cached[1] == mtime_ns:
+            corpus[path] = cached
+        else:
+            corpus[path] = (size, mtime_ns, None, None)
+            todo.append(path)
+
+    print(f"found {len(corpus)} files, parsing {len(todo)} new or changed files", file=sys.stderr)
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+    def store(results):
+        for path, result, error in results:
+            size, mtime_ns, _, _ = corpus[path]
+            corpus[path] = (size, mtime_ns, result, error)
+
+    if workers == 1 or len(batches) <= 1:
+        for batch in batches:
+            store(scan_batch(batch))
+    elif batches:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(scan_batch, batch) for batch in batches]
+            for future in as_completed(futures):
+                store(future.result())
+
+    if cache_path and todo:
+        save_cache(corpus, cache_path)
+    return corpus
+
+def compute_stats(corpus):
+    """
+    return a dict with
+    num_torrents, num_errors, weighted_avg_piece_size, avg_file_size
+    like the average-piece-size-*.py scripts
+    """
+    total_size = 0
+    weighted_piece_sum = 0
+    # For multi-file torrents
+    multi_file_total_size = 0
+    multi_file_total_count = 0
+    num_errors = 0
+
+    for size, mtime_ns, result, error in corpus.values():
+        if result is None:
+            num_errors += 1
+            continue
+        piece_size, content_size, file_count, infohash = result
+
+        if piece_size and content_size > 0:
+            weighted_piece_sum += piece_size * content_size
+            total_size += content_size
+
+        # If multi-file with at least 100 files, include in avg file size calc
+        if file_count >= 100 and content_size > 0:
+            multi_file_total_size += content_size
+            multi_file_total_count += file_count
+
+    return {
+        "num_torrents": len(corpus),
+        "num_errors": num_errors,
+        "weighted_avg_piece_size": (weighted_piece_sum / total_size) if total_size > 0 else None,
+        "avg_file_size": (multi_file_total_size / multi_file_total_count) if multi_file_total_count > 0 else None,
+    }
+
+def get_collection(path, directory=torrents_dir):
+    # torrents/managed_by_aa/isbndb/isbndb_2022_09.torrent -> managed_by_aa/isbndb
+    return os.path.dirname(os.path.relpath(path, directory))
+
+def write_dataset(corpus, path=dataset_path, directory=torrents_dir, added_dates=None):
+    """
+    write the per-torrent metrics of corpus as a columnar .npz file
+
+    columns, one row per torrent, sorted by path:
+      path_id: index into paths
+      collection_id: index into collections
+      piece_size, content_size, file_count: 0 if the file failed to parse
+      added_date: added_to_torrents_list_at like 20250714, 0 if unknown
+      valid: False if the file failed to parse
+    lookup tables:
+      paths, collections
+    """
+    # pip install numpy
+    import numpy as np
+
+    added_dates = added_dates or {}
+    paths = sorted(corpus)
+    n = len(paths)
+    collections = sorted(set(get_collection(p, directory) for p in paths))
+    collection_index = {c: i for i, c in enumerate(collections)}
+
+    piece_size = np.zeros(n, dtype=np.int64)
+    content_size = np.zeros(n, dtype=np.int64)
+    file_count = np.zeros(n, dtype=np.int64)
+    added_date = np.zeros(n, dtype=np.int32)
+    collection_id = np.zeros(n, dtype=np.int32)
+    valid = np.zeros(n, dtype=bool)
+
+    for i, p in enumerate(paths):
+        size, mtime_ns, result, error = corpus[p]
+        collection_id[i] = collection_index[get_collection(p, directory)]
+        added_date[i] = added_dates.get(p, 0)
+        if result is None:
+            continue
+        valid[i] = True
+        piece_size[i] = result[0] or 0
+        content_size[i] = result[1]
+        file_count[i] = result[2]
+
+    temp_path = path + ".tmp.npz"
+    np.savez(
+        temp_path,
+        path_id=np.arange(n, dtype=np.int32),
+        collection_id=collection_id,
+        piece_size=piece_size,
+        content_size=content_size,
+        file_count=file_count,
+        added_date=added_date,
+        valid=valid,
+        paths=np.array(paths, dtype=str),
+        collections=np.array(collections, dtype=str),
+    )
+    os.replace(temp_path, path)
+
+def load_added_dates():
+    "return {path: date_int} from torrents.json, or {} if it is missing"
+    from manifest import cache_file, load_manifest
+    if not os.path.exists(cache_file):
+        return {}
+    manifest = load_manifest(cache_file)
+    return {e.path: e.date_int for e in manifest.entries}
+
+def print_stats(stats, dt):
+    print("\n=== Results ===")
+    print(f"processed {stats['num_torrents']} torrents in {dt} seconds")
+    if stats["weighted_avg_piece_size"] is not None:
+        print(f"Weighted average piece size: {stats['weighted_avg_piece_size']:.2f} bytes")
+    else:
+        print("No valid torrent files found.")
+
+    if stats["avg_file_size"] is not None:
+        print(f"Average file size (multi-file torrents with ≥100 files): {stats['avg_file_size']:.2f} bytes")
+    else:
+        print("No multi-file torrents with at least 100 files found.")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="print statistics of the .torrent files")
+    parser.add_argument("directory", nargs="?", default=torrents_dir)
+    parser.add_argument("--workers", type=int, default=None,
+        help="number of parser processes (default: number of CPUs)")
+    parser.add_argument("--no-cache", action="store_true",
+        help=f"parse all files, ignore {stats_cache_path}")
+    parser.add_argument("--dataset", default=dataset_path,
+        help=f"write the per-torrent metrics to this .npz file (default: {dataset_path})")
+    parser.add_argument("--no-dataset", action="store_true",
+        help="dont write the per-torrent metrics")
+    add_profile_args(parser)
+    args = parser.parse_args()
+    with Profiler("stats", args.profile, args.profile_dir, args.profile_memory):
+        run(args)
+
+def run(args):
+    t1 = time.time()
+    corpus = scan_corpus(args.directory, args.workers, None if args.no_cache else stats_cache_path)
+    stats = compute_stats(corpus)
+    t2 = time.time()
+
+    for path, (size, mtime_ns, result, error) in sorted(corpus.items()):
+        if error is not None:
+            print(f"Error parsing {path}: {error}")
+
+    print_stats(stats, t2 - t1)
+
+    if not args.no_dataset:
+        try:
+            write_dataset(corpus, args.dataset, args.directory, load_added_dates())
+        except ImportError:
+            print(f"not writing {args.dataset}. hint: pip install numpy", file=sys.stderr)
+        else:
+            print(f"wrote {args.dataset}. next: run scripts/query-stats.py", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# tarindex.py
+# read and write the ratarmount index of the archive written by pack.py
+
+"""
+Ratarmount index writer.
+
+ratarmount looks for an existing index at <archive>.index.sqlite
+before it scans the archive. A full scan of the xz archive takes minutes,
+but pack.py already knows the offset of every member from TarWriter,
+so it writes the index while it packs.
+
+The tables follow the schema of ratarmountcore's create-index-tables.sql
+(index version 0.7.0). Seeking into the compressed archive needs no table:
+pixz writes many xz blocks, and ratarmount reads their offsets
+from the index at the end of the xz stream.
+
+Usage:
+    # compare our index with the index of ratarmountcore
+    ./tarindex.py --compare-ratarmount torrents.2025-07-19.tar.xz
+"""
+
+import os
+import sys
+import json
+import stat
+import sqlite3
+
+from tarwriter import TarMember
+
+index_suffix = ".index.sqlite"
+
+# version of the index format in ratarmountcore
+ratarmount_index_version = "0.7.0"
+
+index_schema = """
+CREATE TABLE "files" (
+    "path"           VARCHAR(65535) NOT NULL,
+    "name"           VARCHAR(65535) NOT NULL,
+    "offsetheader"   INTEGER,
+    "offset"         INTEGER,
+    "size"           INTEGER,
+    "mtime"          REAL,
+    "mode"           INTEGER,
+    "type"           INTEGER,
+    "linkname"       VARCHAR(65535),
+    "uid"            INTEGER,
+    "gid"            INTEGER,
+    "istar"          BOOL   ,
+    "issparse"       BOOL   ,
+    "isgenerated"    BOOL   ,
+    "recursiondepth" INTEGER,
+    PRIMARY KEY ("path","name","offsetheader")
+);
+CREATE TABLE "xattrkeys" (
+    "id" INTEGER PRIMARY KEY,
+    "name" VARCHAR(65535) UNIQUE
+);
+CREATE TABLE "xattrsdata" (
+    "offsetheader" INTEGER,
+    "keyid" INTEGER,
+    "value" VARCHAR(65535),
+    PRIMARY KEY ("offsetheader","keyid"),
+    FOREIGN KEY ("keyid") REFERENCES xattrkeys("id")
+);
+CREATE VIEW "xattrs" ( "offsetheader", "key", "value" ) AS
+    SELECT offsetheader, xattrkeys.name, value FROM "xattrsdata"
+    INNER JOIN xattrkeys ON xattrkeys.id = xattrsdata.keyid;
+CREATE TABLE "metadata" (
+    "key"      VARCHAR(65535) NOT NULL,
+    "value"    VARCHAR(65535) NOT NULL,
+    PRIMARY KEY ("key")
+);
+CREATE TABLE "versions" (
+    "name"     VARCHAR(65535) NOT NULL,
+    "version"  VARCHAR(65535) NOT NULL,
+    "major"    INTEGER,
+    "minor"    INTEGER,
+    "patch"    INTEGER,
+    PRIMARY KEY ("name")
+);
+"""
+
+# not read by ratarmount.
+# the block groups of an archive written by blockpack.py,
+# so the next incremental pack can reuse their xz blocks
+block_groups_schema = """
+CREATE TABLE "blockgroups" (
+    "first_block"  INTEGER PRIMARY KEY,
+    "num_blocks"   INTEGER NOT NULL,
+    "signature"    VARCHAR(64) NOT NULL
+);
+"""
+
+# tar typeflag -> file type bits, like ratarmount's _tar_info_full_mode
+# hard links (typeflag 1) have only the permission bits
+type_modes = {
+    "0": stat.S_IFREG,
+    "2": stat.S_IFLNK,
+    "5": stat.S_IFDIR,
+}
+
+def get_index_path(archive_path):
+    return archive_path + index_suffix
+
+def split_name(name):
+    """
+    split a tar member name into the (path, name) columns of ratarmount
+
+    "torrents/" -> ("", "torrents")
+    "torrents/a/t0.torrent" -> ("/torrents/a", "t0.torrent")
+    """
+    dir_name, base_name = os.path.split("/" + name.rstrip("/"))
+    return ("" if dir_name == "/" else dir_name), base_name
+
+def member_row(member):
+    path, name = split_name(member.name)
+    return (
+        path,
+        name,
+        member.offset,
+        member.data_offset,
+        member.size,
+        0, # mtime
+        member.mode | type_modes.get(member.typeflag, 0),
+        member.typeflag.encode(),
+        member.linkname or "",
+        0, # uid
+        0, # gid
+        False, # istar
+        False, # issparse
+        False, # isgenerated
+        1, # recursiondepth
+    )
+
+def write_index(members, archive_path, index_path=None, block_groups=None):
+    """
+    write the ratarmount index of archive_path
+
+    members: TarMember list from TarWriter, in archive order
+    block_groups: (first_block, num_blocks, signature) list from blockpack.py
+    """
+    index_path = index_path or get_index_path(archive_path)
+    temp_path = index_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.unlink(temp_path)
+    db = sqlite3.connect(temp_path)
+    try:
+        db.executescript(index_schema)
+        db.executemany("INSERT INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", map(member_row, members))
+        # only st_size is stored: ratarmount rejects the index when the archive shrinks,
+        # and the mtime changes when the release is downloaded
+        db.executemany("INSERT INTO metadata VALUES (?,?)", [
+            ("tarstats", json.dumps({"st_size": os.path.getsize(archive_path)})),
+            ("backendName", "SQLiteIndexedTar"),
+            ("isGnuIncremental", "0"),
+        ])
+        if block_groups is not None:
+            db.executescript(block_groups_schema)
+            db.executemany("INSERT INTO blockgroups VALUES (?,?,?)", block_groups)
+        db.executemany("INSERT INTO versions VALUES (?,?,?,?,?)", [
+            ("index", ratarmount_index_version, *map(int, ratarmount_index_version.split("."))),
+        ])
+        db.commit()
+    finally:
+        db.close()
+    os.replace(temp_path, index_path)
+    return index_path
+
+def row_member(path, name, offset, data_offset, size, mode, typeflag, linkname):
+    typeflag = typeflag.decode() if isinstance(typeflag, bytes) else str(typeflag)
+    name = f"{path}/{name}"[1:] if path else name
+    if typeflag == "5":
+        name += "/"
+    return TarMember(name, typeflag, stat.S_IMODE(mode), size, offset, data_offset, linkname or None)
+
+def read_index(index_path):
+    "return the TarMember list of an index, in archive order"
+    with sqlite3.connect(f"file:{index_path}?mode=ro", uri=True) as db:
+        rows = db.execute(
+            "SELECT path, name, offsetheader, offset, size, mode, type, linkname "
+            "FROM files WHERE NOT coalesce(isgenerated, 0) ORDER BY offsetheader"
+        ).fetchall()
+    return [row_member(*row) for row in rows]
+
+def read_block_groups(index_path):
+    "return the (first_block, num_blocks, signature) list of an index, or [] if it has none"
+    with sqlite3.connect(f"file:{index_path}?mode=ro", uri=True) as db:
+        try:
+            return db.execute("SELECT first_block, num_blocks, signature FROM blockgroups ORDER BY first_block").fetchall()
+        except sqlite3.OperationalError:
+            return []
+
+def compare_ratarmount(archive_path, index_path=None):
+    """
+    compare the files table of our index with the index of ratarmountcore
+
+    return True if the tables are equal
+    """
+    import tempfile
+    # pip install ratarmountcore
+    from ratarmountcore.mountsource.formats.tar import SQLiteIndexedTar
+
+    index_path = index_path or get_index_path(archive_path)
+    query = "SELECT * FROM files ORDER BY offsetheader"
+    with sqlite3.connect(index_path) as db:
+        ours = db.execute(query).fetchall()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ref_path = os.path.join(temp_dir, "ref" + index_suffix)
+        SQLiteIndexedTar(archive_path, writeIndex=True, indexFilePath=ref_path).close()
+        with sqlite3.connect(ref_path) as db:
+            ref = db.execute(query).fetchall()
+
+    print(f"ratarmount: {len(ref)} files")
+    print(f"ours:       {len(ours)} files")
+    for ref_row, our_row in zip(ref, ours):
+        if ref_row != our_row:
+            print(f"error: first difference")
+            print(f"  ratarmount: {ref_row!r}")
+            print(f"  ours:       {our_row!r}")
+            return False
+    if len(ref) != len(ours):
+        print("error: different number of files")
+        return False
+    print("ok: files are equal")
+
+    # load our index, like ratarmount does on mount
+    SQLiteIndexedTar(archive_path, indexFilePath=index_path, writeIndex=False).close()
+    print("ok: ratarmount loads our index")
+    return True
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="check the ratarmount index written by pack.py")
+    parser.add_argument("archive")
+    parser.add_argument("--index", help=f"index file (default: archive{index_suffix})")
+    parser.add_argument("--compare-ratarmount", action="store_true",
+        help="compare our index with the index of ratarmountcore, exit 1 if they differ")
+    args = parser.parse_args()
+    if args.compare_ratarmount:
+        sys.exit(0 if compare_ratarmount(args.archive, args.index) else 1)
+    index_path = args.index or get_index_path(args.archive)
+    with sqlite3.connect(index_path) as db:
+        count, size = db.execute("SELECT count(*), sum(size) FROM files").fetchone()
+        print(f"{index_path}: {count} files, {size} bytes")
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+# tarwriter.py
+# reproducible tar writer, byte-compatible with the GNU tar call in pack.py
+
+"""
+Reproducible tar writer.
+
+The output is byte-identical to
+
+    tar --sort=name --mtime="UTC 1970-01-01" --owner=0 --group=0 --numeric-owner \\
+      --pax-option=exthdr.name=%d/PaxHeaders/%f,delete=atime,delete=ctime \\
+      --exclude="*.part" -c -f - <paths>
+
+--pax-option makes GNU tar write the POSIX.1-2001 (pax) format:
+ustar headers with mtime 0, uid/gid 0 and empty user/group names,
+plus a pax extended header with a "path" or "linkpath" record
+for names longer than 100 bytes or with non-ASCII bytes.
+Directories are walked depth-first, entries sorted by their byte names.
+Hard links are stored as link entries, like GNU tar does.
+
+File contents are prefetched by a thread pool,
+so the latency of reading many small files overlaps.
+
+Usage:
+    # compare our output with GNU tar
+    ./tarwriter.py --compare-gnu-tar torrents torrents.json
+"""
+
+import os
+import sys
+import stat
+import fnmatch
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+block_size = 512
+# GNU tar pads the archive to a multiple of the record size
+# default blocking factor: 20 blocks
+record_size = 20 * block_size
+
+default_exclude = ["*.part"]
+
+# prefetch files up to this size in the thread pool
+# larger files are streamed by the writer thread
+prefetch_max_size = 8 * 1024 * 1024
+default_read_ahead = 256
+default_threads = 16
+
+stream_chunk_size = 1024 * 1024
+
+def octal(value, width):
+    # zero-padded octal number with a trailing NUL
+    s = b"%0*o" % (width - 1, value)
+    if len(s) > width - 1:
+        raise ValueError(f"value {value} does not fit into {width} bytes")
+    return s + b"\0"
+
+def build_header(name, mode, size, typeflag, linkname=b"", devnums=True):
+    "build one ustar header block with the fixed reproducible fields"
+    h = bytearray(block_size)
+    h[0:100] = name[:100].ljust(100, b"\0")
+    h[100:108] = octal(mode, 8)
+    h[108:116] = octal(0, 8) # uid
+    h[116:124] = octal(0, 8) # gid
+    h[124:136] = octal(size, 12)
+    h[136:148] = octal(0, 12) # mtime
+    h[148:156] = b" " * 8 # checksum placeholder
+    h[156:157] = typeflag
+    h[157:257] = linkname[:100].ljust(100, b"\0")
+    h[257:263] = b"ustar\0"
+    h[263:265] = b"00"
+    # uname and gname stay empty with --numeric-owner
+    if devnums:
+        h[329:337] = octal(0, 8) # devmajor
+        h[337:345] = octal(0, 8) # devminor
+    h[148:156] = b"%06o\0 " % sum(h)
+    return bytes(h)
+
+def pax_record(keyword, value):
+    # "%d %s=%s\n" where %d is the length of the whole record
+    payload = b" " + keyword + b"=" + value + b"\n"
+    length = len(payload)
+    while True:
+        total = len(str(length).encode()) + len(payload)
+        if total == length:
+            return str(length).encode() + payload
+        length = total
+
+def padding(size):
+    return b"\0" * (-size % block_size)
+
+def needs_pax(name):
+    return len(name) > 100 or not name.isascii()
+
+def pax_header_name(name):
+    # exthdr.name=%d/PaxHeaders/%f
+    name = name.rstrip(b"/")
+    dir_name, base_name = os.path.split(name)
+    return (dir_name or b".") + b"/PaxHeaders/" + base_name
+
+class TarMember:
+    """
+    one member of the written archive
+
+    offset: start of the first header block, including a pax header
+    data_offset: start of the file contents
+    """
+
+    __slots__ = ("name", "typeflag", "mode", "size", "offset", "data_offset", "linkname")
+
+    def __init__(self, name, typeflag, mode, size, offset, data_offset, linkname=None):
+        self.name = name
+        self.typeflag = typeflag
+        self.mode = mode
+        self.size = size
+        self.offset = offset
+        self.data_offset = data_offset
+        self.linkname = linkname
+
+    def __repr__(self):
+        return f"TarMember({self.name!r}, {self.typeflag!r}, size={self.size}, offset={self.offset})"
+
+def is_excluded(path, exclude):
+    base_name = os.path.basename(path.rstrip("/"))
+    return any(
+        fnmatch.fnmatchcase(base_name, pattern) or fnmatch.fnmatchcase(path, pattern)
+        for pattern in exclude
+    )
+
+def iter_tree(path, exclude):
+    "yield (path, lstat) in the order of tar --sort=name"
+    if is_excluded(path, exclude):
+        return
+    st = os.lstat(path)
+    yield path, st
+    if stat.S_ISDIR(st.st_mode):
+        for name in sorted(os.listdir(path), key=os.fsencode):
+            yield from iter_tree(os.path.join(path, name), exclude)
+
+def read_file(path, size):
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) != size:
+        raise RuntimeError(f"file changed as we read it: {path}")
+    return data
+
+class TarWriter:
+    """
+    write a reproducible tar archive to fileobj
+
+    with fileobj=None, nothing is read or written,
+    only the offsets of the members are counted
+
+    usage:
+
+        with open("out.tar", "wb") as f:
+            writer = TarWriter(f)
+            writer.add_paths(["torrents", "torrents.json"])
+            writer.close()
+        # writer.members has the offsets of all members
+    """
+
+    def __init__(self, fileobj, exclude=default_exclude, read_ahead=default_read_ahead, threads=default_threads):
+        self.fileobj = fileobj
+        self.exclude = list(exclude)
+        self.read_ahead = read_ahead
+        self.threads = threads
+        self.offset = 0
+        self.members = []
+        # (st_dev, st_ino) -> member name, to detect hard links
+        self.links = {}
+
+    def write(self, data):
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+        self.offset += len(data)
+
+    def write_header(self, name, mode, size, typeflag, linkname=b""):
+        "write the header blocks of one member, return the member offset"
+        offset = self.offset
+        # GNU tar writes linkpath before path
+        records = b""
+        if needs_pax(linkname):
+            records += pax_record(b"linkpath", linkname)
+        if needs_pax(name):
+            records += pax_record(b"path", name)
+        if records:
+            self.write(
+                build_header(pax_header_name(name), 0o644, len(records), b"x", devnums=False)
+                + records + padding(len(records))
+            )
+        self.write(build_header(name, mode, size, typeflag, linkname))
+        return offset
+
+    def plan(self, path, st):
+        "return (name, typeflag, size, linkname) of a tree entry"
+        mode = st.st_mode
+        if stat.S_ISDIR(mode):
+            return os.fsencode(path.rstrip("/")) + b"/", b"5", 0, b""
+        name = os.fsencode(path)
+        if stat.S_ISLNK(mode):
+            return name, b"2", 0, os.fsencode(os.readlink(path))
+        if not stat.S_ISREG(mode):
+            raise RuntimeError(f"unsupported file type: {path}")
+        if st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            target = self.links.get(key)
+            if target is not None:
+                return name, b"1", 0, target
+            self.links[key] = name
+        return name, b"0", st.st_size, b""
+
+    def iter_planned(self, paths):
+        for top_path in paths:
+            for path, st in iter_tree(top_path, self.exclude):
+                yield (path, st, *self.plan(path, st))
+
+    def add_paths(self, paths):
+        "add the trees below paths, in the given order"
+        pending = deque()
+        with ThreadPoolExecutor(self.threads) as executor:
+            for item in self.iter_planned(paths):
+                path, st, name, typeflag, size, linkname = item
+                future = None
+                if typeflag == b"0" and size <= prefetch_max_size:
+                    future = executor.submit(read_file, path, size)
+                pending.append((item, future))
+                if len(pending) >= self.read_ahead:
+                    self.add_member(*pending.popleft())
+            while pending:
+                self.add_member(*pending.popleft())
+
+    def add_member(self, item, future):
+        path, st, name, typeflag, size, linkname = item
+        mode = 0o777 if typeflag == b"2" else stat.S_IMODE(st.st_mode)
+        offset = self.write_header(name, mode, size, typeflag, linkname)
+        data_offset = self.offset
+        if typeflag == b"0":
+            if self.fileobj is None:
+                # only count the offsets
+                self.offset += size
+            elif future is not None:
+                self.write(future.result())
+            else:
+                self.write_stream(path, size)
+            self.write(padding(size))
+        self.members.append(TarMember(
+            name.decode("utf8", "surrogateescape"), typeflag.decode(), mode,
+            size, offset, data_offset,
+            linkname.decode("utf8", "surrogateescape") if linkname else None,
+        ))
+
+    def write_stream(self, path, size):
+        remaining = size
+        with open(path, "rb") as f:
+            while remaining > 0:
+                chunk = f.read(min(stream_chunk_size, remaining))
+                if not chunk:
+                    break
+                self.write(chunk)
+                remaining -= len(chunk)
+            if remaining != 0 or f.read(1):
+                raise RuntimeError(f"file changed as we read it: {path}")
+
+    def close(self):
+        "write the end-of-archive blocks and pad to the record size"
+        self.write(b"\0" * (2 * block_size))
+        self.write(b"\0" * (-self.offset % record_size))
+
+def write_tar(fileobj, paths, **kwargs):
+    "write a reproducible tar archive of paths to fileobj, return the members"
+    writer = TarWriter(fileobj, **kwargs)
+    writer.add_paths(paths)
+    writer.close()
+    return writer.members
+
+def compare_gnu_tar(paths):
+    """
+    compare our output with GNU tar for the same paths
+
+    return True if the bytes are equal
+    """
+    import subprocess
+    import tempfile
+    from pack import get_tar_args
+
+    args = get_tar_args("-")
+    # replace the default archive paths
+    args = args[:args.index("-f") + 2] + list(paths)
+    gnu = subprocess.run(args, stdout=subprocess.PIPE, check=True).stdout
+
+    with tempfile.TemporaryFile() as f:
+        write_tar(f, paths)
+        f.seek(0)
+        ours = f.read()
+
+    print(f"gnu tar: {len(gnu)} bytes, sha1 {hashlib.sha1(gnu).hexdigest()}")
+    print(f"ours:    {len(ours)} bytes, sha1 {hashlib.sha1(ours).hexdigest()}")
+    if gnu == ours:
+        print("ok: output is equal")
+        return True
+    diff = next((i for i, (a, b) in enumerate(zip(gnu, ours)) if a != b), min(len(gnu), len(ours)))
+    block = diff - diff % block_size
+    print(f"error: first difference at byte {diff}")
+    print(f"  gnu tar block: {gnu[block:block + block_size]!r}")
+    print(f"  our block:     {ours[block:block + block_size]!r}")
+    return False
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="write a reproducible tar archive")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--compare-gnu-tar", action="store_true",
+        help="compare our output with GNU tar, exit 1 if they differ")
+    parser.add_argument("-f", "--file", default="-",
+        help="output file (default: stdout)")
+    args = parser.parse_args()
+    if args.compare_gnu_tar:
+        sys.exit(0 if compare_gnu_tar(args.paths) else 1)
+    if args.file == "-":
+        write_tar(sys.stdout.buffer, args.paths)
+    else:
+        with open(args.file, "wb") as f:
+            write_tar(f, args.paths)
@@ -0,0 +1,62 @@
+# test_hashes.py
+# pin the release layout: the piece cache of hashes.py and the torrent of release.py
+
+# pip install pytest torf
+import os
+
+import pytest
+torf = pytest.importorskip("torf")
+
+import piecehash
+from hashes import hash_file, write_hashes
+from piecehash import read_piece_cache, set_release_layout, generate, default_piece_size, release_first_file
+
+def write_random(path, size):
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+
+@pytest.fixture
+def release(tmp_path):
+    # like release.py: the archive is hashed by pack.py, then linked into the content dir
+    archive_path = str(tmp_path / "torrents.tar.xz")
+    write_random(archive_path, 5 * 1024 * 1024 + 123)
+    write_hashes(archive_path, hash_file(archive_path, tiger=False))
+    content_path = tmp_path / "annas-torrents-2025-07-19"
+    content_path.mkdir()
+    os.link(archive_path, content_path / "torrents.tar.xz")
+    # sorted before torrents.tar.xz by torf
+    for name in ["dedup.py", "pack.py", "torrents.json"]:
+        write_random(content_path / name, 1000)
+    return archive_path, str(content_path)
+
+def create_torrent(content_path, cache):
+    t = torf.Torrent(path=content_path, creation_date=None, created_by=None, randomize_infohash=False)
+    set_release_layout(t, release_first_file, cache[0] if cache else None)
+    return t
+
+def test_constants():
+    # changing these changes the infohash of every release
+    assert release_first_file == "torrents.tar.xz"
+    assert default_piece_size == 2 * 1024 * 1024
+
+def test_piece_cache(release):
+    archive_path, content_path = release
+    cache = read_piece_cache(archive_path)
+    assert cache[0] == default_piece_size
+    assert len(cache[1]) == 2 * piecehash.piece_hash_size
+
+def test_release_layout(release):
+    archive_path, content_path = release
+    cache = read_piece_cache(archive_path)
+    t = create_torrent(content_path, cache)
+    assert [f["path"] for f in t.metainfo["info"]["files"]] == [
+        ["torrents.tar.xz"], ["dedup.py"], ["pack.py"], ["torrents.json"],
+    ]
+    assert t.piece_size == 2 * 1024 * 1024
+
+    generate(t, workers=2, progress=False, cache=cache)
+    # torf hashes the same layout to the same pieces
+    ref = create_torrent(content_path, cache)
+    ref.generate()
+    assert t.metainfo["info"]["pieces"] == ref.metainfo["info"]["pieces"]
+    assert t.infohash == ref.infohash
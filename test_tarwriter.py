@@ -0,0 +1,82 @@
+# test_tarwriter.py
+# compare tarwriter.py with GNU tar, byte for byte
+
+# pip install pytest
+import io
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from tarwriter import write_tar
+from pack import get_tar_args
+
+def is_gnu_tar():
+    if not shutil.which("tar"):
+        return False
+    result = subprocess.run(["tar", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return b"GNU tar" in result.stdout
+
+pytestmark = pytest.mark.skipif(not is_gnu_tar(), reason="GNU tar not found")
+
+def gnu_tar(paths):
+    args = get_tar_args("-")
+    # replace the default archive paths
+    args = args[:args.index("-f") + 2] + paths
+    return subprocess.run(args, stdout=subprocess.PIPE, check=True).stdout
+
+def our_tar(paths):
+    f = io.BytesIO()
+    write_tar(f, paths)
+    return f.getvalue()
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    # GNU tar stores the names as given, so both get the same relative paths
+    monkeypatch.chdir(tmp_path)
+    write_file("torrents/a/small.torrent", b"d4:infod4:name1:aee")
+    write_file("torrents/a/empty.torrent", b"")
+    write_file("torrents/a/block.torrent", b"x" * 512)
+    write_file("torrents/a/large.torrent", os.urandom(3 * 1024 * 1024 + 1))
+    # longer than the 100 bytes of the ustar name field
+    write_file("torrents/" + "long-" * 30 + "/" + "n" * 120 + ".torrent", b"long")
+    write_file("torrents/b/äöü-日本.torrent", b"non-ascii")
+    write_file("torrents/b/B.torrent", b"sorted before a")
+    # partial download, excluded
+    write_file("torrents/b/partial.torrent.part", b"part")
+    os.makedirs("torrents/empty")
+    os.symlink("../a/small.torrent", "torrents/b/symlink.torrent")
+    os.symlink("l" * 150, "torrents/b/long-symlink.torrent")
+    os.link("torrents/a/small.torrent", "torrents/b/hardlink.torrent")
+    write_file("torrents.json", b"[]")
+    return tmp_path
+
+def assert_equal_tar(paths):
+    gnu = gnu_tar(paths)
+    ours = our_tar(paths)
+    if gnu != ours:
+        diff = next((i for i, (a, b) in enumerate(zip(gnu, ours)) if a != b), min(len(gnu), len(ours)))
+        block = diff - diff % 512
+        pytest.fail(f"first difference at byte {diff}:\n"
+            f"  gnu tar block: {gnu[block:block + 512]!r}\n"
+            f"  our block:     {ours[block:block + 512]!r}")
+
+def test_tree(tree):
+    assert_equal_tar(["torrents", "torrents.json"])
+
+def test_single_files(tree):
+    assert_equal_tar(["torrents.json", "torrents/a/small.torrent"])
+
+def test_empty_dir(tree):
+    assert_equal_tar(["torrents/empty"])
+
+def test_exclude(tree):
+    names = our_tar(["torrents/b"])
+    assert b"partial.torrent.part" not in names
+    assert b"hardlink.torrent" in names
@@ -1,123 +1,210 @@
 #!/usr/bin/env python3
 
-base_url = "https://annas-archive.org"
-torrents_json_url = f"{base_url}/dyn/torrents.json"
-cache_file = "torrents.json"
-url_prefix = f"{base_url}/dyn/small_file/"
-url_prefix_len = len(url_prefix)
-
 version_file_path = "version.txt"
 
 import os
-import re
-import time
-import json
 import asyncio
+import argparse
 from pathlib import Path
 
 # pip install aiohttp
 import aiohttp
 
-def format_date(date_int):
-    date_str = str(date_int)
-    assert len(date_str) == 8, f"invalid date_str {date_str}"
-    return "-".join([
-        date_str[0:4], # year
-        date_str[4:6], # month
-        date_str[6:8], # day
-    ])
-
-def parse_date(date_str):
-    assert len(date_str) == 10, f"invalid date_str {date_str}" # "2024-03-07"
-    return int(date_str.replace("-", "")) # 20240307
-
-async def main():
+from download import DownloadPool, create_session, refresh_file, default_workers, default_limit_per_host
+from manifest import base_url, cache_file, load_manifest, hash_file
+from state import StateDB, state_db_path
+from validate import validate_state
+from reconcile import torrents_dir, scan_tree, reconcile, check_removals, remove_empty_dirs
+from dedup import dedup_state, gc_store
+from metrics import Metrics, add_metrics_args
+from profiling import Profiler, add_profile_args
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="update the torrents/ mirror from torrents.json")
+    parser.add_argument("--workers", type=int, default=default_workers,
+        help=f"number of concurrent downloads (default: {default_workers})")
+    parser.add_argument("--limit-per-host", type=int, default=default_limit_per_host,
+        help=f"max open connections per host (default: {default_limit_per_host})")
+    parser.add_argument("--base-url", default=base_url,
+        help=f"base url of torrents.json and the torrent files (default: {base_url})")
+    parser.add_argument("--compress", action=argparse.BooleanOptionalAction, default=True,
+        help="allow a compressed transfer of torrents.json (default: yes)")
+    parser.add_argument("--keep-orphans", action="store_true",
+        help=f"only report local files which are not listed in {cache_file}")
+    parser.add_argument("--force", action="store_true",
+        help="remove files also when the manifest is empty or more than 5%% of the files would be removed")
+    parser.add_argument("--dry-run", action="store_true",
+        help="only report which files would be removed and how many would be downloaded. "
+            f"{cache_file} is still refreshed")
+    parser.add_argument("--verify", action="store_true",
+        help="rehash local files and refetch files with a changed sha1")
+    parser.add_argument("--validate", action=argparse.BooleanOptionalAction, default=True,
+        help="check that local files are valid torrents (default: yes)")
+    parser.add_argument("--validate-workers", type=int, default=None,
+        help="number of validator processes (default: number of CPUs)")
+    parser.add_argument("--dedup", action="store_true",
+        help="hard link files with the same content to a content-addressed store, see dedup.py")
+    add_metrics_args(parser)
+    add_profile_args(parser)
+    return parser.parse_args()
+
+async def main(args, metrics):
+
+    torrents_json_url = f"{args.base_url}/dyn/torrents.json"
+    url_prefix = f"{args.base_url}/dyn/small_file/"
 
     # Check and update cache file if needed
+    # this is a conditional request, so polling is cheap
     num_removed_files = 0
     cache_path = Path(cache_file)
-    if cache_path.exists():
-        cache_age = time.time() - cache_path.stat().st_ctime
-        if cache_age > 60 * 60 * 24:  # 24 hours
-            print(f"removing old {cache_file}")
-            cache_path.unlink()
-            num_removed_files += 1
-
-    if not cache_path.exists():
-        async with aiohttp.ClientSession() as session:
-            async with session.get(torrents_json_url) as response:
-                assert response.status == 200, f"bad response.status {response.status}"
-                with open(cache_file, 'wb') as f:
-                    while True:
-                        chunk = await response.content.read(1024)
-                        if not chunk:
-                            break
-                        f.write(chunk)
+    print(f"checking {torrents_json_url}")
+    with metrics.span("refresh_manifest") as span:
+        async with create_session() as session:
+            cache_changed = await refresh_file(session, torrents_json_url, cache_path, compress=args.compress)
+        span.bytes = cache_path.stat().st_size if cache_changed else 0
+    metrics.count("manifest_changed", int(cache_changed))
+    if cache_changed:
+        print(f"updated {cache_file}")
+    else:
+        print(f"not modified: {cache_file}")
 
     # Process torrents.json and prepare download URLs
-    with open(cache_file) as f:
-        torrents = json.load(f)
-
-    download_urls = []
-    last_torrent_date_int = 0
-    for torrent in torrents:
-        url = torrent['url']
-        size = torrent['torrent_size']
-        obsolete = torrent['obsolete']
-        embargo = torrent['embargo']
-
-        if not url.startswith(url_prefix):
-            print(f"ignoring url {url}", file=sys.stderr)
-            continue
-
-        if obsolete or embargo:
-            path = Path(url[url_prefix_len:])
-            if path.exists():
-                print(f"removing {path}", file=sys.stderr)
-                path.unlink()
-            continue
-
-        path = Path(url[url_prefix_len:])
-
-        # ignore annas-torrents torrents
-        # example:
-        # torrents/managed_by_aa/annas-torrents-2025-07-14.torrent/annas-torrents-2025-07-14.torrent
-        if str(path).startswith("torrents/managed_by_aa/annas-torrents-"):
-            continue
-
-        torrent_date_int = parse_date(torrent['added_to_torrents_list_at'])
-
-        if torrent_date_int > last_torrent_date_int:
-            last_torrent_date_int = torrent_date_int
-
-        if path.exists():
-            actual_size = path.stat().st_size
-            if actual_size != size:
-                print(f"removing {path} (size mismatch)", file=sys.stderr)
-                path.unlink()
-            else:
-                continue
-
-        download_urls.append(url)
-
-    # Download all files reusing the same TCP connection
-    if download_urls:
-        async with aiohttp.ClientSession() as session:
-            for url in download_urls:
-                path = Path(url[url_prefix_len:])
-                path.parent.mkdir(parents=True, exist_ok=True)
-
-                # print(f"fetching {url}")
-                print(f"fetching {path}")
-                async with session.get(url) as response:
-                    with open(path, 'wb') as f:
-                        while True:
-                            chunk = await response.content.read(1024)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-
-    last_torrent_date = format_date(last_torrent_date_int)
+    manifest = load_manifest(cache_file, url_prefix)
+
+    for url in manifest.ignored_urls:
+        print(f"ignoring url {url}", file=sys.stderr)
+
+    # Sweep the torrents/ tree once and diff it against the manifest
+    with metrics.span("reconcile"):
+        tree = scan_tree(torrents_dir)
+        result = reconcile(manifest.entries, tree)
+
+    # obsolete, embargoed or no longer listed
+    orphans = result.orphans
+    if args.keep_orphans:
+        for path in orphans:
+            print(f"keeping orphan {path}", file=sys.stderr)
+            metrics.count("files_kept")
+        orphans = []
+
+    if args.dry_run:
+        for path in orphans:
+            print(f"would remove {path}")
+        for entry, size in result.mismatched:
+            print(f"would remove {entry.path} (size mismatch)")
+        print(f"would remove {len(orphans) + len(result.mismatched)} of {len(tree.files)} files, "
+            f"would download {len(result.missing)} files")
+        return
+
+    # a truncated or filtered manifest must not empty the tree
+    error = check_removals(manifest.entries, tree, orphans + [entry.path for entry, size in result.mismatched])
+    if error and not args.force:
+        print(f"error: {error}. hint: check {cache_file}, run with --dry-run to list the files, or with --force", file=sys.stderr)
+        sys.exit(1)
+
+    with StateDB(state_db_path) as db:
+        db.sync_manifest(manifest.entries)
+
+        removed_paths = []
+        for path in orphans:
+            print(f"removing {path}", file=sys.stderr)
+            os.unlink(path)
+            removed_paths.append(path)
+        num_removed_files += len(removed_paths)
+
+        for entry, size in result.mismatched:
+            print(f"removing {entry.path} (size mismatch)", file=sys.stderr)
+            os.unlink(entry.path)
+            removed_paths.append(entry.path)
+
+        metrics.count("files_removed", len(removed_paths))
+        metrics.count("files_skipped", len(result.present))
+        if removed_paths:
+            db.record_removed_paths(removed_paths)
+            remove_empty_dirs(tree)
+
+        db.sync_tree(
+            (entry.url, size, mtime_ns)
+            for entry, size, mtime_ns in result.present
+        )
+
+        if args.verify:
+            # find files that changed since they were downloaded
+            print("verifying local files")
+            with metrics.span("verify") as span:
+                span.bytes = 0
+                for url, path, size, mtime_ns, sha1 in db.get_present():
+                    if not os.path.exists(path):
+                        print(f"missing {path}", file=sys.stderr)
+                        db.record_removed(url, event="lost")
+                        continue
+                    actual_sha1 = hash_file(path)
+                    span.bytes += size
+                    if sha1 is None:
+                        st = os.stat(path)
+                        db.record_file(url, path, st.st_size, st.st_mtime_ns, actual_sha1)
+                    elif actual_sha1 != sha1:
+                        print(f"removing {path} (sha1 mismatch)", file=sys.stderr)
+                        os.unlink(path)
+                        db.record_removed(url, event="corrupt")
+                        metrics.count("files_corrupt")
+                db.commit()
+
+        # Download missing files
+        # the pool workers reuse a few keep-alive TCP connections
+        async def record_download(url, path):
+            # hash in a thread, so the event loop keeps the other downloads busy.
+            # the sqlite connection belongs to this thread, so the write stays here
+            sha1 = await asyncio.to_thread(hash_file, path)
+            db.record_download(url, path, sha1)
+
+        pool = DownloadPool(
+            workers=args.workers,
+            limit_per_host=args.limit_per_host,
+            on_done=record_download,
+            metrics=metrics,
+        )
+        with metrics.span("download") as span:
+            pool.start()
+
+            download_urls = []
+            for url, path, expected_size in db.get_missing():
+                download_urls.append(url)
+                pool.put(url, path, expected_size)
+
+            # wait for the download queue to drain
+            await pool.close()
+            span.bytes = metrics.counters.get("downloaded_bytes", 0)
+        metrics.count("files_fetched", pool.num_done)
+
+        # Validate new and changed files
+        # this is a no-op for files which were validated before
+        num_invalid_files = 0
+        if args.validate:
+            with metrics.span("validate"):
+                num_invalid_files = validate_state(db, args.validate_workers)
+            metrics.count("files_invalid", num_invalid_files)
+
+        # Hard link duplicate files
+        # pack.py writes them as tar hard links
+        if args.dedup:
+            with metrics.span("dedup"):
+                stats = dedup_state(db)
+                print(f"dedup: {stats}")
+                num_unused_objects = gc_store()
+                if num_unused_objects:
+                    print(f"dedup: removed {num_unused_objects} unused objects")
+            metrics.count("files_linked", stats.num_linked)
+
+    if pool.failed:
+        print(f"error: failed to fetch {len(pool.failed)} of {len(download_urls)} files", file=sys.stderr)
+        sys.exit(1)
+
+    if num_invalid_files:
+        print(f"error: found {num_invalid_files} invalid files. hint: run update.py again to refetch them", file=sys.stderr)
+        sys.exit(1)
+
+    last_torrent_date = manifest.last_date
 
     if os.path.exists(version_file_path):
         with open(version_file_path) as f:
@@ -133,7 +220,7 @@ async def main():
         with open(version_file_path, "w") as f:
             f.write(last_torrent_date + "\n")
 
-    if len(download_urls) == 0 and num_removed_files == 0:
+    if len(download_urls) == 0 and num_removed_files == 0 and not cache_changed:
         print(f"already up to date: no files were added or removed")
         sys.exit(1)
 
@@ -142,4 +229,7 @@ async def main():
 
 if __name__ == "__main__":
     import sys
-    asyncio.run(main())
+    args = parse_args()
+    with Metrics("update", args.metrics_dir, args.textfile_dir) as metrics:
+        with Profiler("update", args.profile, args.profile_dir, args.profile_memory) as profiler:
+            profiler.run_async(main(args, metrics))
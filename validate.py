@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# validate.py
+# check that downloaded .torrent files are valid torrents
+
+# invalid files are moved to quarantine_dir/<path>
+quarantine_dir = "quarantine"
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bencode import BencodeError, decode_torrent, check_torrent
+
+def validate_torrent(path, expected_infohash=None):
+    """
+    parse a .torrent file and check its structure
+
+    return (infohash, error) where error is None for a valid torrent.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        metainfo, infohash = decode_torrent(data)
+        check_torrent(metainfo)
+    except (OSError, BencodeError) as exc:
+        return None, str(exc)
+    if expected_infohash and infohash != expected_infohash.lower():
+        return infohash, f"infohash mismatch: expected {expected_infohash}, actual {infohash}"
+    return infohash, None
+
+def validate_job(job):
+    path, expected_infohash = job
+    return validate_torrent(path, expected_infohash)
+
+def validate_files(jobs, workers=None, chunksize=64):
+    """
+    validate many .torrent files in a process pool
+
+    jobs: [(path, expected_infohash)]
+    yield (job, infohash, error) in the order of jobs
+    """
+    jobs = list(jobs)
+    if workers == 1 or len(jobs) <= chunksize:
+        # not worth the process startup
+        for job in jobs:
+            yield (job, *validate_job(job))
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        results = executor.map(validate_job, jobs, chunksize=chunksize)
+        for job, (infohash, error) in zip(jobs, results):
+            yield job, infohash, error
+
+def quarantine_file(path, quarantine_dir=quarantine_dir):
+    "move path to quarantine_dir/path"
+    dst = os.path.join(quarantine_dir, path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.replace(path, dst)
+    return dst
+
+def validate_state(db, workers=None, quarantine_dir=quarantine_dir):
+    """
+    validate the local files without a known infohash
+
+    valid files get their infohash recorded,
+    so unchanged files are never validated again.
+    invalid files are quarantined and become missing.
+
+    return the number of invalid files.
+    """
+    rows = db.get_unvalidated()
+    if not rows:
+        return 0
+    print(f"validating {len(rows)} files")
+    t1 = time.time()
+    num_invalid = 0
+    jobs = [(path, btih) for url, path, btih in rows]
+    for (url, _, _), (job, infohash, error) in zip(rows, validate_files(jobs, workers)):
+        path = job[0]
+        if error is None:
+            db.record_infohash(url, infohash)
+            continue
+        num_invalid += 1
+        dst = quarantine_file(path, quarantine_dir)
+        print(f"error: invalid torrent {path}: {error}. moved to {dst}", file=sys.stderr)
+        db.record_removed(url, event="invalid")
+    db.commit()
+    t2 = time.time()
+    print(f"validated {len(rows)} files in {t2 - t1:.1f} seconds")
+    return num_invalid
+
+if __name__ == "__main__":
+    # validate .torrent files without touching the state database
+    import argparse
+    parser = argparse.ArgumentParser(description="validate .torrent files")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    num_invalid = 0
+    for (path, _), infohash, error in validate_files(((p, None) for p in args.paths), args.workers):
+        if error:
+            num_invalid += 1
+            print(f"error: {path}: {error}")
+        else:
+            print(f"{infohash} {path}")
+    sys.exit(1 if num_invalid else 0)